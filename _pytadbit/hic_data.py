@@ -12,23 +12,25 @@ from collections                    import OrderedDict
 from warnings                       import warn
 from bisect                         import bisect_right as bisect
 from pickle                         import HIGHEST_PROTOCOL, dump, load
+from itertools                      import islice
 
+import numpy as np
 from numpy.linalg                   import LinAlgError
 from numpy                          import corrcoef, nansum, array, isnan, mean
 from numpy                          import meshgrid, asarray, exp, linspace, std
 from numpy                          import nanpercentile as npperc, log as nplog
-from numpy                          import nanmax, ma, zeros_like
+from numpy                          import nanmax, ma
 from scipy.stats                    import ttest_ind, spearmanr
 from scipy.special                  import gammaincc
 from scipy.cluster.hierarchy        import linkage, fcluster, dendrogram
 from scipy.sparse.linalg            import eigsh
-from scipy.sparse                   import csr_matrix
+from scipy.sparse                   import csr_matrix, coo_matrix
 from scipy.ndimage                  import median_filter
 
 from pytadbit.utils.extraviews      import plot_compartments
 from pytadbit.utils.extraviews      import plot_compartments_summary
 from pytadbit.utils.hic_filtering   import filter_by_mean, filter_by_zero_count
-from pytadbit.utils.normalize_hic   import iterative, expected
+from pytadbit.utils.normalize_hic   import iterative, iterative_sparse, expected
 from pytadbit.parsers.genome_parser import parse_fasta
 from pytadbit.parsers.bed_parser    import parse_bed
 from pytadbit.utils.file_handling   import mkdir
@@ -82,40 +84,81 @@ class HiC_data(dict):
 
     def _symmetricize(self):
         """
-        Check if matrix is symmetric (check first 10 non-zero values) and,
-        if not, make it symmetric
+        Check if matrix is symmetric and, if not, make it symmetric
          - if matrix is half empty, copy values on one side to the other side
          - if matrix is asymmetric, sum non-diagonal values
         """
-        to_sum = False
-        symmetric = True
-        count  = 0
-        for n in self:
-            i = n // self.__size
-            j = n % self.__size
-            if i == j or self[i, j] == self[i, j] == 0:
-                continue
-            if not isclose(self[i, j], self[j, i]):
-                if self[i, j] != 0 and self[j, i] != 0:
-                    to_sum = True
-                symmetric = False
-                break
-            if count > 10:
-                return
-            count += 1
-        if symmetric:  # may not reach 10 values
+        rows, cols, values = self._coo()
+        if _is_symmetric(rows, cols, values):
             return
-        if to_sum:
-            for n in list(self.keys())[:]:
-                i = n // self.__size
-                j = n % self.__size
-                if i != j:
-                    self[j, i] = self[i, j] = self[j, i] + self[i, j]
-        else:
-            for n in list(self.keys())[:]:
-                i = n // self.__size
-                j = n % self.__size
-                self[j, i] = self[i, j] = self[n]
+        self._load_coo(rows, cols, values)
+
+    def _coo(self):
+        """
+        :returns: rows, columns and values of the stored interactions
+        """
+        keys = np.fromiter(dict.keys(self), dtype=np.int64,
+                           count=dict.__len__(self))
+        values = np.array(list(dict.values(self)))
+        rows, cols = np.divmod(keys, self.__size)
+        return rows, cols, values
+
+    def _load_coo(self, rows, cols, values):
+        """
+        Stores interactions given as arrays of rows, columns and values. The
+        stored matrix is made symmetric (see _symmetricize).
+        """
+        rows, cols, values = _upper_triangle(rows, cols, values)
+        off = rows != cols
+        keys = np.concatenate((rows * self.__size + cols,
+                               cols[off] * self.__size + rows[off]))
+        values = np.concatenate((values, values[off]))
+        dict.update(self, zip(keys.tolist(), values.tolist()))
+
+    def _update_coo(self, rows, cols, values):
+        """
+        Sets interactions given as arrays of rows, columns and values (same as
+        setting them one by one, the matrix is not made symmetric)
+        """
+        dict.update(self, zip((rows.astype(np.int64) * self.__size +
+                               cols).tolist(), values.tolist()))
+
+    @classmethod
+    def from_coo(cls, matrix, **kwargs):
+        """
+        Builds a Hi-C data object from a scipy sparse matrix. Duplicated
+        entries are summed.
+
+        :param matrix: square scipy sparse matrix (COO format preferably), it
+           can hold the full matrix or only one of its triangles (the other
+           is then filled by symmetry)
+        :param kwargs: any other argument of HiC_data (chromosomes, dict_sec,
+           resolution, masked...)
+
+        :returns: Hi-C data object
+        """
+        matrix = coo_matrix(matrix)
+        if matrix.shape[0] != matrix.shape[1]:
+            raise Exception('ERROR: matrix should be square')
+        matrix.sum_duplicates()
+        hic = cls((), matrix.shape[0], **kwargs)
+        hic._load_coo(matrix.row.astype(np.int64),
+                      matrix.col.astype(np.int64), matrix.data)
+        return hic
+
+    @classmethod
+    def from_csr(cls, matrix, **kwargs):
+        """
+        Builds a Hi-C data object from a scipy sparse matrix in Compressed
+        Sparse Row format (see from_coo).
+
+        :param matrix: square scipy sparse matrix
+        :param kwargs: any other argument of HiC_data (chromosomes, dict_sec,
+           resolution, masked...)
+
+        :returns: Hi-C data object
+        """
+        return cls.from_coo(csr_matrix(matrix).tocoo(), **kwargs)
 
     def _update_size(self, size):
         self.__size +=  size
@@ -169,16 +212,9 @@ class HiC_data(dict):
 
         :returns: scipy sparse matrix in Compressed Sparse Row format
         """
-        values = []
-        cols = []
-        rows = []
-        for key, value in self.items():
-            row, col = round(key // self.__size), key % self.__size
-            values.append(float(value))
-            cols.append(col)
-            rows.append(row)
-
-        return csr_matrix((values, (rows, cols)), shape=(self.__size,self.__size))
+        rows, cols, values = self._coo()
+        return csr_matrix((values.astype(float), (rows, cols)),
+                          shape=(self.__size, self.__size))
 
     def add_sections_from_fasta(self, fasta):
         """
@@ -378,7 +414,7 @@ class HiC_data(dict):
         self.expected = expected(self, bads=self.bads, **kwargs)
 
     def normalize_hic(self, iterations=0, max_dev=0.1, silent=False,
-                      sqrt=False, factor=1):
+                      sqrt=False, factor=1, sparse=True, warm_start=False):
         """
         Normalize the Hi-C data.
 
@@ -392,10 +428,21 @@ class HiC_data(dict):
         :param False sqrt: uses the square root of the computed biases
         :param 1 factor: final mean number of normalized interactions wanted
            per cell (excludes filtered, or bad, out columns)
+        :param True sparse: computes the biases with sparse matrix-vector
+           products (much faster on large matrices), otherwise uses the
+           dictionary based implementation
+        :param False warm_start: uses previously computed biases as starting
+           point of the iterative correction (only with sparse)
         """
-        bias = iterative(self, iterations=iterations,
-                         max_dev=max_dev, bads=self.bads,
-                         verbose=not silent)
+        if sparse:
+            bias = iterative_sparse(self, iterations=iterations,
+                                    max_dev=max_dev, bads=self.bads,
+                                    bias=self.bias if warm_start else None,
+                                    verbose=not silent)
+        else:
+            bias = iterative(self, iterations=iterations,
+                             max_dev=max_dev, bads=self.bads,
+                             verbose=not silent)
         if sqrt:
             bias = dict((b, bias[b]**0.5) for b in bias)
         if factor:
@@ -630,7 +677,7 @@ class HiC_data(dict):
         out.close()
 
     def get_matrix(self, focus=None, diagonal=True, normalized=False,
-                   masked=False):
+                   masked=False, as_array=False):
         """
         returns a matrix.
 
@@ -644,47 +691,110 @@ class HiC_data(dict):
         :param False normalized: get normalized data
         :param False masked: return masked arrays using the definition of bad
            columns
+        :param False as_array: return a numpy array (see get_array)
 
         :returns: matrix (a list of lists of values)
         """
+        matrix = self.get_array(focus=focus, diagonal=diagonal,
+                                normalized=normalized, masked=masked)
+        if masked or as_array:
+            return matrix
+        return matrix.tolist()
+
+    def get_array(self, focus=None, diagonal=True, normalized=False,
+                  masked=False, dtype=None):
+        """
+        returns a matrix as a numpy array. Much faster and lighter than a list
+        of lists for large matrices.
+
+        :param None focus: a tuple with the (start, end) position of the desired
+           window of data (start, starting at 1, and both start and end are
+           inclusive). Alternatively a chromosome name can be input or a tuple
+           of chromosome name, in order to retrieve a specific inter-chromosomal
+           region
+        :param True diagonal: if False, diagonal is replaced by ones, or zeroes
+           if normalized
+        :param False normalized: get normalized data
+        :param False masked: return masked arrays using the definition of bad
+           columns
+        :param None dtype: numpy type of the array (e.g. numpy.float32 to use
+           half of the memory). By default, the type of the stored values, or
+           float if normalized
+
+        :returns: numpy array (masked if masked)
+        """
         if normalized and not self.bias:
             raise Exception('ERROR: experiment not normalized yet')
         start1, start2, end1, end2 = self._focus_coords(focus)
+        if dtype is None and normalized:
+            dtype = float
+        matrix = self._get_dense(start1, end1, start2, end2, dtype)
         if normalized:
-            if diagonal:
-                matrix = [[self[i, j] / self.bias[i] / self.bias[j]
-                           for i in range(start2, end2)]
-                          for j in range(start1, end1)]
+            # same order of divisions as in: self[i, j] / bias[i] / bias[j]
+            matrix /= self._bias_array(start2, end2, matrix.dtype)[None, :]
+            matrix /= self._bias_array(start1, end1, matrix.dtype)[:, None]
+        if not diagonal and start1 == start2:
+            diag = np.arange(min(matrix.shape))
+            if normalized:
+                matrix[diag, diag] = 0
             else:
-                matrix = [[self[i, j] / self.bias[i] / self.bias[j]
-                           for i in range(start2, end2)]
-                          for j in range(start1, end1)]
-                if start1 == start2:
-                    for i in range(len(matrix)):
-                        matrix[i][i] = 0
-        else:
-            if diagonal:
-                matrix = [[self[i, j] for i in range(start2, end2)]
-                          for j in range(start1, end1)]
-            else:
-                matrix = [[self[i, j] for i in range(start2, end2)]
-                          for j in range(start1, end1)]
-                if start1 == start2:
-                    for i in range(len(matrix)):
-                        matrix[i][i] = 1 if matrix[i][i] else 0
-
+                matrix[diag, diag] = matrix[diag, diag] != 0
         if masked:
-            bads1 = [b - start1 for b in self.bads if start1 <= b < end1]
-            bads2 = [b - start2 for b in self.bads if start2 <= b < end2]
-            m = zeros_like(matrix)
-            for bad1 in bads1:
-                m[:,bad1] = 1
-                for bad2 in bads2:
-                    m[bad2,:] = 1
-            matrix = ma.masked_array(matrix, m)
+            mask = np.zeros(matrix.shape, dtype=bool)
+            mask[[b - start1 for b in self.bads if start1 <= b < end1], :] = True
+            mask[:, [b - start2 for b in self.bads if start2 <= b < end2]] = True
+            matrix = ma.masked_array(matrix, mask)
+        return matrix
+
+    def _bias_array(self, start, end, dtype=float):
+        return np.array([self.bias.get(i, 1.) for i in range(start, end)],
+                        dtype=dtype)
 
+    def _get_dense(self, start1, end1, start2, end2, dtype=None):
+        """
+        :returns: numpy array with the raw interactions of rows start1 to end1
+           (not included) and columns start2 to end2 (not included)
+        """
+        rows, cols, values = self._coo_region(start1, end1, start2, end2)
+        matrix = np.zeros((end1 - start1, end2 - start2),
+                          dtype=values.dtype if dtype is None else dtype)
+        matrix[rows - start1, cols - start2] = values
         return matrix
 
+    def _coo_region(self, start1, end1, start2, end2):
+        """
+        :returns: rows, columns and values of the stored interactions between
+           rows start1 to end1 (not included) and columns start2 to end2 (not
+           included)
+        """
+        size = self.__size
+        ncols = end2 - start2
+        if ncols <= 0 or end1 <= start1:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                    np.zeros(0, dtype=int))
+        # small region: look up each cell
+        if (end1 - start1) * ncols < dict.__len__(self):
+            get = self.get
+            cols = np.arange(start2, end2, dtype=np.int64)
+            step = max(1, _BUFFER_SIZE // ncols)
+            all_rows, all_cols, all_values = [], [], []
+            for beg in range(start1, end1, step):
+                rows = np.arange(beg, min(beg + step, end1), dtype=np.int64)
+                keys = (rows[:, None] * size + cols[None, :]).ravel()
+                values = np.array([get(k, 0) for k in keys.tolist()])
+                nonzero = np.flatnonzero(values)
+                all_rows.append(keys[nonzero] // size)
+                all_cols.append(keys[nonzero] % size)
+                all_values.append(values[nonzero])
+            return (np.concatenate(all_rows), np.concatenate(all_cols),
+                    np.concatenate(all_values))
+        # large region: filter all stored interactions
+        rows, cols, values = self._coo()
+        if not len(values):
+            values = np.zeros(0, dtype=int)
+        keep = (rows >= start1) & (rows < end1) & (cols >= start2) & (cols < end2)
+        return rows[keep], cols[keep], values[keep]
+
     def _focus_coords(self, focus):
         siz = len(self)
         if focus:
@@ -1526,61 +1636,602 @@ class HiC_data(dict):
 
         :yields: matrix line by line (a line being a list of values)
         """
-        siz = len(self)
         if normalized and not self.bias:
             raise Exception('ERROR: experiment not normalized yet')
-        if focus:
-            if isinstance(focus, tuple) and isinstance(focus[0], int):
-                if len(focus) == 2:
-                    start1, end1 = focus
-                    start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-                else:
-                    start1, end1, start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-            elif isinstance(focus, tuple) and isinstance(focus[0], basestring):
-                start1, end1 = self.section_pos[focus[0]]
-                start2, end2 = self.section_pos[focus[1]]
-            else:
-                start1, end1 = self.section_pos[focus]
-                start2, end2 = self.section_pos[focus]
-        else:
-            start1 = start2 = 0
-            end1   = end2   = siz
-        if normalized:
-            for i in range(start2, end2):
-                # if bad column:
-                if i in self.bads:
-                    yield [0.0 for j in range(start1, end1)]
-                # if we want the diagonal, or we don't but are looking at a
-                # region that is not symmetric
-                elif diagonal or start1 != start2:
-                    yield [self[i, j] / self.bias[i] / self.bias[j]
-                           for j in range(start1, end1)]
-                # diagonal replaced by zeroes
-                else:
-                    yield ([self[i, j] / self.bias[i] / self.bias[j]
-                            for j in range(start1, i)] +
-                           [0.0] +
-                           [self[i, j] / self.bias[i] / self.bias[j]
-                            for j in range(i + 1, end1)])
-        else:
-            for i in range(start2, end2):
+        start1, start2, end1, end2 = self._focus_coords(focus)
+        null = 0.0 if normalized else 0
+        # matrix is built by blocks of rows of around one million cells
+        step = max(1, _BUFFER_SIZE // max(1, end1 - start1))
+        for beg in range(start2, end2, step):
+            end = min(beg + step, end2)
+            block = self._get_dense(beg, end, start1, end1,
+                                    float if normalized else None)
+            if normalized:
+                # same order of divisions as in: self[i, j] / bias[i] / bias[j]
+                block /= self._bias_array(beg, end)[:, None]
+                block /= self._bias_array(start1, end1)[None, :]
+            if not diagonal and start1 == start2:
+                diag = np.arange(beg, end)
+                block[diag - beg, diag - start1] = 0
+            for i, row in enumerate(block.tolist(), beg):
                 # if bad column:
                 if i in self.bads:
-                    yield [0 for j in range(start1, end1)]
-                # if we want the diagonal, or we don't but are looking at a
-                # region that is not symmetric
-                elif diagonal or start1 != start2:
-                    yield [self[i, j] for j in range(start1, end1)]
-                # diagonal replaced by zeroes
+                    yield [null] * (end1 - start1)
                 else:
-                    yield ([self[i, j] for j in range(start1, i)] +
-                           [0] +
-                           [self[i, j] for j in range(i + 1, end1)])
+                    yield row
+
+
+class SparseHiC_data(HiC_data):
+    """
+    HiC_data object storing interactions in numpy arrays instead of a
+    dictionary.
+
+    As the matrix is symmetric, only its upper triangle is kept, in Compressed
+    Sparse Row format: columns of row i are ``_indices[_indptr[i]:_indptr[i+1]]``
+    (sorted) and their values ``_data[_indptr[i]:_indptr[i+1]]``. A stored
+    interaction costs 8 bytes with raw counts (12 with floats), instead of the
+    100+ bytes of a dictionary entry.
+
+    Interactions are accessed as in HiC_data (``hic[i, j]``,
+    ``hic.get(i * size + j)``, ``hic.items()``...). Note that setting a value
+    also sets its symmetric (``hic[i, j] = v`` is the same as
+    ``hic[j, i] = v``). New values are buffered and merged in the arrays when
+    the buffer is full or when the whole matrix is read.
+    """
+    def __init__(self, items, size, chromosomes=None, dict_sec=None,
+                 resolution=1, masked=None, symmetricized=False):
+        self._indptr  = np.zeros(size + 1, dtype=np.int64)
+        self._indices = np.zeros(0, dtype=np.int32)
+        self._data    = np.zeros(0, dtype=np.int32)
+        self._buffer  = {}
+        super(SparseHiC_data, self).__init__(
+            (), size, chromosomes=chromosomes, dict_sec=dict_sec,
+            resolution=resolution, masked=masked, symmetricized=symmetricized)
+        self._load_coo(*_items_to_coo(items, size))
+
+    def _symmetricize(self):
+        """
+        Stored matrix is symmetric by construction, only merges buffered
+        values
+        """
+        self._consolidate()
+
+    def _load_coo(self, rows, cols, values):
+        """
+        Replaces stored interactions by the ones given as arrays of rows,
+        columns and values. The stored matrix is made symmetric (see
+        HiC_data._symmetricize).
+        """
+        self._set_coo(*_upper_triangle(rows, cols, values))
+
+    def _update_coo(self, rows, cols, values):
+        """
+        Sets interactions given as arrays of rows, columns and values (same as
+        setting them one by one)
+        """
+        lower = rows > cols
+        rows, cols = np.where(lower, cols, rows), np.where(lower, rows, cols)
+        self._buffer.update(zip(zip(rows.tolist(), cols.tolist()),
+                                values.tolist()))
+        if len(self._buffer) > _BUFFER_SIZE:
+            self._consolidate()
+
+    def _set_coo(self, rows, cols, values):
+        """
+        Replaces stored interactions by the given upper triangle pixels
+        (sorted by row and column)
+        """
+        nonzero = values != 0
+        rows, cols, values = rows[nonzero], cols[nonzero], values[nonzero]
+        counts = np.bincount(rows, minlength=len(self))
+        self._indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self._indptr[1:])
+        self._indices = cols.astype(np.int32)
+        self._data    = _compact_values(values)
+
+    def _consolidate(self):
+        """
+        Merges buffered values into the arrays
+        """
+        if not self._buffer:
+            return
+        new_rows, new_cols = np.array(list(self._buffer.keys()),
+                                      dtype=np.int64).T
+        new_values = np.array(list(self._buffer.values()))
+        self._buffer = {}
+        rows, cols, values = self._coo()
+        rows   = np.concatenate((rows  , new_rows  ))
+        cols   = np.concatenate((cols  , new_cols  ))
+        values = np.concatenate((values, new_values))
+        # lexsort is stable: buffered values come last in case of duplicates
+        order = np.lexsort((cols, rows))
+        rows, cols, values = rows[order], cols[order], values[order]
+        last = np.ones(len(rows), dtype=bool)
+        last[:-1] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        self._set_coo(rows[last], cols[last], values[last])
+
+    def _coo(self):
+        """
+        :returns: rows, columns and values of the stored upper triangle
+        """
+        self._consolidate()
+        rows = np.repeat(np.arange(len(self._indptr) - 1, dtype=np.int64),
+                         np.diff(self._indptr))
+        return rows, self._indices.astype(np.int64), self._data
+
+    def _iter_coo(self, start=0, end=None):
+        """
+        Iterates over the stored upper triangle by blocks of consecutive rows
+        (of around one million interactions).
+
+        :param 0 start: first row
+        :param None end: last row (not included)
+
+        :yields: rows, columns and values of each block
+        """
+        self._consolidate()
+        indptr = self._indptr
+        nrows = len(indptr) - 1
+        end = nrows if end is None else min(end, nrows)
+        while start < end:
+            stop = int(np.searchsorted(indptr, indptr[start] + _BUFFER_SIZE,
+                                       side='right')) - 1
+            stop = min(max(stop, start + 1), end)
+            beg, fin = indptr[start], indptr[stop]
+            rows = np.repeat(np.arange(start, stop, dtype=np.int64),
+                             np.diff(indptr[start:stop + 1]))
+            yield (rows, np.asarray(self._indices[beg:fin], dtype=np.int64),
+                   np.asarray(self._data[beg:fin]))
+            start = stop
+
+    def _coo_region(self, start1, end1, start2, end2):
+        """
+        :returns: rows, columns and values of the stored interactions between
+           rows start1 to end1 (not included) and columns start2 to end2 (not
+           included). Only the rows of the region are read.
+        """
+        all_rows = [np.zeros(0, dtype=np.int64)]
+        all_cols = [np.zeros(0, dtype=np.int64)]
+        all_values = [self._data[:0]]
+        # interactions stored in the upper triangle, and the symmetric of the
+        # ones stored in the lower triangle
+        for beg, end, beg2, end2, mirror in ((start1, end1, start2, end2, False),
+                                             (start2, end2, start1, end1, True)):
+            for rows, cols, values in self._iter_coo(beg, end):
+                keep = (cols >= beg2) & (cols < end2)
+                if mirror:  # diagonal already found
+                    keep &= rows != cols
+                    rows, cols = cols, rows
+                all_rows.append(rows[keep])
+                all_cols.append(cols[keep])
+                all_values.append(values[keep])
+        return (np.concatenate(all_rows), np.concatenate(all_cols),
+                np.concatenate(all_values))
+
+    def _bad_mask(self, bads):
+        size = len(self)
+        mask = np.zeros(max(size, len(self._indptr) - 1), dtype=bool)
+        mask[[b for b in bads if b < size]] = True
+        return mask
+
+    def get(self, key, default=None):
+        size = len(self)
+        row, col = divmod(key, size)
+        if row > col:
+            row, col = col, row
+        if self._buffer:
+            try:
+                return self._buffer[row, col]
+            except KeyError:
+                pass
+        try:
+            beg, end = self._indptr[row], self._indptr[row + 1]
+        except IndexError:
+            return default
+        pos = beg + np.searchsorted(self._indices[beg:end], col)
+        if pos < end and self._indices[pos] == col:
+            return self._data[pos].item()
+        return default
+
+    def __setitem__(self, row_col, val):
+        size = len(self)
+        try:
+            row, col = row_col
+        except TypeError:
+            row, col = divmod(row_col, size)
+        if row * size + col > self._size2:
+            raise IndexError(
+                'ERROR: row or column larger than %s' % size)
+        if row > col:
+            row, col = col, row
+        self._buffer[row, col] = val
+        if len(self._buffer) > _BUFFER_SIZE:
+            self._consolidate()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __iter__(self):
+        return self.keys()
+
+    def items(self):
+        """
+        Iterates over stored interactions (in both halves of the matrix)
+
+        :yields: tuples of position (row * size + column) and value
+        """
+        size = len(self)
+        for rows, cols, values in self._iter_coo():
+            for up, down, val in zip((rows * size + cols).tolist(),
+                                     (cols * size + rows).tolist(),
+                                     values.tolist()):
+                yield up, val
+                if up != down:
+                    yield down, val
+
+    def keys(self):
+        return (k for k, _ in self.items())
+
+    def values(self):
+        return (v for _, v in self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, SparseHiC_data):
+            if len(self) != len(other):
+                return False
+            return all(np.array_equal(a, b)
+                       for a, b in zip(self._coo(), other._coo()))
+        try:
+            return dict(self.items()) == dict((k, v) for k, v in other.items()
+                                              if v)
+        except AttributeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __reduce__(self):
+        self._consolidate()
+        return _new_sparse_hic_data, (self.__class__, ), self.__dict__
+
+    def copy(self):
+        self._consolidate()
+        new = _new_sparse_hic_data(self.__class__)
+        new.__dict__.update(self.__dict__)
+        new._indptr  = np.array(self._indptr)
+        new._indices = np.array(self._indices)
+        new._data    = np.array(self._data)
+        new._buffer  = {}
+        return new
+
+    def get_hic_data_as_csr(self):
+        """
+        Returns a scipy sparse matrix in Compressed Sparse Row format of the
+        Hi-C data
+
+        :returns: scipy sparse matrix in Compressed Sparse Row format
+        """
+        rows, cols, values = self._coo()
+        off = rows != cols
+        size = len(self)
+        return csr_matrix((np.concatenate((values, values[off])).astype(float),
+                           (np.concatenate((rows, cols[off])),
+                            np.concatenate((cols, rows[off])))),
+                          shape=(size, size))
+
+    def sum(self, bias=None, bads=None):
+        """
+        Sum Hi-C data matrix
+        WARNING: parameters are not meant to be used by external users
+
+        :params None bias: expects a dictionary of biases to use normalized matrix
+        :params None bads: extends computed bad columns
+
+        :returns: the sum of the Hi-C matrix skipping bad columns
+        """
+        is_bad = self._bad_mask(bads or self.bads)
+        weights = None
+        if bias:
+            weights = np.array([bias.get(i, 1.) for i in range(len(is_bad))])
+        norm_sum = 0
+        for rows, cols, values in self._iter_coo():
+            keep = ~(is_bad[rows] | is_bad[cols])
+            rows, cols, values = rows[keep], cols[keep], values[keep]
+            # off-diagonal values count twice
+            values = values * np.where(rows == cols, 1, 2)
+            if weights is not None:
+                norm_sum += float((values / (weights[rows] *
+                                             weights[cols])).sum())
+            else:
+                norm_sum += values.sum().item()
+        return norm_sum
+
+
+
+class MmapHiC_data(SparseHiC_data):
+    """
+    SparseHiC_data object with its arrays stored in a folder and
+    memory-mapped. Only the parts of the matrix that are read are paged in
+    memory, which allows to work with genome-wide matrices at high
+    resolution.
+
+    Rows are stored in genomic order, and interactions within a row sorted by
+    column, so the interactions between two chromosomes are found in the
+    rows of the first one, in a contiguous range of columns. Region lookups
+    (e.g. ``get_matrix(focus=...)``, ``yield_matrix``) thus only read the rows
+    of the region, and functions going through the whole matrix (e.g.
+    ``sum``, ``items``) read it block by block.
+
+    The folder contains the CSR arrays (``indptr.bin``, ``indices.bin`` and
+    ``values.bin``) and a pickle with the rest of the attributes
+    (``hic_data.pickle``). Use :func:`load_mmap_hic_data` to open it again.
+
+    Modifications (values, biases, bad columns...) are written to the folder
+    by the ``save`` function. Note that saving new values rewrites the arrays
+    (the object is meant to be read).
+    """
+    def __init__(self, path, items, size, chromosomes=None, dict_sec=None,
+                 resolution=1, masked=None, symmetricized=False):
+        self._path = path
+        self._appending = None
+        mkdir(path)
+        super(MmapHiC_data, self).__init__(
+            items, size, chromosomes=chromosomes, dict_sec=dict_sec,
+            resolution=resolution, masked=masked, symmetricized=symmetricized)
+        self.save()
+
+    def _array_path(self, name):
+        return os.path.join(self._path, name + '.bin')
+
+    def _open_arrays(self, dtype):
+        for name, attr, atype in (('indptr' , '_indptr' , np.int64),
+                                  ('indices', '_indices', np.int32),
+                                  ('values' , '_data'   , dtype)):
+            fnam = self._array_path(name)
+            if os.path.getsize(fnam):
+                setattr(self, attr, np.memmap(fnam, dtype=atype, mode='r'))
+            else:  # empty files cannot be mapped
+                setattr(self, attr, np.zeros(0, dtype=atype))
+
+    def _set_coo(self, rows, cols, values):
+        super(MmapHiC_data, self)._set_coo(rows, cols, values)
+        # write in new files, not to alter the ones currently mapped
+        for name, array in (('indptr' , self._indptr ),
+                            ('indices', self._indices),
+                            ('values' , self._data   )):
+            array.tofile(self._array_path(name) + '_tmp')
+            os.rename(self._array_path(name) + '_tmp', self._array_path(name))
+        self._open_arrays(self._data.dtype)
+
+    def _append_coo(self, rows, cols, values, dtype=np.int32):
+        """
+        Writes interactions of the upper triangle (row <= column) directly to
+        disk, without holding the matrix in memory. Interactions have to be
+        appended by increasing rows: the ones in rows lower than the lowest
+        row appended are written, the others are kept in memory until the
+        next call (in case they are appended again, the last value is kept).
+        Appending ends when the matrix is read.
+
+        :param rows: numpy array of row indexes
+        :param cols: numpy array of column indexes
+        :param values: numpy array of values
+        :param int32 dtype: numpy type of the values stored
+        """
+        if self._appending is None:
+            if len(self._data) or self._buffer:
+                raise Exception('ERROR: can only append to an empty matrix')
+            self._appending = {
+                'handlers': dict((name, open(self._array_path(name) + '_tmp',
+                                             'wb'))
+                                 for name in ('indptr', 'indices', 'values')),
+                'rows'    : 0,
+                'nnz'     : 0,
+                'dtype'   : dtype,
+                'held'    : (np.zeros(0, dtype=np.int64),
+                             np.zeros(0, dtype=np.int64),
+                             np.zeros(0, dtype=dtype))}
+            np.zeros(1, dtype=np.int64).tofile(
+                self._appending['handlers']['indptr'])
+        if not len(rows):
+            return
+        lowest = rows.min()
+        if lowest < self._appending['rows']:
+            raise Exception('ERROR: interactions should be appended by '
+                            'increasing rows')
+        held_rows, held_cols, held_values = self._appending['held']
+        rows   = np.concatenate((held_rows  , rows  ))
+        cols   = np.concatenate((held_cols  , cols  ))
+        values = np.concatenate((held_values, values))
+        order = np.lexsort((cols, rows))
+        rows, cols, values = rows[order], cols[order], values[order]
+        last = np.ones(len(rows), dtype=bool)
+        last[:-1] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        rows, cols, values = rows[last], cols[last], values[last]
+        done = rows < lowest
+        self._write_rows(rows[done], cols[done], values[done], lowest)
+        self._appending['held'] = (rows[~done], cols[~done], values[~done])
+
+    def _write_rows(self, rows, cols, values, end):
+        """
+        Writes interactions of all rows before end (not included)
+        """
+        appending = self._appending
+        nonzero = values != 0
+        rows, cols, values = rows[nonzero], cols[nonzero], values[nonzero]
+        counts = np.bincount(rows - appending['rows'],
+                             minlength=end - appending['rows'])
+        (appending['nnz'] + np.cumsum(counts)).tofile(
+            appending['handlers']['indptr'])
+        cols.astype(np.int32).tofile(appending['handlers']['indices'])
+        values.astype(appending['dtype']).tofile(
+            appending['handlers']['values'])
+        appending['rows'] = end
+        appending['nnz'] += len(values)
+
+    def _end_append(self):
+        """
+        Writes interactions kept in memory and closes files
+        """
+        appending = self._appending
+        rows, cols, values = appending['held']
+        end = max(len(self), (rows[-1] + 1) if len(rows) else 0)
+        self._write_rows(rows, cols, values, end)
+        for name, handler in appending['handlers'].items():
+            handler.close()
+            os.rename(self._array_path(name) + '_tmp', self._array_path(name))
+        self._appending = None
+        self._open_arrays(appending['dtype'])
+
+    def _consolidate(self):
+        if self._appending is not None:
+            self._end_append()
+        super(MmapHiC_data, self)._consolidate()
+
+    def get(self, key, default=None):
+        if self._appending is not None:
+            self._end_append()
+        return super(MmapHiC_data, self).get(key, default)
+
+    def save(self):
+        """
+        Saves modifications (values, biases, bad columns...) to the folder
+        """
+        self._consolidate()
+        state = dict((k, v) for k, v in self.__dict__.items()
+                     if k not in ('_indptr', '_indices', '_data', '_buffer',
+                                  '_appending', '_path'))
+        state['dtype'] = self._data.dtype.str
+        out = open(os.path.join(self._path, 'hic_data.pickle'), 'wb')
+        dump(state, out, HIGHEST_PROTOCOL)
+        out.close()
+
+    def __reduce__(self):
+        self.save()
+        return load_mmap_hic_data, (self._path, )
+
+    def copy(self):
+        """
+        :returns: a copy of the matrix in memory (SparseHiC_data object)
+        """
+        new = super(MmapHiC_data, self).copy()
+        new.__class__ = SparseHiC_data
+        del new._path
+        del new._appending
+        return new
+
 
+def load_mmap_hic_data(path):
+    """
+    Opens a Hi-C data matrix stored on disk (see :class:`MmapHiC_data`)
+
+    :param path: path to the folder of the matrix
+
+    :returns: a MmapHiC_data object
+    """
+    state = load(open(os.path.join(path, 'hic_data.pickle'), 'rb'))
+    hic = _new_sparse_hic_data(MmapHiC_data)
+    dtype = np.dtype(state.pop('dtype'))
+    hic.__dict__.update(state)
+    hic._path = path
+    hic._appending = None
+    hic._buffer = {}
+    hic._open_arrays(dtype)
+    return hic
+
+
+_BUFFER_SIZE = 1000000
+
+
+def _new_sparse_hic_data(cls):
+    return cls.__new__(cls)
+
+
+def _compact_values(values):
+    """
+    Smallest dtype able to store given interaction values (int32 for counts)
+    """
+    if values.dtype.kind in 'biu':
+        info = np.iinfo(np.int32)
+        if not len(values) or (values.min() >= info.min and
+                               values.max() <= info.max):
+            return values.astype(np.int32)
+        return values.astype(np.int64)
+    return values.astype(np.float64)
+
+
+def _items_to_coo(items, size):
+    """
+    :param items: dictionary, or iterable of (position, value) pairs,
+       position being row * size + column
+
+    :returns: rows, columns and values as numpy arrays
+    """
+    if isinstance(items, SparseHiC_data):
+        return items._coo()
+    if hasattr(items, 'items'):
+        items = items.items()
+    items = iter(items)
+    keys = []
+    values = []
+    while True:
+        chunk = list(islice(items, _BUFFER_SIZE))
+        if not chunk:
+            break
+        chunk_keys, chunk_values = zip(*chunk)
+        keys.append(np.array(chunk_keys, dtype=np.int64))
+        values.append(np.array(chunk_values))
+    if not keys:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.int32))
+    rows, cols = np.divmod(np.concatenate(keys), size)
+    return rows, cols, np.concatenate(values)
+
+
+def _is_symmetric(rows, cols, values):
+    """
+    :returns: True if each pixel (i, j) off the diagonal has a (j, i)
+       counterpart with the same value
+    """
+    upper = rows < cols
+    lower = rows > cols
+    if upper.sum() != lower.sum():
+        return False
+    up_rows, up_cols, up_values = rows[upper], cols[upper], values[upper]
+    lo_rows, lo_cols, lo_values = cols[lower], rows[lower], values[lower]
+    up_order = np.lexsort((up_cols, up_rows))
+    lo_order = np.lexsort((lo_cols, lo_rows))
+    return (np.array_equal(up_rows[up_order], lo_rows[lo_order]) and
+            np.array_equal(up_cols[up_order], lo_cols[lo_order]) and
+            np.allclose(up_values[up_order], lo_values[lo_order],
+                        rtol=1e-09, atol=0))
+
+
+def _upper_triangle(rows, cols, values):
+    """
+    Reduces pixels of a matrix to the upper triangle of a symmetric matrix,
+    following the rules of HiC_data._symmetricize: if the matrix holds
+    different values in (i, j) and (j, i) they are summed, otherwise the
+    missing half is copied from the other one.
+
+    :returns: rows, columns and values of the upper triangle (row <= column),
+       sorted by row and column
+    """
+    lower = rows > cols
+    rows, cols = np.where(lower, cols, rows), np.where(lower, rows, cols)
+    order = np.lexsort((cols, rows))
+    rows, cols, values = rows[order], cols[order], values[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    if first.all():
+        return rows, cols, values
+    second = np.flatnonzero(~first)
+    if np.allclose(values[second], values[second - 1], rtol=1e-09, atol=0):
+        return rows[first], cols[first], values[first]
+    return (rows[first], cols[first],
+            np.add.reduceat(values, np.flatnonzero(first)))
 
 def _hmm_refine_compartments(xsec, models, bads, verbose):
     prevll = float('-inf')
@@ -1,13 +1,20 @@
 from __future__ import print_function
-from itertools                    import combinations
-from os                           import path, system
+from itertools                    import combinations, islice
+from random                       import getrandbits
+from os                           import path, system, remove
+from shutil                       import copyfileobj
 from sys                          import stdout
 from collections                  import OrderedDict
-from multiprocessing              import cpu_count
+from multiprocessing              import cpu_count, Pool
 from distutils.version            import LooseVersion
 from subprocess                   import Popen, PIPE
+import heapq
+
+import numpy as np
 
 from pytadbit.utils.file_handling import mkdir, magic_open, which
+from pytadbit.parsers.pairs_parser import PairsWriter, PAIRS_COLUMNS
+from pytadbit.parsers.pairs_parser import lines_to_columns
 
 
 def eq_reads(rd1, rd2):
@@ -127,7 +134,8 @@ def merge_bams(bam1, bam2, output_bam, cpus = cpu_count(), samtools = 'samtools'
         system(samtools  + ' index %s' % (output_bam))
 
 
-def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
+def get_intersection(fname1, fname2, out_path, verbose=False, compress=False,
+                     pairs=False, ncpus=1, max_memory=1000):
     """
     Merges the two files corresponding to each reads sides. Reads found in both
        files are merged and written in an output file.
@@ -150,6 +158,13 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
        the inputs
     :param False compress: compress (gzip) input files. This is done in the
        background while next input files are parsed.
+    :param False pairs: write output in TADbit binary pairs format (see
+       :class:`pytadbit.parsers.pairs_parser.PairsWriter`) instead of 2D-bed
+    :param 1 ncpus: number of CPUs used to sort pairs of reads. Pairs are
+       sorted by runs, in parallel, and runs are merged into the output file
+       (external merge sort)
+    :param 1000 max_memory: memory (in Mb) available to buffer pairs of reads
+       before sorting them, and to merge the sorted runs
 
     :returns: final number of pair of interacting fragments, and a dictionary with
        the number of multiple contacts (keys of the dictionary being the number of
@@ -177,28 +192,29 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
     if header1 != header2:
         raise Exception('seems to be mapped onover different chromosomes\n')
 
-    # prepare to write read pairs into different files
-    # depending on genomic position
-    nchunks = 1024
+    # cumulative start of each chromosome, to put the most upstream read first
     global CHROM_START
     CHROM_START = {}
+    chromosomes = OrderedDict()
     cum_pos = 0
     for line in header1.split('\n'):
         if line.startswith('# CRM'):
             _, _, crm, pos = line.split()
             CHROM_START[crm] = cum_pos
+            chromosomes[crm] = int(pos)
             cum_pos += int(pos)
-    lchunk = cum_pos // nchunks
-    buf = dict([(i, []) for i in range(nchunks + 1)])
-    # prepare temporary directories
-    tmp_dir = out_path + '_tmp_files'
+    crm_ids = dict((crm, i) for i, crm in enumerate(chromosomes))
+
+    # pairs of reads are buffered, and each buffer is sorted by genomic
+    # coordinate (in parallel) into a run of binary records
+    tmp_dir = '%s_tmp_%016x' % (out_path, getrandbits(64))
     mkdir(tmp_dir)
-    for i in range(nchunks // int(nchunks**0.5) + 1):
-        mkdir(path.join(tmp_dir, 'rep_%03d' % i))
+    run_size = max(1000, int(max_memory * 2**20 / _PAIR_MEMORY) // (2 * ncpus + 1))
+    pool = Pool(ncpus)
+    procs = []
+    buf = []
 
     # iterate over reads in each of the two input files
-    # and store them into a dictionary and then into temporary files
-    # dicitonary ois emptied each 1 milion entries
     if verbose:
         print ('Getting intersection of reads 1 and reads 2:')
     count = 0
@@ -217,12 +233,15 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
                     stdout.write('.')
                     stdout.flush()
                 count_dots += 1
-            for _ in range(1000000): # iterate 1 million times, write to files
+            for _ in range(1000000):
                 # same read id in both lianes, we store put the more upstream
                 # before and store them
                 if eq_reads(read1, read2):
                     count += 1
-                    _process_lines(line1, line2, buf, multiples, lchunk)
+                    _process_lines(line1, line2, buf, multiples)
+                    if len(buf) >= run_size:
+                        _submit_run(pool, procs, buf, crm_ids, tmp_dir, ncpus)
+                        buf = []
                     line1 = next(reads1)
                     read1 = line1.split('\t', 1)[0]
                     line2 = next(reads2)
@@ -234,11 +253,12 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
                 else:
                     line1 = next(reads1)
                     read1 = line1.split('\t', 1)[0]
-            write_to_files(buf, tmp_dir, nchunks)
     except StopIteration:
         reads1.close()
         reads2.close()
-    write_to_files(buf, tmp_dir, nchunks)
+    if buf:
+        _submit_run(pool, procs, buf, crm_ids, tmp_dir, ncpus)
+    del buf
     if verbose:
         print('\nFound %d pair of reads mapping uniquely' % count)
 
@@ -246,29 +266,41 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
     if compress:
         if verbose:
             print('compressing input files')
-        procs = [Popen(['gzip', f]) for f in (fname1, fname2)]
-    # sort each tmp file according to first element (idx) and write them
-    # to output file (without the idx)
-    # sort also according to read 2 (to filter duplicates)
-    #      and also according to strand
-    if verbose:
-        print('Sorting each temporary file by genomic coordinate')
+        procs_gz = [Popen(['gzip', f]) for f in (fname1, fname2)]
+    pool.close()
+    pool.join()
+    runs = [proc.get() for proc in procs]
 
-    out = open(out_path, 'w')
-    out.write(header1)
-    for b in buf:
-        if verbose:
-            stdout.write('\r    %4d/%d sorted files' % (b + 1, len(buf)))
-            stdout.flush()
-        with open(path.join(tmp_dir, 'rep_%03d' % (b // int(nchunks**0.5)),
-                            'tmp_%05d.tsv' % b)) as f_tmp:
-            out.write(''.join(['\t'.join(l[1:]) for l in sorted(
-                [l.split('\t') for l in f_tmp],
-                key=lambda x: (x[0], x[8], x[9], x[6]))]))
+    # merge sorted runs (by genomic coordinate, then by position of read 2 and
+    # RE fragment of read 1, to filter duplicates) into the output file
+    if verbose:
+        print('Merging %d sorted runs by genomic coordinate' % len(runs))
+    merged, chunk_size = _merge_runs(runs, tmp_dir, max_memory)
+    if pairs:
+        out = PairsWriter(out_path, chromosomes)
+        while True:
+            chunk = list(islice(merged, chunk_size))
+            if not chunk:
+                break
+            records = np.array([rec for _, rec, _ in chunk], dtype=_RUN_DTYPE)
+            out.write([name for _, _, name in chunk],
+                      dict((k, records[k]) for k in PAIRS_COLUMNS))
+    else:
+        crms = list(chromosomes)
+        out = open(out_path, 'w')
+        out.write(header1)
+        while True:
+            chunk = list(islice(merged, chunk_size))
+            if not chunk:
+                break
+            out.write(''.join([
+                '%s\t%s\t%d\t%d\t%d\t%d\t%d\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
+                    (name, crms[rec[0]]) + rec[1:6] + (crms[rec[6]], ) + rec[7:12])
+                for _, rec, name in chunk]))
     out.close()
 
     if compress:
-        for proc in procs:
+        for proc in procs_gz:
             proc.communicate()
         system('rm -rf ' + fname1)
         system('rm -rf ' + fname2)
@@ -278,6 +310,129 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
     return count, multiples
 
 
+# record of a pair of reads in the sorted runs of get_intersection (with the
+# order of the pair in the input, and the length of its read ID)
+_RUN_DTYPE = np.dtype(list(PAIRS_COLUMNS.items()) +
+                      [('seq', '<i8'), ('nlen', '<i4')])
+# approximate memory used by a buffered pair of reads (tuple of strings)
+_PAIR_MEMORY = 1024
+# maximum number of runs merged at once (open files and read buffers)
+_MAX_MERGE_RUNS = 64
+
+
+def _submit_run(pool, procs, buf, crm_ids, tmp_dir, ncpus):
+    # limit the number of runs waiting in memory
+    if len(procs) >= 2 * ncpus:
+        procs[-2 * ncpus].wait()
+    procs.append(pool.apply_async(_sort_run, args=(
+        buf, crm_ids, path.join(tmp_dir, 'run_%05d.bin' % len(procs)),
+        len(procs) << 32)))
+
+
+def _sort_run(buf, crm_ids, fname, first):
+    """
+    Sorts a list of pairs of reads by genomic coordinate, and writes them as
+    binary records followed by their read IDs.
+
+    :param first: order of the first pair of reads of the list in the input
+       (ties are kept in input order)
+
+    :returns: the path to the run and its number of records
+    """
+    names, columns = lines_to_columns(buf, crm_ids)
+    del buf
+    run = np.empty(len(names), dtype=_RUN_DTYPE)
+    for k in PAIRS_COLUMNS:
+        run[k] = columns[k]
+    run['seq'] = first + np.arange(len(names))
+    order = np.lexsort((run['seq'], run['rs1'], run['pos2'], run['chrom2'],
+                        run['pos1'], run['chrom1']))
+    run = run[order]
+    names = [names[i].encode() for i in order]
+    run['nlen'] = [len(name) for name in names]
+    with open(fname, 'wb') as out:
+        out.write(run.tobytes())
+        out.write(b''.join(names))
+    return fname, len(run)
+
+
+def _merge_runs(runs, tmp_dir, max_memory, max_runs=_MAX_MERGE_RUNS):
+    """
+    Merges sorted runs (written by _sort_run) within max_memory (in Mb). Half
+    of the memory is shared by the read buffers of the runs merged, the other
+    half is left to buffer the merged records. If there are more than
+    max_runs runs, they are first merged by groups of max_runs into
+    intermediate runs, as many times as needed.
+
+    :returns: an iterator over the merged records (see _iter_run), and the
+       number of merged records to buffer at once
+    """
+    nrecords = max(2, int(max_memory * 2**20 / _PAIR_MEMORY))
+    npass = 0
+    while len(runs) > max_runs:
+        merged = []
+        for i in range(0, len(runs), max_runs):
+            group = runs[i:i + max_runs]
+            merged.append(_write_run(
+                _merge_group(group, nrecords),
+                path.join(tmp_dir, 'merge_%d_%05d.bin' % (npass, i)),
+                nrecords // 2))
+            for fname, _ in group:
+                remove(fname)
+        runs = merged
+        npass += 1
+    return _merge_group(runs, nrecords), nrecords // 2
+
+
+def _merge_group(runs, nrecords):
+    chunk = max(1, nrecords // (2 * len(runs)))
+    return heapq.merge(*[_iter_run(fname, nrec, chunk) for fname, nrec in runs])
+
+
+def _write_run(merged, fname, chunk):
+    """
+    Writes merged records in the format of _sort_run (binary records followed
+    by their read IDs).
+
+    :returns: the path to the run and its number of records
+    """
+    count = 0
+    with open(fname, 'wb') as out, open(fname + '_names', 'w+b') as names:
+        while True:
+            records = list(islice(merged, chunk))
+            if not records:
+                break
+            out.write(np.array([rec for _, rec, _ in records],
+                               dtype=_RUN_DTYPE).tobytes())
+            names.write(''.join([name for _, _, name in records]).encode())
+            count += len(records)
+        names.seek(0)
+        copyfileobj(names, out)
+    remove(fname + '_names')
+    return fname, count
+
+
+def _iter_run(fname, nrecords, chunk=100000):
+    """
+    Iterates over the records of a run written by _sort_run.
+
+    :yields: sorting key, record (as a tuple) and read ID
+    """
+    with open(fname, 'rb') as fh:
+        names_pos = nrecords * _RUN_DTYPE.itemsize
+        for start in range(0, nrecords, chunk):
+            fh.seek(start * _RUN_DTYPE.itemsize)
+            run = np.fromfile(fh, dtype=_RUN_DTYPE,
+                              count=min(chunk, nrecords - start))
+            fh.seek(names_pos)
+            names = fh.read(int(run['nlen'].sum())).decode()
+            names_pos = fh.tell()
+            ends = np.cumsum(run['nlen']).tolist()
+            for rec, beg, end in zip(run.tolist(), [0] + ends, ends):
+                yield ((rec[0], rec[1], rec[6], rec[7], rec[4], rec[12]),
+                       rec, names[beg:end])
+
+
 def _loc_reads(r1, r2):
     """
     Put upstream read before, get position in buf
@@ -290,18 +445,7 @@ def _loc_reads(r1, r2):
     return r1, r2, pos1
 
 
-def write_to_files(buf, tmp_dir, nchunks):
-    for b in buf:
-        out = open(path.join(tmp_dir, 'rep_%03d' % (b // int(nchunks**0.5)),
-                             'tmp_%05d.tsv' % b), 'a')
-        out.write('\n'.join(buf[b]))
-        if buf[b]: # case the file was empty
-            out.write('\n')
-        out.close()
-        del(buf[b][:])
-
-
-def _process_lines(line1, line2, buf, multiples, lchunk):
+def _process_lines(line1, line2, buf, multiples):
     # case we have potential multicontacts
     if '|||' in line1 or '|||' in line2:
         elts = {}
@@ -355,16 +499,15 @@ def _process_lines(line1, line2, buf, multiples, lchunk):
             multiples[contacts] += 1
             prod_cont = contacts * (contacts + 1) // 2
             for i, (r1, r2) in enumerate(combinations(list(elts.values()), 2)):
-                r1, r2, idx = _loc_reads(r1, r2)
-                buf[idx // lchunk].append('%d\t%s#%d/%d\t%s\t%s' % (
-                    idx, r1[0], i + 1, prod_cont, '\t'.join(r1[1:]),
-                    '\t'.join(r2[1:])))
+                r1, r2, _ = _loc_reads(r1, r2)
+                buf.append(('%s#%d/%d' % (r1[0], i + 1, prod_cont), ) +
+                           tuple(r1[1:]) + tuple(r2[1:]))
         elif contacts == 1:
-            r1, r2, idx = _loc_reads(list(elts.values())[0], list(elts.values())[1])
-            buf[idx // lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
+            r1, r2, _ = _loc_reads(list(elts.values())[0], list(elts.values())[1])
+            buf.append(tuple(r1) + tuple(r2[1:]))
         else:
-            r1, r2, idx = _loc_reads(list(elts1.values())[0], list(elts2.values())[0])
-            buf[idx // lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
+            r1, r2, _ = _loc_reads(list(elts1.values())[0], list(elts2.values())[0])
+            buf.append(tuple(r1) + tuple(r2[1:]))
     else:
-        r1, r2, idx = _loc_reads(line1.strip().split('\t'), line2.strip().split('\t'))
-        buf[idx // lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
+        r1, r2, _ = _loc_reads(line1.strip().split('\t'), line2.strip().split('\t'))
+        buf.append(tuple(r1) + tuple(r2[1:]))
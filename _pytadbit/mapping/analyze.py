@@ -29,6 +29,7 @@ from pytadbit.utils.tadmaths      import right_double_mad as mad
 from pytadbit.parsers.hic_parser  import load_hic_data_from_reads
 from pytadbit.utils.extraviews    import nicer
 from pytadbit.utils.file_handling import mkdir
+from pytadbit.parsers.pairs_parser import is_pairs, iter_pairs
 
 try:
     basestring
@@ -711,30 +712,42 @@ def fragment_size(fnam, savefig=None, nreads=None, max_size=99.9, axe=None,
 
     :returns: the median value and the percentile inputed as max_size.
     """
-    distr = {}
-    genome_seq = OrderedDict()
-    pos = 0
-    fhandler = open(fnam)
-    for line in fhandler:
-        if line.startswith('#'):
-            if line.startswith('# CRM '):
-                crm, clen = line[6:].split('\t')
-                genome_seq[crm] = int(clen)
-        else:
-            break
-        pos += len(line)
-    fhandler.seek(pos)
-    des = []
-    for line in fhandler:
-        (crm1, pos1, dir1, _, re1, _,
-         crm2, pos2, dir2, _, re2) = line.strip().split('\t')[1:12]
-        if re1 == re2 and crm1 == crm2 and dir1 == '1' and dir2 == '0':
-            pos1, pos2 = int(pos1), int(pos2)
-            des.append(pos2 - pos1)
-            if len(des) == nreads:
+    if is_pairs(fnam):
+        des = []
+        for _, cols in iter_pairs(fnam, names=False, columns=(
+                'chrom1', 'pos1', 'strand1', 'rs1',
+                'chrom2', 'pos2', 'strand2', 'rs2')):
+            dangling = ((cols['rs1'] == cols['rs2']) &
+                        (cols['chrom1'] == cols['chrom2']) &
+                        (cols['strand1'] == 1) & (cols['strand2'] == 0))
+            des.extend((cols['pos2'][dangling] - cols['pos1'][dangling]).tolist())
+            if nreads and len(des) >= nreads:
+                des = des[:nreads]
+                break
+    else:
+        genome_seq = OrderedDict()
+        pos = 0
+        fhandler = open(fnam)
+        for line in fhandler:
+            if line.startswith('#'):
+                if line.startswith('# CRM '):
+                    crm, clen = line[6:].split('\t')
+                    genome_seq[crm] = int(clen)
+            else:
                 break
+            pos += len(line)
+        fhandler.seek(pos)
+        des = []
+        for line in fhandler:
+            (crm1, pos1, dir1, _, re1, _,
+             crm2, pos2, dir2, _, re2) = line.strip().split('\t')[1:12]
+            if re1 == re2 and crm1 == crm2 and dir1 == '1' and dir2 == '0':
+                pos1, pos2 = int(pos1), int(pos2)
+                des.append(pos2 - pos1)
+                if len(des) == nreads:
+                    break
+        fhandler.close()
     des = [i for i in des if i <= too_large]
-    fhandler.close()
     if not des:
         raise Exception('ERROR: no dangling-ends found in %s' % (fnam))
     max_perc = np.percentile(des, max_size)
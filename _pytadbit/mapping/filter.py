@@ -5,9 +5,21 @@
 """
 from __future__ import print_function
 from builtins   import next
+from random     import getrandbits
+from itertools  import islice
+from shutil     import copyfileobj
+import os
 import multiprocessing as mu
 
+import numpy as np
+from numpy.lib.format import open_memmap
+
 from pytadbit.mapping.restriction_enzymes import count_re_fragments
+from pytadbit.parsers.pairs_parser        import is_pairs, iter_pairs
+from pytadbit.parsers.pairs_parser        import read_pairs_index, PairsWriter
+from pytadbit.parsers.pairs_parser        import PAIRS_COLUMNS
+from pytadbit.utils.file_handling         import mkdir
+from pytadbit.utils.tadmaths              import library_complexity
 
 
 MASKED = {1 : {'name': 'self-circle'       , 'reads': 0},
@@ -29,7 +41,8 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
     Create a new file with reads filtered
 
     :param fnam: input file path, where non-filtered read are stored
-    :param outfile: output file path, where filtered read will be stored
+    :param outfile: output file path, where filtered read will be stored (in
+       TADbit binary pairs format if input file is also in this format)
     :param masked: dictionary given by the
        :func:`pytadbit.mapping.filter.filter_reads`
     :param None filters: list of numbers corresponding to the filters we want
@@ -38,9 +51,20 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
        reads filtered, not the valid pairs.
     :param False verbose:
 
+    If the filters were computed with the fast version of
+    :func:`pytadbit.mapping.filter.filter_reads`, pairs are selected with the
+    bitmask of filters instead of the lists of read IDs.
+
     :returns: number of reads kept
     """
     filters = filters or list(masked.keys())
+    bitmask = filter_bitmask(masked, filters)
+    if bitmask:
+        count = _apply_filter_bitmask(fnam, outfile, bitmask, filters, reverse)
+        if verbose:
+            print('    saving to file {:,} {} reads.'.format(
+                count, 'filtered' if reverse else 'valid'))
+        return count
     filter_handlers = {}
     for k in filters:
         try:
@@ -50,6 +74,13 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
         except StopIteration:
             pass
 
+    if is_pairs(fnam):
+        count = _apply_filter_pairs(fnam, outfile, filter_handlers, reverse)
+        if verbose:
+            print('    saving to file {:,} {} reads.'.format(
+                count, 'filtered' if reverse else 'valid'))
+        return count
+
     out = open(outfile, 'w')
     fhandler = open(fnam)
     # get the header
@@ -107,11 +138,122 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
     return count
 
 
+def filter_bitmask(masked, filters=None):
+    """
+    :param masked: dictionary given by the
+       :func:`pytadbit.mapping.filter.filter_reads`
+    :param None filters: list of numbers corresponding to the filters we want
+       to apply
+
+    :returns: path to the bitmask of filters if it is available for all the
+       given filters, None otherwise
+    """
+    filters = list(masked.keys()) if filters is None else filters
+    bitmasks = set(masked[k].get('bitmask') for k in filters)
+    if len(bitmasks) != 1:
+        return None
+    bitmask = bitmasks.pop()
+    if bitmask and os.path.exists(bitmask):
+        return bitmask
+    return None
+
+
+def _apply_filter_bitmask(fnam, outfile, bitmask, filters, reverse,
+                          chunk_size=1000000):
+    """
+    Writes the pairs of reads that are (or are not, if reverse) caught by
+    any of the filters, using the bitmask of filters (aligned with the pairs
+    of the input file).
+    """
+    bits = 0
+    for k in filters:
+        bits |= 1 << (k - 1)
+    flags = np.load(bitmask, mmap_mode='r')
+    pos = 0
+    if is_pairs(fnam):
+        index = read_pairs_index(fnam)
+        if index['count'] != len(flags):
+            raise Exception('ERROR: bitmask of filters does not match %s' % (
+                fnam))
+        out = PairsWriter(outfile, index['chromosomes'])
+        for reads, cols in iter_pairs(fnam):
+            keep = (flags[pos:pos + len(reads)] & bits) != 0
+            if not reverse:
+                keep = ~keep
+            idx = np.flatnonzero(keep)
+            out.write([reads[i] for i in idx],
+                      dict((k, cols[k][idx]) for k in cols))
+            pos += len(reads)
+        out.close()
+        return out.count
+    count = 0
+    out = open(outfile, 'w')
+    fhandler = open(fnam)
+    line = next(fhandler)
+    while line.startswith('#'):
+        out.write(line)
+        line = next(fhandler)
+    lines = [line]
+    while True:
+        lines.extend(islice(fhandler, chunk_size - len(lines)))
+        if not lines:
+            break
+        if pos + len(lines) > len(flags):
+            raise Exception('ERROR: bitmask of filters does not match %s' % (
+                fnam))
+        keep = (flags[pos:pos + len(lines)] & bits) != 0
+        if not reverse:
+            keep = ~keep
+        idx = np.flatnonzero(keep)
+        out.write(''.join(lines[i] for i in idx))
+        count += len(idx)
+        pos += len(lines)
+        lines = []
+    out.close()
+    fhandler.close()
+    if pos != len(flags):
+        raise Exception('ERROR: bitmask of filters does not match %s' % (
+            fnam))
+    return count
+
+
+def _apply_filter_pairs(fnam, outfile, filter_handlers, reverse):
+    """
+    Writes the pairs of a TADbit binary pairs file that are (or are not, if
+    reverse) listed in the filter files.
+    """
+    current = set([v for v, _ in list(filter_handlers.values())])
+    out = PairsWriter(outfile, read_pairs_index(fnam)['chromosomes'])
+    for reads, cols in iter_pairs(fnam):
+        keep = np.zeros(len(reads), dtype=bool)
+        for i, read in enumerate(reads):
+            if read not in current:
+                continue
+            keep[i] = True
+            # iterate over different filters to update current filters
+            for k in list(filter_handlers.keys()):
+                if read != filter_handlers[k][0]:
+                    continue
+                try: # get next line from filter file
+                    filter_handlers[k][0] = next(filter_handlers[k][1]).strip()
+                except StopIteration:
+                    filter_handlers[k][1].close()
+                    del filter_handlers[k]
+            current = set([v for v, _ in list(filter_handlers.values())])
+        if not reverse:
+            keep = ~keep
+        idx = np.flatnonzero(keep)
+        out.write([reads[i] for i in idx],
+                  dict((k, cols[k][idx]) for k in cols))
+    out.close()
+    return out.count
+
+
 def filter_reads(fnam, output=None, max_molecule_length=500,
                  over_represented=0.005, max_frag_size=100000,
                  min_frag_size=100, re_proximity=5, verbose=True,
                  savedata=None, min_dist_to_re=750, strict_duplicates=False,
-                 fast=True):
+                 fast=True, ncpus=4, max_memory=1000):
     """
     Filter mapped pair of reads in order to remove experimental artifacts (e.g.
     dangling-ends, self-circle, PCR artifacts...)
@@ -138,13 +280,16 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
           detected restriction fragments, they may be prone to PCR artifacts or
           represent fragile regions of the genome or genome assembly errors
        9- duplicated         : the combination of the start positions of the
-          reads is repeated -> PCR artifact (only keep one copy)
+          reads is repeated -> PCR artifact (only keep one copy). Pairs of
+          reads are hashed by coordinates, and duplicates are found wherever
+          they are in the file.
        10- random breaks     : start position of one of the read is too far (
           more than min_dist_to_re) from RE cutting site. Non-canonical
           enzyme activity or random physical breakage of the chromatin.
 
-    :param fnam: path to file containing the pair of reads in tsv format, file
-       generated by :func:`pytadbit.mapping.mapper.get_intersection`
+    :param fnam: path to file containing the pair of reads in tsv format (or
+       in TADbit binary pairs format), file generated by
+       :func:`pytadbit.mapping.mapper.get_intersection`
     :param None output: PATH where to write files containing IDs of filtered
        reads. Uses fnam by default.
     :param 500 max_molecule_length: facing reads that are within
@@ -161,14 +306,24 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
        from a RE site (usually 1.5 times the insert size). Applied in filter 10
     :param None savedata: PATH where to write the number of reads retained by
        each filter
-    :param True fast: parallel version, requires 4 CPUs and more RAM memory
+    :param True fast: single-pass version, all filters are evaluated at once
+       on each pair of reads (the file is split in ncpus ranges processed in
+       parallel). Also writes a bitmask of filters for each pair of reads (in
+       the same order as in the input file) in output + '_filters.npy', with
+       bit k - 1 set if the pair is caught by filter k.
+    :param 4 ncpus: number of CPUs used by the fast version
+    :param 1000 max_memory: memory (in Mb) available to find duplicates.
+       Pairs of reads are hashed into on-disk buckets small enough to be
+       sorted within this limit.
     :param False strict_duplicates: by default reads are considered duplicates if
        they coincide in genomic coordinates and strand; with strict_duplicates
        enabled, we also ask to consider read length (WARNING: this option is
        called strict, but it is more permissive).
 
     :return: dictionary with, as keys, the kind of filter applied, and as values
-       a set of read IDs to be removed
+       a set of read IDs to be removed. The estimated library complexity
+       (number of unique molecules) is stored under the 'complexity' key of
+       the duplicates filter (9).
 
     *Note: Filtering is not exclusive, one read can be filtered several times.*
     """
@@ -184,7 +339,7 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
     if not fast: # mainly for debugging
         if verbose:
             print('filtering duplicates')
-        sub_mask, total = _filter_duplicates(fnam, output)
+        sub_mask, total = _filter_duplicates(fnam, output, max_memory)
         MASKED.update(sub_mask)
         if verbose:
             print('filtering same fragments')
@@ -197,23 +352,13 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
             print('filtering over represented')
         MASKED.update(_filter_over_represented(fnam, over_represented, output))
     else:
-        pool = mu.Pool(4)
-        a = pool.apply_async(_filter_same_frag,
-                             args=(fnam, max_molecule_length, output))
-        b = pool.apply_async(_filter_from_res,
-                             args=(fnam, max_frag_size, min_dist_to_re,
-                                   re_proximity, min_frag_size, output))
-        c = pool.apply_async(_filter_over_represented,
-                             args=(fnam, over_represented, output))
-        d = pool.apply_async(_filter_duplicates,
-                             args=(fnam, output))
-        pool.close()
-        pool.join()
-        sub_mask, total = d.get()
+        sub_mask, total = _filter_fused(
+            fnam, output, max_molecule_length, over_represented,
+            max_frag_size, min_frag_size, re_proximity, min_dist_to_re,
+            strict_duplicates, ncpus, max_memory)
         MASKED.update(sub_mask)
-        MASKED.update(b.get())
-        MASKED.update(c.get())
-        MASKED.update(a.get())
+    MASKED[9]['complexity'] = library_complexity(total,
+                                                 total - MASKED[9]['reads'])
 
     # if savedata or verbose:
     #     bads = len(frozenset().union(*[masked[k]['reads'] for k in masked]))
@@ -222,6 +367,7 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
         out.write('Mapped both\t%d\n' % total)
         for k in range(1, len(MASKED) + 1):
             out.write('%s\t%d\n' % (MASKED[k]['name'], MASKED[k]['reads']))
+        out.write('Library complexity\t%.0f\n' % MASKED[9]['complexity'])
         # out.write('Valid pairs\t%d\n' % (total - bads))
         out.close()
     if verbose:
@@ -232,10 +378,544 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
             print('  {:2}- {:>25} : {:12,} ({:6.2f}%)'.format(
                 k, MASKED[k]['name'], MASKED[k]['reads'],
                 float(MASKED[k]['reads']) / total * 100))
+        print('\n  Estimated library complexity : {:,.0f} unique molecules'.format(
+            MASKED[9]['complexity']))
     return MASKED
 
 
+FUSED_FILTERS = (1, 2, 3, 4, 5, 6, 7, 8, 9, 10)
+
+# coordinates defining a duplicated pair of reads (read lengths only used
+# with strict duplicates), and the row of the pair of reads in the input file
+DUP_COLUMNS = ('chrom1', 'pos1', 'strand1', 'chrom2', 'pos2', 'strand2',
+               'len1', 'len2')
+DUP_DTYPE = np.dtype([(k, PAIRS_COLUMNS[k]) for k in DUP_COLUMNS] +
+                     [('row', '<i8')])
+# rows are stored as (index of range << 40) + row in the range
+_ROW_BITS = 40
+
+
+def _filter_fused(fnam, output, max_molecule_length, over_represented,
+                  max_frag_size, min_frag_size, re_proximity, min_dist_to_re,
+                  strict_duplicates, ncpus, max_memory=1000):
+    """
+    Evaluates all filters in a single pass over the pairs of reads. The input
+    file (2D-bed or binary pairs) is split in sorted ranges processed in
+    parallel, after a pre-pass counting reads per RE fragment (needed to find
+    over-represented fragments) and hashing pairs of reads in buckets (needed
+    to find duplicates).
+
+    :returns: the masked dictionary (with the path to the list of reads
+       caught by each filter, and to the bitmask of filters) and the total
+       number of pairs of reads
+    """
+    masked = dict((k, {'name': MASKED[k]['name'], 'reads': 0})
+                  for k in FUSED_FILTERS)
+    pairs = is_pairs(fnam)
+    ranges = (_pairs_ranges if pairs else _text_ranges)(fnam, ncpus)
+    tmpdir = '%s_tmp_filters_%016x' % (output, getrandbits(64))
+    mkdir(tmpdir)
+    pool = mu.Pool(ncpus) if ncpus > 1 and len(ranges) > 1 else None
+
+    # pre-pass: count reads per RE fragment and find duplicates
+    counts, nbuckets = _hash_duplicates(fnam, pairs, ranges, tmpdir,
+                                        strict_duplicates, max_memory, pool,
+                                        ncpus, count_frags=True)
+    nrows = [c[-1] for c in counts]
+    if pairs:
+        frags = np.concatenate([c[0] for c in counts])
+        frags, idx = np.unique(frags, return_inverse=True)
+        count = np.bincount(idx, weights=np.concatenate([c[1] for c in counts]))
+    else:
+        frag_count = counts[0][0]
+        for other in counts[1:]:
+            for frag, val in other[0].items():
+                frag_count[frag] = frag_count.get(frag, 0) + val
+        frags = list(frag_count.keys())
+        count = np.array([frag_count[f] for f in frags])
+    del counts
+    num_frags = len(count)
+    cut = int((1 - over_represented) * num_frags + 0.5)
+    # use cut-1 because it represents the length of the list
+    cut = np.sort(count)[cut - 1] if num_frags else 0
+    if pairs:
+        over = frags[count > cut]
+    else:
+        over = set(f for f, c in zip(frags, count) if c > cut)
+    del frags, count
+
+    # main pass
+    params = (max_molecule_length, max_frag_size, min_frag_size, re_proximity,
+              min_dist_to_re)
+    results = _map_pool(pool, _filter_pairs_range if pairs else _filter_text_range,
+                        [(fnam, rng, params, over, tmpdir, i, nbuckets, nrows[i])
+                         for i, rng in enumerate(ranges)])
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # merge results of each range, in order
+    bitmask_fnam = output + '_filters.npy'
+    total = sum(res[1] for res in results)
+    bitmask = open_memmap(bitmask_fnam, mode='w+', dtype=np.uint16,
+                          shape=(total,))
+    pos = 0
+    for _, num, fname in results:
+        if num:
+            bitmask[pos:pos + num] = np.load(fname)
+        os.remove(fname)
+        pos += num
+    del bitmask
+    for k in masked:
+        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
+        masked[k]['bitmask'] = bitmask_fnam
+        masked[k]['reads'] = sum(res[0][k] for res in results)
+        with open(masked[k]['fnam'], 'w') as out:
+            for i in range(len(ranges)):
+                fname = os.path.join(tmpdir, '%d_%d.tsv' % (i, k))
+                with open(fname) as fh:
+                    copyfileobj(fh, out)
+                os.remove(fname)
+    os.rmdir(tmpdir)
+    return masked, total
+
+
+def _map_pool(pool, func, args):
+    if pool is None:
+        return [func(*arg) for arg in args]
+    procs = [pool.apply_async(func, args=arg) for arg in args]
+    return [proc.get() for proc in procs]
+
+
+def _text_ranges(fnam, nchunks):
+    """
+    Splits a 2D-bed file in ranges of lines of similar size.
+
+    :returns: list of (start, end) with byte offsets of the first and after
+       the last line of each range
+    """
+    with open(fnam, 'rb') as fh:
+        line = fh.readline()
+        while line.startswith(b'#'):
+            line = fh.readline()
+        first = fh.tell() - len(line)
+        fh.seek(0, 2)
+        size = fh.tell()
+        ranges = []
+        start = first
+        for i in range(1, nchunks):
+            pos = first + (size - first) * i // nchunks
+            if pos <= start:
+                continue
+            fh.seek(pos - 1)
+            fh.readline()  # end of the line containing pos
+            end = fh.tell()
+            if end >= size:
+                break
+            ranges.append((start, end))
+            start = end
+        ranges.append((start, size))
+    return ranges
+
+
+def _pairs_ranges(fnam, nchunks):
+    """
+    Splits a binary pairs file in ranges of blocks.
+
+    :returns: list of lists of block indexes
+    """
+    nblocks = len(read_pairs_index(fnam)['blocks'])
+    return [list(range(nblocks * i // nchunks, nblocks * (i + 1) // nchunks))
+            for i in range(nchunks) if nblocks * (i + 1) // nchunks > nblocks * i // nchunks] or [[]]
+
+
+def _iter_text_range(fnam, rng):
+    start, end = rng
+    if start >= end:
+        return
+    with open(fnam, 'rb') as fh:
+        fh.seek(start)
+        pos = start
+        for line in fh:
+            pos += len(line)
+            yield line.decode()
+            if pos >= end:
+                break
+
+
+def _text_crm_ids(fnam):
+    """
+    Index of each chromosome in the header of a 2D-bed file.
+    """
+    crm_ids = {}
+    with open(fnam) as fh:
+        for line in fh:
+            if not line.startswith('#'):
+                break
+            if line.startswith('# CRM'):
+                crm_ids[line.split()[2]] = len(crm_ids)
+    return crm_ids
+
+
+def _hash_duplicates(fnam, pairs, ranges, tmpdir, strict_duplicates,
+                     max_memory, pool, ncpus=1, count_frags=False):
+    """
+    Finds duplicated pairs of reads, whatever their position in the file.
+    Coordinates of each pair of reads are hashed into on-disk buckets, sized
+    to be sorted within max_memory (in Mb) when ncpus buckets are processed in
+    parallel. In each bucket, all pairs of reads sharing coordinates, except
+    the first found in the file, are duplicates.
+
+    Row indexes of duplicates are left in tmpdir (one file per bucket and
+    range), to be loaded with :func:`_load_dups`.
+
+    :returns: the result of the pre-pass on each range (with the reads
+       counted per RE fragment if count_frags, and the number of pairs of
+       reads in last position) and the number of buckets
+    """
+    if pairs:
+        nrows = read_pairs_index(fnam)['count']
+    else:
+        nrows = _estimate_text_rows(fnam, ranges)
+    # sorting a bucket takes about 3 times its size in memory
+    nbuckets = max(ncpus, int(np.ceil(3. * nrows * DUP_DTYPE.itemsize * ncpus /
+                                      (max_memory * 2**20))))
+    counts = _map_pool(pool, _prepass_pairs_range if pairs else _prepass_text_range,
+                       [(fnam, rng, i, tmpdir, nbuckets, strict_duplicates,
+                         count_frags) for i, rng in enumerate(ranges)])
+    _map_pool(pool, _resolve_dup_bucket,
+              [(tmpdir, b, len(ranges)) for b in range(nbuckets)])
+    return counts, nbuckets
+
+
+def _estimate_text_rows(fnam, ranges, sample=1000):
+    lengths = []
+    for line in _iter_text_range(fnam, ranges[0]):
+        lengths.append(len(line))
+        if len(lengths) >= sample:
+            break
+    if not lengths:
+        return 0
+    return int((ranges[-1][1] - ranges[0][0]) / np.mean(lengths)) + 1
+
+
+def _dup_bucket(keys, nbuckets):
+    """
+    FNV-1a hash of the coordinates of each pair of reads, modulo nbuckets.
+    """
+    hashed = np.full(len(keys), 0xcbf29ce484222325, dtype=np.uint64)
+    for k in DUP_COLUMNS:
+        hashed ^= keys[k].astype(np.int64).view(np.uint64)
+        hashed *= np.uint64(0x100000001b3)
+    hashed ^= hashed >> np.uint64(32)
+    return (hashed % np.uint64(nbuckets)).astype(np.int64)
+
+
+def _spill_dup_keys(keys, first_row, idx, tmpdir, nbuckets, outdup):
+    """
+    Appends the coordinates of a chunk of pairs of reads to the files of
+    their buckets.
+    """
+    keys['row'] = (idx << _ROW_BITS) + first_row + np.arange(len(keys))
+    bucket = _dup_bucket(keys, nbuckets)
+    order = np.argsort(bucket, kind='mergesort')
+    bounds = np.searchsorted(bucket[order], np.arange(nbuckets + 1))
+    for b in np.flatnonzero(np.diff(bounds)):
+        if not b in outdup:
+            outdup[b] = open(os.path.join(tmpdir, 'dups_%d_%d.bin' % (b, idx)),
+                             'wb')
+        outdup[b].write(keys[order[bounds[b]:bounds[b + 1]]].tobytes())
+    return len(keys)
+
+
+def _prepass_text_range(fnam, rng, idx, tmpdir, nbuckets, strict_duplicates,
+                        count_frags, chunk_size=100000):
+    crm_ids = _text_crm_ids(fnam)
+    frag_count = {}
+    outdup = {}
+    nrows = 0
+    buf = []
+    for line in _iter_text_range(fnam, rng):
+        _, cr1, pos1, sd1, l1, rs1, _, cr2, pos2, sd2, l2, rs2, _ = line.split('\t')
+        if count_frags:
+            try:
+                frag_count[(cr1, rs1)] += 1
+            except KeyError:
+                frag_count[(cr1, rs1)] = 1
+            try:
+                frag_count[(cr2, rs2)] += 1
+            except KeyError:
+                frag_count[(cr2, rs2)] = 1
+        buf.append((cr1, pos1, sd1, cr2, pos2, sd2, l1, l2))
+        if len(buf) >= chunk_size:
+            nrows += _spill_dup_keys(
+                _text_dup_keys(buf, crm_ids, strict_duplicates), nrows, idx,
+                tmpdir, nbuckets, outdup)
+            buf = []
+    if buf:
+        nrows += _spill_dup_keys(
+            _text_dup_keys(buf, crm_ids, strict_duplicates), nrows, idx,
+            tmpdir, nbuckets, outdup)
+    for out in outdup.values():
+        out.close()
+    return frag_count, nrows
+
+
+def _text_dup_keys(buf, crm_ids, strict_duplicates):
+    cols = list(zip(*buf))
+    keys = np.zeros(len(buf), dtype=DUP_DTYPE)
+    for i, k in enumerate(DUP_COLUMNS[:8 if strict_duplicates else 6]):
+        if k.startswith('chrom'):
+            try:
+                keys[k] = [crm_ids[c] for c in cols[i]]
+            except KeyError as e:
+                raise Exception('ERROR: chromosome %s not in the header of the '
+                                'input file' % e)
+        else:
+            keys[k] = np.array(cols[i], dtype=int)
+    return keys
+
+
+def _prepass_pairs_range(fnam, blocks, idx, tmpdir, nbuckets,
+                         strict_duplicates, count_frags):
+    frags = np.zeros(0, dtype=np.int64)
+    count = np.zeros(0)
+    outdup = {}
+    nrows = 0
+    columns = list(DUP_COLUMNS[:8 if strict_duplicates else 6])
+    if count_frags:
+        columns += ['rs1', 'rs2']
+    for _, cols in iter_pairs(fnam, columns=columns, names=False, blocks=blocks):
+        if count_frags:
+            frags, fidx = np.unique(np.concatenate((
+                frags, _re_fragment_keys(cols, '1'), _re_fragment_keys(cols, '2'))),
+                                    return_inverse=True)
+            count = np.bincount(fidx, weights=np.concatenate((
+                count, np.ones(2 * len(cols['rs1'])))))
+        keys = np.zeros(len(cols['pos1']), dtype=DUP_DTYPE)
+        for k in DUP_COLUMNS:
+            if k in cols:
+                keys[k] = cols[k]
+        nrows += _spill_dup_keys(keys, nrows, idx, tmpdir, nbuckets, outdup)
+    for out in outdup.values():
+        out.close()
+    return frags, count, nrows
+
+
+def _resolve_dup_bucket(tmpdir, bucket, nranges):
+    """
+    Sorts the pairs of reads of a bucket by coordinates (and by row) to find
+    duplicates. Writes their rows, split by range.
+
+    :returns: number of duplicates found in the bucket
+    """
+    keys = []
+    for idx in range(nranges):
+        fname = os.path.join(tmpdir, 'dups_%d_%d.bin' % (bucket, idx))
+        if os.path.exists(fname):
+            keys.append(np.fromfile(fname, dtype=DUP_DTYPE))
+            os.remove(fname)
+    if not keys:
+        return 0
+    keys = np.concatenate(keys)
+    keys = keys[np.lexsort([keys['row']] + [keys[k] for k in DUP_COLUMNS])]
+    same = np.ones(len(keys) - 1, dtype=bool)
+    for k in DUP_COLUMNS:
+        same &= keys[k][1:] == keys[k][:-1]
+    dups = keys['row'][1:][same]
+    ranges = dups >> _ROW_BITS
+    for idx in np.unique(ranges):
+        np.save(os.path.join(tmpdir, 'dups_%d_%d.npy' % (bucket, idx)),
+                dups[ranges == idx] & ((1 << _ROW_BITS) - 1))
+    return len(dups)
+
+
+def _load_dups(tmpdir, idx, nbuckets, nrows):
+    """
+    :returns: boolean array, True for the duplicated pairs of reads of a range
+    """
+    dups = np.zeros(nrows, dtype=bool)
+    for bucket in range(nbuckets):
+        fname = os.path.join(tmpdir, 'dups_%d_%d.npy' % (bucket, idx))
+        if os.path.exists(fname):
+            dups[np.load(fname)] = True
+            os.remove(fname)
+    return dups
+
+
+def _open_range_outputs(tmpdir, idx):
+    return dict((k, open(os.path.join(tmpdir, '%d_%d.tsv' % (idx, k)), 'w'))
+                for k in FUSED_FILTERS)
+
+
+def _filter_text_range(fnam, rng, params, over, tmpdir, idx, nbuckets, nrows):
+    """
+    Evaluates all filters on a range of lines of a 2D-bed file.
+    """
+    (max_molecule_length, max_frag_size, min_frag_size, re_proximity,
+     min_dist_to_re) = params
+    outfil = _open_range_outputs(tmpdir, idx)
+    counts = dict((k, 0) for k in FUSED_FILTERS)
+    dups = _load_dups(tmpdir, idx, nbuckets, nrows)
+    flags = []
+    for row, line in enumerate(_iter_text_range(fnam, rng)):
+        (read,
+         cr1, pos1, sd1, _, rs1, re1,
+         cr2, pos2, sd2, _, rs2, re2) = line.split('\t')
+        ps1, ps2, sd1_, sd2_ = int(pos1), int(pos2), int(sd1), int(sd2)
+        irs1, ire1, irs2, ire2 = int(rs1), int(re1), int(rs2), int(re2)
+        flag = 0
+        # same fragment filters
+        if cr1 == cr2:
+            if ire1 == ire2:
+                if sd1_ != sd2_:
+                    if (ps2 > ps1) == sd2_:
+                        flag |= 1     # self-circle
+                    else:
+                        flag |= 2     # dangling-end
+                else:
+                    flag |= 4         # error
+            elif (abs(ps1 - ps2) < max_molecule_length
+                  and sd2_ != sd1_
+                  and (ps2 > ps1) != sd2_):
+                flag |= 8             # extra dangling-end
+        # RE sites filters
+        diff11 = ire1 - ps1
+        diff12 = ps1 - irs1
+        diff21 = ire2 - ps2
+        diff22 = ps2 - irs2
+        if ((diff11 < re_proximity) or (diff12 < re_proximity) or
+            (diff21 < re_proximity) or (diff22 < re_proximity)):
+            # multicontacts excluded if fragment is internal (not the first)
+            if not '~' in read:
+                flag |= 16            # too close from RES
+        dif1 = ire1 - irs1
+        dif2 = ire2 - irs2
+        if (dif1 < min_frag_size) or (dif2 < min_frag_size):
+            flag |= 32                # too short
+        if (dif1 > max_frag_size) or (dif2 > max_frag_size):
+            flag |= 64                # too large
+        if (cr1, rs1) in over or (cr2, rs2) in over:
+            flag |= 128               # over-represented
+        if dups[row]:
+            flag |= 256               # duplicated
+        if (((diff11 > min_dist_to_re) and (diff12 > min_dist_to_re)) or
+            ((diff21 > min_dist_to_re) and (diff22 > min_dist_to_re))):
+            flag |= 512               # random breaks
+        flags.append(flag)
+        if flag:
+            for k in FUSED_FILTERS:
+                if flag & (1 << (k - 1)):
+                    counts[k] += 1
+                    outfil[k].write(read + '\n')
+    for k in outfil:
+        outfil[k].close()
+    fname = os.path.join(tmpdir, '%d_flags.npy' % idx)
+    np.save(fname, np.array(flags, dtype=np.uint16))
+    return counts, len(flags), fname
+
+
+def _filter_pairs_range(fnam, blocks, params, over, tmpdir, idx, nbuckets,
+                        nrows):
+    """
+    Evaluates all filters on a range of blocks of a binary pairs file.
+    """
+    (max_molecule_length, max_frag_size, min_frag_size, re_proximity,
+     min_dist_to_re) = params
+    outfil = _open_range_outputs(tmpdir, idx)
+    counts = dict((k, 0) for k in FUSED_FILTERS)
+    dups = _load_dups(tmpdir, idx, nbuckets, nrows)
+    flags = []
+    row = 0
+    for reads, cols in iter_pairs(fnam, blocks=blocks):
+        flag = np.zeros(len(reads), dtype=np.uint16)
+        # same fragment filters
+        cis = cols['chrom1'] == cols['chrom2']
+        same = cis & (cols['re1'] == cols['re2'])
+        diff_strand = cols['strand1'] != cols['strand2']
+        outward = (cols['pos2'] > cols['pos1']) == cols['strand2']
+        flag[same & diff_strand & outward] |= 1
+        flag[same & diff_strand & ~outward] |= 2
+        flag[same & ~diff_strand] |= 4
+        flag[cis & ~same & diff_strand & ~outward &
+             (abs(cols['pos1'] - cols['pos2']) < max_molecule_length)] |= 8
+        # RE sites filters
+        diff11 = cols['re1'] - cols['pos1']
+        diff12 = cols['pos1'] - cols['rs1']
+        diff21 = cols['re2'] - cols['pos2']
+        diff22 = cols['pos2'] - cols['rs2']
+        # multicontacts excluded if fragment is internal (not the first)
+        multi = np.array(['~' in read for read in reads], dtype=bool)
+        flag[~multi & ((diff11 < re_proximity) | (diff12 < re_proximity) |
+                       (diff21 < re_proximity) | (diff22 < re_proximity))] |= 16
+        dif1 = cols['re1'] - cols['rs1']
+        dif2 = cols['re2'] - cols['rs2']
+        flag[(dif1 < min_frag_size) | (dif2 < min_frag_size)] |= 32
+        flag[(dif1 > max_frag_size) | (dif2 > max_frag_size)] |= 64
+        flag[np.in1d(_re_fragment_keys(cols, '1'), over) |
+             np.in1d(_re_fragment_keys(cols, '2'), over)] |= 128
+        flag[dups[row:row + len(reads)]] |= 256
+        row += len(reads)
+        flag[((diff11 > min_dist_to_re) & (diff12 > min_dist_to_re)) |
+             ((diff21 > min_dist_to_re) & (diff22 > min_dist_to_re))] |= 512
+        for k in FUSED_FILTERS:
+            caught = np.flatnonzero(flag & (1 << (k - 1)))
+            counts[k] += len(caught)
+            if len(caught):
+                outfil[k].write(''.join(reads[i] + '\n' for i in caught))
+        flags.append(flag)
+    for k in outfil:
+        outfil[k].close()
+    fname = os.path.join(tmpdir, '%d_flags.npy' % idx)
+    flags = np.concatenate(flags) if flags else np.zeros(0, dtype=np.uint16)
+    np.save(fname, flags)
+    return counts, len(flags), fname
+
+
+def _write_masked(outfil, masked, k, reads, mask):
+    """
+    Writes IDs of the reads selected by a boolean array in a filter file.
+    """
+    idx = np.flatnonzero(mask)
+    masked[k]['reads'] += len(idx)
+    if len(idx):
+        outfil[k].write(''.join(reads[i] + '\n' for i in idx))
+
+
+def _open_masked(masked, output):
+    outfil = {}
+    for k in masked:
+        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
+        outfil[k] = open(masked[k]['fnam'], 'w')
+    return outfil
+
+
+def _filter_same_frag_pairs(fnam, max_molecule_length, output):
+    masked = {1 : {'name': 'self-circle'       , 'reads': 0},
+              2 : {'name': 'dangling-end'      , 'reads': 0},
+              3 : {'name': 'error'             , 'reads': 0},
+              4 : {'name': 'extra dangling-end', 'reads': 0}}
+    outfil = _open_masked(masked, output)
+    for reads, cols in iter_pairs(fnam, columns=('chrom1', 'pos1', 'strand1', 're1',
+                                                 'chrom2', 'pos2', 'strand2', 're2')):
+        cis = cols['chrom1'] == cols['chrom2']
+        same = cis & (cols['re1'] == cols['re2'])
+        diff_strand = cols['strand1'] != cols['strand2']
+        outward = (cols['pos2'] > cols['pos1']) == cols['strand2']
+        _write_masked(outfil, masked, 1, reads, same & diff_strand & outward)
+        _write_masked(outfil, masked, 2, reads, same & diff_strand & ~outward)
+        _write_masked(outfil, masked, 3, reads, same & ~diff_strand)
+        _write_masked(outfil, masked, 4, reads, (
+            cis & ~same & diff_strand & ~outward &
+            (abs(cols['pos1'] - cols['pos2']) < max_molecule_length)))
+    for k in masked:
+        outfil[k].close()
+    return masked
+
+
 def _filter_same_frag(fnam, max_molecule_length, output):
+    if is_pairs(fnam):
+        return _filter_same_frag_pairs(fnam, max_molecule_length, output)
     # t0 = time()
     masked = {1 : {'name': 'self-circle'       , 'reads': 0},
               2 : {'name': 'dangling-end'      , 'reads': 0},
@@ -287,74 +967,90 @@ def _filter_same_frag(fnam, max_molecule_length, output):
     return masked
 
 
-def _filter_duplicates_strict(fnam, output):
-    total = 0
+def _filter_duplicates_hashed(fnam, output, strict_duplicates,
+                              max_memory=1000, ncpus=1):
+    """
+    Finds duplicated pairs of reads (see :func:`_hash_duplicates`), in 2D-bed
+    or binary pairs format.
+    """
+    pairs = is_pairs(fnam)
+    ranges = (_pairs_ranges if pairs else _text_ranges)(fnam, ncpus)
+    tmpdir = '%s_tmp_duplicates_%016x' % (output, getrandbits(64))
+    mkdir(tmpdir)
+    pool = mu.Pool(ncpus) if ncpus > 1 and len(ranges) > 1 else None
+    counts, nbuckets = _hash_duplicates(fnam, pairs, ranges, tmpdir,
+                                        strict_duplicates, max_memory, pool,
+                                        ncpus)
+    if pool is not None:
+        pool.close()
+        pool.join()
     masked = {9 : {'name': 'duplicated'        , 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
-    line = next(fhandler)
-    while line.startswith('#'):
-        line = next(fhandler)
-    (read,
-     cr1, pos1, sd1, l1 , _, _,
-     cr2, pos2, sd2, l2 , _, _) = line.split('\t')
-    prev_elts = cr1, pos1, cr2, pos2, sd1, sd2, l1, l2
-    for line in fhandler:
-        (read,
-         cr1, pos1, sd1, l1 , _, _,
-         cr2, pos2, sd2, l2 , _, _) = line.split('\t')
-        new_elts = cr1, pos1, cr2, pos2, sd1, sd2, l1, l2
-        if prev_elts == new_elts:
-            masked[9]["reads"] += 1
-            outfil[9].write(read + '\n')
-        total += 1
-        prev_elts = new_elts
-    fhandler.close()
-    # print 'done 4', time() - t0
+    outfil = _open_masked(masked, output)
+    total = 0
+    for i, rng in enumerate(ranges):
+        dups = _load_dups(tmpdir, i, nbuckets, counts[i][-1])
+        total += len(dups)
+        if pairs:
+            row = 0
+            for reads, _ in iter_pairs(fnam, columns=('chrom1', ), blocks=rng):
+                _write_masked(outfil, masked, 9, reads, dups[row:row + len(reads)])
+                row += len(reads)
+        else:
+            for dup, line in zip(dups, _iter_text_range(fnam, rng)):
+                if dup:
+                    masked[9]["reads"] += 1
+                    outfil[9].write(line.split('\t', 1)[0] + '\n')
+    os.rmdir(tmpdir)
     for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
         outfil[k].close()
     return masked, total
 
 
-def _filter_duplicates_loose(fnam, output):
-    total = 0
-    masked = {9 : {'name': 'duplicated'        , 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
-    line = next(fhandler)
-    while line.startswith('#'):
-        line = next(fhandler)
-    (read,
-     cr1, pos1, sd1, _ , _, _,
-     cr2, pos2, sd2, _ , _, _) = line.split('\t')
-    prev_elts = cr1, pos1, cr2, pos2, sd1, sd2
-    for line in fhandler:
-        (read,
-         cr1, pos1, sd1, _ , _, _,
-         cr2, pos2, sd2, _ , _, _) = line.split('\t')
-        new_elts = cr1, pos1, cr2, pos2, sd1, sd2
-        if prev_elts == new_elts:
-            masked[9]["reads"] += 1
-            outfil[9].write(read + '\n')
-        total += 1
-        prev_elts = new_elts
-    fhandler.close()
-    # print 'done 4', time() - t0
+def _filter_duplicates_strict(fnam, output, max_memory=1000):
+    return _filter_duplicates_hashed(fnam, output, True, max_memory)
+
+
+def _filter_duplicates_loose(fnam, output, max_memory=1000):
+    return _filter_duplicates_hashed(fnam, output, False, max_memory)
+
+
+def _filter_from_res_pairs(fnam, max_frag_size, min_dist_to_re,
+                           re_proximity, min_frag_size, output):
+    masked = {5 : {'name': 'too close from RES', 'reads': 0},
+              6 : {'name': 'too short'         , 'reads': 0},
+              7 : {'name': 'too large'         , 'reads': 0},
+              10: {'name': 'random breaks'     , 'reads': 0}}
+    outfil = _open_masked(masked, output)
+    for reads, cols in iter_pairs(fnam, columns=('pos1', 'rs1', 're1',
+                                                 'pos2', 'rs2', 're2')):
+        diff11 = cols['re1'] - cols['pos1']
+        diff12 = cols['pos1'] - cols['rs1']
+        diff21 = cols['re2'] - cols['pos2']
+        diff22 = cols['pos2'] - cols['rs2']
+        # multicontacts excluded if fragment is internal (not the first)
+        multi = np.array(['~' in read for read in reads], dtype=bool)
+        _write_masked(outfil, masked, 5, reads, ~multi & (
+            (diff11 < re_proximity) | (diff12 < re_proximity) |
+            (diff21 < re_proximity) | (diff22 < re_proximity)))
+        _write_masked(outfil, masked, 10, reads, (
+            ((diff11 > min_dist_to_re) & (diff12 > min_dist_to_re)) |
+            ((diff21 > min_dist_to_re) & (diff22 > min_dist_to_re))))
+        dif1 = cols['re1'] - cols['rs1']
+        dif2 = cols['re2'] - cols['rs2']
+        _write_masked(outfil, masked, 6, reads,
+                      (dif1 < min_frag_size) | (dif2 < min_frag_size))
+        _write_masked(outfil, masked, 7, reads,
+                      (dif1 > max_frag_size) | (dif2 > max_frag_size))
     for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
         outfil[k].close()
-    return masked, total
+    return masked
 
 
 def _filter_from_res(fnam, max_frag_size, min_dist_to_re,
                      re_proximity, min_frag_size, output):
+    if is_pairs(fnam):
+        return _filter_from_res_pairs(fnam, max_frag_size, min_dist_to_re,
+                                      re_proximity, min_frag_size, output)
     # t0 = time()
     masked = {5 : {'name': 'too close from RES', 'reads': 0},
               6 : {'name': 'too short'         , 'reads': 0},
@@ -412,7 +1108,39 @@ def _filter_from_res(fnam, max_frag_size, min_dist_to_re,
     return masked
 
 
+def _re_fragment_keys(cols, side):
+    return (cols['chrom' + side].astype(np.int64) << 32) + cols['rs' + side]
+
+
+def _filter_over_represented_pairs(fnam, over_represented, output):
+    # count reads per RE fragment (chromosome index and start)
+    frags = np.zeros(0, dtype=np.int64)
+    count = np.zeros(0)
+    columns = ('chrom1', 'rs1', 'chrom2', 'rs2')
+    for _, cols in iter_pairs(fnam, columns=columns, names=False):
+        frags, idx = np.unique(np.concatenate((
+            frags, _re_fragment_keys(cols, '1'), _re_fragment_keys(cols, '2'))),
+                               return_inverse=True)
+        count = np.bincount(idx, weights=np.concatenate((
+            count, np.ones(2 * len(cols['rs1'])))))
+    num_frags = len(frags)
+    cut = int((1 - over_represented) * num_frags + 0.5)
+    # use cut-1 because it represents the length of the list
+    cut = np.sort(count)[cut - 1] if num_frags else 0
+    masked = {8 : {'name': 'over-represented'  , 'reads': 0}}
+    outfil = _open_masked(masked, output)
+    for reads, cols in iter_pairs(fnam, columns=columns):
+        _write_masked(outfil, masked, 8, reads, (
+            (count[np.searchsorted(frags, _re_fragment_keys(cols, '1'))] > cut) |
+            (count[np.searchsorted(frags, _re_fragment_keys(cols, '2'))] > cut)))
+    for k in masked:
+        outfil[k].close()
+    return masked
+
+
 def _filter_over_represented(fnam, over_represented, output):
+    if is_pairs(fnam):
+        return _filter_over_represented_pairs(fnam, over_represented, output)
     # t0 = time()
     frag_count = count_re_fragments(fnam)
     num_frags = len(frag_count)
@@ -7,11 +7,15 @@ from __future__ import print_function
 
 from re import compile
 from warnings import warn
+from os import path, rename
+from random import getrandbits
 
 from collections import OrderedDict
 from scipy.stats import binom_test
+import numpy as np
 
 from pytadbit.utils.file_handling import magic_open
+from pytadbit.parsers.genome_parser import genome_checksum
 
 try:
     basestring
@@ -106,8 +110,7 @@ def map_re_sites_nochunk(enzyme_name, genome_seq, verbose=False):
     for crm in genome_seq:
         seq = genome_seq[crm]
         frags[crm] = [1]
-        for match in enz_pattern.finditer(seq):
-            pos = match.end() + 1
+        for pos in _iter_re_sites(enz_pattern, seq):
             frags[crm].append(pos)
             count += 1
         # at the end of last chunk we add the chromosome length
@@ -164,8 +167,7 @@ def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
         seq = genome_seq[crm]
         frags[crm] = dict([(i, []) for i in range(int(len(seq) // frag_chunk + 1))])
         frags[crm][0] = [1]
-        for match in enz_pattern.finditer(seq):
-            pos = match.end() + 1
+        for pos in _iter_re_sites(enz_pattern, seq):
             frags[crm][pos // frag_chunk].append(pos)
             count += 1
         # at the end of last chunk we add the chromosome length
@@ -199,6 +201,110 @@ def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
     return frags
 
 
+def _re_sites_pattern(enzyme_names):
+    # we match the full cut-site but report the position after the cut site
+    restring = ('%s') % ('|'.join(['(?<=%s(?=%s))' % tuple(
+        RESTRICTION_ENZYMES[n].split('|')) for n in enzyme_names]))
+    # IUPAC conventions
+    return compile(iupac2regex(restring))
+
+
+def _iter_re_sites(enz_pattern, seq):
+    """
+    yields the position after the cut of each RE site found in a sequence
+    (string, or memory mapped
+    :class:`pytadbit.parsers.genome_parser.ChromosomeSequence` scanned
+    without loading it)
+    """
+    if hasattr(seq, 'buffer'):
+        enz_pattern = compile(enz_pattern.pattern.encode())
+        seq = seq.buffer
+    for match in enz_pattern.finditer(seq):
+        yield match.end() + 1
+
+
+def re_sites_index(enzyme_name, genome_seq, cache_dir=None, verbose=False):
+    """
+    map all restriction enzyme (RE) sites of a given enzyme (or list of
+    enzymes) in a genome, as in :func:`map_re_sites`, but as one sorted array
+    per chromosome, to be searched with
+    :func:`pytadbit.mapping.restriction_enzymes.locate_re_sites`.
+
+    :param enzyme_name: name of the enzyme to map (upper/lower case are
+       important), or list of names
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+    :param None cache_dir: directory where to store (and reload) the RE
+       sites. Cached files are named after the enzymes and the checksum of
+       the genomic sequences.
+
+    :returns: an ordered dictionary with, for each chromosome, a sorted array
+       (int32) of RE sites, starting with 1 and ending with the length of the
+       chromosome
+    """
+    if isinstance(enzyme_name, basestring):
+        enzyme_names = [enzyme_name]
+    else:
+        enzyme_names = list(enzyme_name)
+    cache = None
+    if cache_dir:
+        cache = path.join(cache_dir, 'RE_sites_%s_%s.npz' % (
+            '-'.join(sorted(enzyme_names)), genome_checksum(genome_seq)[:10]))
+        if path.exists(cache):
+            if verbose:
+                print('Loading cached RE sites')
+            with np.load(cache) as cached:
+                return OrderedDict((crm, cached['arr_%d' % i])
+                                   for i, crm in enumerate(genome_seq))
+
+    enz_pattern = _re_sites_pattern(enzyme_names)
+    sites = OrderedDict()
+    count = 0
+    for crm in genome_seq:
+        seq = genome_seq[crm]
+        positions = list(_iter_re_sites(enz_pattern, seq))
+        count += len(positions)
+        sites[crm] = np.array([1] + positions + [len(seq)], dtype=np.int32)
+    if verbose:
+        print('Found %d RE sites' % count)
+
+    if cache:
+        tmp_cache = '%s_%016x' % (cache, getrandbits(64))
+        try:
+            with open(tmp_cache, 'wb') as out:
+                np.savez(out, *list(sites.values()))
+            rename(tmp_cache, cache)
+        except (IOError, OSError):
+            warn('WARNING: could not write RE sites cache in %s' % cache_dir)
+    return sites
+
+
+def locate_re_sites(sites, positions, lengths):
+    """
+    Finds the RE fragment of a batch of reads of one chromosome.
+
+    :param sites: sorted array of RE sites of the chromosome (see
+       :func:`re_sites_index`)
+    :param positions: array of positions of the reads
+    :param lengths: array of lengths of the reads. Reads overhanging the end
+       of the chromosome are moved inside it, if less than their length is
+       outside.
+
+    :returns: arrays of positions (corrected), previous RE sites and next RE
+       sites
+    """
+    positions = np.asarray(positions)
+    overhang = positions - (sites[-1] - 1)
+    outside = overhang > 0
+    if outside.any():
+        if (overhang[outside] >= np.asarray(lengths)[outside]).any():
+            raise Exception('Read mapped mostly outside ' +
+                            'chromosome\n(also reference genome can be truncated)')
+        positions = np.where(outside, sites[-1] - 1, positions)
+    idx = np.searchsorted(sites, positions, side='right')
+    return positions, sites[np.maximum(idx - 1, 0)], sites[idx]
+
+
 def complementary(seq):
     trs = dict([(nt1, nt2) for nt1, nt2 in zip('ATGCN', 'TACGN')])
     return ''.join([trs[s] for s in seq[::-1]])
@@ -4,9 +4,17 @@ simple BED and BEDgraph parser
 from __future__ import print_function
 from builtins   import next
 
+from collections import OrderedDict
+from os import path
+
+import numpy as np
+
 from pytadbit.utils.file_handling import magic_open
 from pytadbit.utils.extraviews import nicer
-from os import path
+
+
+# number of characters of bedGraph read (and parsed) at once
+_BEDGRAPH_CHUNK = 1 << 24
 
 
 def _bed_float(line):
@@ -122,7 +130,8 @@ def parse_mappability_bedGraph(fname, resolution, wanted_chrom=None,
     :param False reload_cache: reload cached genome
 
     :returns: a dictionary with chromosomes as keys, with average mappability
-       per bin.
+       per bin (the value of each interval weighted by the number of
+       nucleotides falling in the bin).
     """
     tadbit_fname = fname + '_mappability_%s.TADbit' % (nicer(resolution, sep=''))
     if path.exists(tadbit_fname) and not reload_cache:
@@ -131,54 +140,64 @@ def parse_mappability_bedGraph(fname, resolution, wanted_chrom=None,
             return crm, list(map(float, elements.split(',')))
         return dict(read_line(l) for l in open(tadbit_fname))
 
-    fh = open(fname)
-    line = next(fh)
-    crmM, begM, endM, val = line.split()
-    crm = crmM
-    if wanted_chrom:
-        if crmM != wanted_chrom:
-            print('     skipping %s' % crmM)
-            while crmM != wanted_chrom:
-                line = next(fh)
-                crmM, begM, endM, val = line.split()
-                crm = crmM
-    mappability = {}
-    mappability[crm] = []
-    begB = 0
-    while True:
-        endB = begB + resolution
-        tmp = 0
-        try:
-            while True:
-                crmM, begM, endM, val = line.split()
-                if crm != crmM:
-                    mappability[crmM] = []
-                    begB = -resolution
-                    if wanted_chrom:
-                        raise StopIteration
-                    break
-                endM = int(endM)
-                if endM > endB:
-                    weight = endB - int(begM)
-                    if weight >= 0:
-                        tmp += weight * float(val)
-                    break
-                begM = int(begM)
-                weight = endM - (begM if begM > begB else begB)
-                if weight < 0:
-                    break
-                tmp += weight * float(val)
-                line = next(fh)
-        except StopIteration:
-            mappability[crm].append(tmp / resolution)
-            break
-        mappability[crm].append(tmp / resolution)
-        crm = crmM
-        begB +=  resolution
-    print("     saving mappabilty to cache...")
-    if save_cache:
+    weights = OrderedDict()
+    with open(fname) as fh:
+        while True:
+            lines = fh.readlines(_BEDGRAPH_CHUNK)
+            if not lines:
+                break
+            _bedgraph_bins(lines, resolution, weights, wanted_chrom)
+    mappability = dict((crm, (weights[crm] / resolution).tolist())
+                       for crm in weights)
+    # partial parsing (only one chromosome) is not cached
+    if save_cache and not wanted_chrom:
+        print("     saving mappabilty to cache...")
         out = open(tadbit_fname, 'w')
         for crm in mappability:
             out.write(crm + '\t' + ','.join(map(str, mappability[crm])) + '\n')
         out.close()
     return mappability
+
+
+def _bedgraph_bins(lines, resolution, weights, wanted_chrom=None):
+    """
+    Adds the values of a chunk of bedGraph lines to the sums per bin of each
+    chromosome (values weighted by the number of nucleotides of each interval
+    falling in each bin).
+    """
+    fields = np.array(''.join(l for l in lines if not l.startswith(
+        ('#', 'track', 'browser'))).split()).reshape(-1, 4)
+    if wanted_chrom:
+        fields = fields[fields[:, 0] == wanted_chrom]
+    crms, first, inverse = np.unique(fields[:, 0], return_index=True,
+                                     return_inverse=True)
+    for i in np.argsort(first):
+        rows  = fields[inverse == i]
+        beg   = rows[:, 1].astype(np.int64)
+        end   = rows[:, 2].astype(np.int64)
+        val   = rows[:, 3].astype(float)
+        first_bin = beg // resolution
+        last_bin  = (end - 1) // resolution
+        nbins = int(last_bin.max()) + 1
+        # first (or only) bin of each interval
+        sums = np.bincount(first_bin, minlength=nbins, weights=val * (
+            np.minimum(end, (first_bin + 1) * resolution) - beg))
+        # last bin of intervals spanning several bins
+        multi = last_bin > first_bin
+        sums += np.bincount(last_bin[multi], minlength=nbins, weights=val[multi] * (
+            end[multi] - last_bin[multi] * resolution))
+        # bins fully covered by an interval
+        covered = last_bin - first_bin > 1
+        sums += resolution * np.cumsum(
+            np.bincount(first_bin[covered] + 1, minlength=nbins + 1,
+                        weights=val[covered]) -
+            np.bincount(last_bin[covered], minlength=nbins + 1,
+                        weights=val[covered]))[:nbins]
+        crm = crms[i]
+        if crm not in weights:
+            weights[crm] = sums
+            continue
+        if len(weights[crm]) < nbins:
+            weights[crm] = np.concatenate(
+                [weights[crm], np.zeros(nbins - len(weights[crm]))])
+        weights[crm][:nbins] += sums
@@ -126,6 +126,85 @@ def parse_cooler(fname, resolution=None, normalized=False,
     else:
         return items, size, header, masked, False
 
+def parse_pixels(fname, resolution, ranges=None):
+    """
+    Read the pixels stored in a cooler, using its index to load only the rows
+    of some regions.
+
+    :param fname: path to the cooler file.
+    :param resolution: matrix resolution.
+    :param None ranges: dictionary with chromosome names as keys and lists of
+       (first bin, last bin not included) as values (bins relative to the
+       chromosome start). Only the pixels between two of these regions are
+       loaded. If None all pixels are loaded
+
+    :returns: the list of chromosome names, the array with the index of the
+       first bin of each chromosome (plus the total number of bins), and the
+       arrays of bin1_id, bin2_id and count
+    """
+    with h5py.File(fname, "r") as f:
+        root_grp = f['resolutions'][str(resolution)]
+        names = root_grp["chroms"]["name"][()]
+        try:
+            names = [c.decode() for c in names]
+        except (UnicodeDecodeError, AttributeError):
+            names = [str(c) for c in names]
+        chrom_offset = root_grp["indexes"]["chrom_offset"][()]
+        bin1_offset = root_grp["indexes"]["bin1_offset"]
+        pixels = root_grp["pixels"]
+        # rows to read, as global bins
+        intervals = []
+        for i, name in enumerate(names):
+            if ranges is None:
+                intervals.append((chrom_offset[i], chrom_offset[i + 1]))
+                continue
+            for beg, end in ranges.get(name, []):
+                beg = chrom_offset[i] + max(0, beg)
+                end = min(chrom_offset[i] + end, chrom_offset[i + 1])
+                if beg < end:
+                    intervals.append((beg, end))
+        if ranges is not None:
+            wanted = np.zeros(chrom_offset[-1], dtype=bool)
+            for beg, end in intervals:
+                wanted[beg:end] = True
+        bin1 = [np.array([], dtype=np.int64)]
+        bin2 = [np.array([], dtype=np.int64)]
+        count = [np.array([], dtype=np.int64)]
+        for beg, end in intervals:
+            beg, end = bin1_offset[beg], bin1_offset[end]
+            rows = pixels["bin1_id"][beg:end]
+            cols = pixels["bin2_id"][beg:end]
+            vals = pixels["count"][beg:end]
+            if ranges is not None:
+                keep = wanted[cols]
+                rows, cols, vals = rows[keep], cols[keep], vals[keep]
+            bin1.append(rows)
+            bin2.append(cols)
+            count.append(vals)
+    return (names, chrom_offset, np.concatenate(bin1), np.concatenate(bin2),
+            np.concatenate(count))
+
+def read_attrs(fname):
+    """
+    Read the attributes stored at the root of a cooler file
+
+    :param fname: path to the cooler file.
+
+    :returns: a dictionary
+    """
+    with h5py.File(fname, "r") as f:
+        return dict(f.attrs)
+
+def write_attrs(fname, attrs):
+    """
+    Write attributes at the root of a cooler file
+
+    :param fname: path to the cooler file.
+    :param attrs: dictionary of attributes
+    """
+    with h5py.File(fname, "r+") as f:
+        f.attrs.update(attrs)
+
 class cooler_file(object):
     """
         Cooler file wrapper.
@@ -341,6 +420,27 @@ class cooler_file(object):
         self.nbuff += 1
         self.ichunk = ichunk
 
+    def write_pixels(self, bin1, bin2, values):
+        """
+        Write arrays of pixels to the h5py file at once. Pixels should be
+        sorted by row and column, and come after the ones already written.
+
+        :param bin1: array of row numbers (bin indexes in the cooler)
+        :param bin2: array of column numbers (bin indexes in the cooler)
+        :param values: array of interaction values
+
+        """
+        nnew = len(values)
+        with h5py.File(self.outcool, "r+") as f:
+            root_grp = f[self.root_grp][str(self.resolution)]
+            grp = root_grp["pixels"]
+            dsets = ["bin1_id","bin2_id","count"]
+            for dset, data in zip(dsets, (bin1, bin2, values)):
+                grp[dset].resize((self.nnz + nnew,))
+                grp[dset][self.nnz : self.nnz + nnew] = data
+        self.nnz += nnew
+        self.ncontacts += int(np.sum(values))
+
     def close(self):
         """
         Copy remaining buffer to file, index the pixelsand complete information
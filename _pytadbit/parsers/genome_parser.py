@@ -6,18 +6,209 @@ convert a bunch of fasta files, or a single multi fasta file, into a dictionary
 from __future__ import print_function
 
 from collections import OrderedDict
-import multiprocessing as mu
-from os import path
+from hashlib     import md5
+from mmap        import mmap, ACCESS_READ
+from os          import path, rename
+from random      import getrandbits
+from warnings    import warn
+import json
+import struct
 import re
 
+import numpy as np
+
 from pytadbit.utils.file_handling import magic_open
-from functools import reduce
 
 try:
     basestring
 except NameError:
     basestring = str
 
+
+# the last byte before the new line is the version of the format (2: index
+# entries with the checksum of each sequence)
+GENOME_MAGIC = b'TADbit-genome\x02\n'
+
+# memory maps of the cached genomes opened by this process
+_GENOME_MAPS = {}
+
+
+def _genome_map(fname):
+    try:
+        return _GENOME_MAPS[fname]
+    except KeyError:
+        with open(fname, 'rb') as fh:
+            _GENOME_MAPS[fname] = mmap(fh.fileno(), 0, access=ACCESS_READ)
+        return _GENOME_MAPS[fname]
+
+
+class ChromosomeSequence(object):
+    """
+    Sequence of a chromosome stored in a TADbit genome cache file. The
+    sequence is read from the memory mapped file (one byte per nucleotide,
+    upper case), only slices of it are converted to strings.
+
+    :param fname: path to the genome cache file
+    :param offset: position of the sequence in the file
+    :param length: length of the sequence
+    :param None md5: checksum of the sequence (hexadecimal)
+    """
+
+    def __init__(self, fname, offset, length, md5=None):
+        self.fname  = fname
+        self.offset = offset
+        self.length = length
+        self.md5    = md5
+
+    @property
+    def buffer(self):
+        """
+        memoryview of the sequence (bytes), e.g. to be scanned with regular
+        expressions compiled from bytes
+        """
+        return memoryview(_genome_map(self.fname))[
+            self.offset:self.offset + self.length]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            beg, end, step = key.indices(self.length)
+            if step != 1:
+                return str(self)[key]
+            return _genome_map(self.fname)[
+                self.offset + beg:self.offset + max(beg, end)].decode()
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError('sequence index out of range')
+        return self[key:key + 1]
+
+    def __str__(self):
+        return self[:]
+
+    def __repr__(self):
+        return 'ChromosomeSequence(%r, %d, %d)' % (self.fname, self.offset,
+                                                  self.length)
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def count(self, sub):
+        """
+        number of non-overlapping occurrences of a sub-sequence
+        """
+        return self.buffer.tobytes().count(sub.encode())
+
+
+def _genome_cache_magic(fname):
+    try:
+        with open(fname, 'rb') as fh:
+            return fh.read(len(GENOME_MAGIC))
+    except (IOError, OSError):
+        return b''
+
+
+def is_genome_cache(fname):
+    """
+    Check if a file is a TADbit binary genome cache (of the current version)
+
+    :param fname: path to file
+    """
+    return _genome_cache_magic(fname) == GENOME_MAGIC
+
+
+def write_genome_cache(genome_seq, fname):
+    """
+    Writes a TADbit binary genome cache. Sequences are stored one after the
+    other (one byte per nucleotide), followed by an index (JSON) with the
+    name, offset, length and checksum of each chromosome.
+
+    File layout:
+       - magic string
+       - sequences
+       - index (JSON)
+       - offset of the index (8 bytes) and magic string
+
+    :param genome_seq: dictionary with chromosome names as keys and sequences
+       as values
+    :param fname: path to output file
+    """
+    index = []
+    tmp_fname = '%s_%016x' % (fname, getrandbits(64))
+    with open(tmp_fname, 'wb') as out:
+        out.write(GENOME_MAGIC)
+        for crm in genome_seq:
+            seq = str(genome_seq[crm]).encode()
+            index.append([crm, out.tell(), len(seq), md5(seq).hexdigest()])
+            out.write(seq)
+        offset = out.tell()
+        out.write(json.dumps(index).encode())
+        out.write(struct.pack('<Q', offset))
+        out.write(GENOME_MAGIC)
+    rename(tmp_fname, fname)
+    # sequences loaded afterwards must not use a map of the replaced file
+    _GENOME_MAPS.pop(path.abspath(fname), None)
+
+
+def load_genome_cache(fname, only_length=False):
+    """
+    Loads a TADbit binary genome cache (written by
+    :func:`write_genome_cache`).
+
+    :param fname: path to the genome cache file
+    :param False only_length: returns dictionary with length of genome, not
+       sequence
+
+    :returns: a sorted dictionary with chromosome names as keys, and
+       :class:`ChromosomeSequence` (or lengths) as values
+    """
+    fname = path.abspath(fname)
+    with open(fname, 'rb') as fh:
+        fh.seek(-8 - len(GENOME_MAGIC), 2)
+        offset = struct.unpack('<Q', fh.read(8))[0]
+        if fh.read(len(GENOME_MAGIC)) != GENOME_MAGIC:
+            raise Exception('ERROR: %s is not a complete TADbit genome file' % (
+                fname))
+        end = fh.tell() - 8 - len(GENOME_MAGIC)
+        fh.seek(offset)
+        index = json.loads(fh.read(end - offset).decode())
+    if only_length:
+        return OrderedDict((crm, length) for crm, _, length, _ in index)
+    return OrderedDict((crm, ChromosomeSequence(fname, beg, length, checksum))
+                       for crm, beg, length, checksum in index)
+
+
+def _sequence_bytes(seq):
+    return seq.buffer if hasattr(seq, 'buffer') else seq.encode()
+
+
+def genome_checksum(genome_seq, chromosomes=None):
+    """
+    Checksum of a genome, used to name files cached from it (the checksums
+    of the sequences of memory mapped genomes are stored in the genome cache
+    file).
+
+    :param genome_seq: a dictionary generated by :func:`parse_fasta`
+    :param None chromosomes: list of chromosomes to consider (all by default)
+
+    :returns: checksum (hexadecimal)
+    """
+    checksum = md5()
+    for crm in chromosomes or genome_seq:
+        seq = genome_seq[crm]
+        seq_md5 = getattr(seq, 'md5', None) or md5(_sequence_bytes(seq)).hexdigest()
+        checksum.update(('>%s\n%s\n' % (crm, seq_md5)).encode())
+    return checksum.hexdigest()
+
+
 def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
                 verbose=True, save_cache=True, reload_cache=False, only_length=False):
     """
@@ -30,8 +221,9 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
        are passed, then chromosome names will be inferred from fasta headers
     :param None chr_filter: use only chromosome in the input list
     :param None chr_regexp: use only chromosome matching
-    :param True save_cache: save a cached version of this file for faster
-       loadings (~4 times faster)
+    :param True save_cache: save a cached (binary) version of this file for
+       faster loadings. Cached genomes are memory mapped, sequences being
+       :class:`ChromosomeSequence` objects instead of strings
     :param False reload_cache: reload cached genome
     :param False only_length: returns dictionary with length of genome,not sequence
 
@@ -46,19 +238,30 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
     else:
         fname = path.join(path.commonprefix(f_names), 'genome.TADbit')
     if path.exists(fname) and not reload_cache:
-        if verbose:
-            print('Loading cached genome')
-        genome_seq = OrderedDict()
-        with open(fname) as f_open:
-            for line in f_open:
-                if line.startswith('>'):
-                    c = line[1:].strip()
-                else:
-                    if only_length:
-                        genome_seq[c] = len(line.strip())
+        magic = _genome_cache_magic(fname)
+        if magic == GENOME_MAGIC:
+            if verbose:
+                print('Loading cached genome')
+            return load_genome_cache(fname, only_length=only_length)
+        if magic.startswith(GENOME_MAGIC[:-2]):
+            # binary cache of another version, parsed and cached again
+            if verbose:
+                print('Cached genome from another version, parsing again')
+        else:
+            if verbose:
+                print('Loading cached genome')
+            # text cache from older versions
+            genome_seq = OrderedDict()
+            with open(fname) as f_open:
+                for line in f_open:
+                    if line.startswith('>'):
+                        c = line[1:].strip()
                     else:
-                        genome_seq[c] = line.strip()
-        return genome_seq
+                        if only_length:
+                            genome_seq[c] = len(line.strip())
+                        else:
+                            genome_seq[c] = line.strip()
+            return genome_seq
 
     if isinstance(chr_names, basestring):
         chr_names = [chr_names]
@@ -137,14 +340,20 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
             fname = f_names[0] + '_genome.TADbit'
         else:
             fname = path.join(path.commonprefix(f_names), 'genome.TADbit')
-        out = open(fname, 'w')
-        for c in genome_seq:
-            out.write('>%s\n%s\n' % (c, genome_seq[c]))
-        out.close()
+        write_genome_cache(genome_seq, fname)
     return genome_seq
 
 
-def get_gc_content(genome, resolution, chromosomes=None, n_cpus=None, by_chrom=False):
+# number of nucleotides processed at once in the computation of GC content
+_GC_CHUNK = 1 << 24
+
+_GC_CODES = np.zeros(256, dtype=np.int8)
+_GC_CODES[[ord('G'), ord('C')]] = 1
+_GC_CODES[ord('N')] = -1
+
+
+def get_gc_content(genome, resolution, chromosomes=None, n_cpus=None,
+                   by_chrom=False, cache_dir=None):
     """
     Get GC content by bins of a given size. Ns are nottaken into account in the
        calculation, only the number of Gs and Cs over As, Ts, Gs and Cs
@@ -152,46 +361,54 @@ def get_gc_content(genome, resolution, chromosomes=None, n_cpus=None, by_chrom=F
     :param genome: a TADbit parsed genome object
     :param resolution:
     :param None chromosomes: GC content only calculated over these chromosomes
-    :param None n_cpus: parallelize (can't parallelize more than the number of
-       chromosomes)
+    :param None n_cpus: not used, kept for backward compatibility (the
+       computation is vectorized)
     :param False by_chrom: if False returns a unique list for the full genome
+    :param None cache_dir: directory where to store (and reload) the GC
+       content. Cached files are named after the resolution and the checksum
+       of the genome.
     """
     chromosomes = chromosomes if chromosomes else list(genome.keys())
-    if not n_cpus:
-        n_cpus = mu.cpu_count()
-    pool = mu.Pool(n_cpus)
-    get_chr_gc = _get_chr_gc_dico if by_chrom else _get_chr_gc_list
-    jobs = {}
-    for crm in chromosomes:
-        jobs[crm] = pool.apply_async(get_chr_gc, args=(genome[crm], resolution))
-    pool.close()
-    pool.join()
-    if by_chrom:
-        gc_content = dict((crm, jobs[crm].get()) for crm in chromosomes)
+    cache = None
+    if cache_dir:
+        cache = path.join(cache_dir, 'GC_content_%d_%s.npz' % (
+            resolution, genome_checksum(genome, chromosomes)[:10]))
+    if cache and path.exists(cache):
+        with np.load(cache) as cached:
+            gc_content = [cached['arr_%d' % i] for i in range(len(chromosomes))]
     else:
-        gc_content = reduce(lambda x,y: x + y, (jobs[crm].get() for crm in chromosomes))
-    return gc_content
+        gc_content = [_get_chr_gc(genome[crm], resolution)
+                      for crm in chromosomes]
+        if cache:
+            tmp_cache = '%s_%016x' % (cache, getrandbits(64))
+            try:
+                with open(tmp_cache, 'wb') as out:
+                    np.savez(out, *gc_content)
+                rename(tmp_cache, cache)
+            except (IOError, OSError):
+                warn('WARNING: could not write GC content cache in %s' % cache_dir)
+    if by_chrom:
+        return dict((crm, dict(enumerate(gc.tolist())))
+                    for crm, gc in zip(chromosomes, gc_content))
+    return np.concatenate(gc_content).tolist() if gc_content else []
 
 
-def _get_chr_gc_list(chrom, resolution):
+def _get_chr_gc(chrom, resolution):
+    """
+    GC content per bin of a chromosome, counting Gs, Cs and Ns of the byte
+    view of the sequence, by chunks of bins.
+    """
+    codes = np.frombuffer(_sequence_bytes(chrom), dtype=np.uint8)
+    chunk = max(1, _GC_CHUNK // resolution) * resolution
     gc_content = []
-    for pos in range(0, len(chrom), resolution):
-        seq = chrom[pos:pos + resolution]
-        try:
-            gc_content.append(float(seq.count('G') + seq.count('C')) /
-                              (len(seq) - seq.count('N')))
-        except ZeroDivisionError:
-            gc_content.append(float('nan'))
-    return gc_content
-
-
-def _get_chr_gc_dico(chrom, reso):
-    gc_content = {}
-    for pos in range(0, len(chrom), reso):
-        seq = chrom[pos:pos + reso]
-        try:
-            gc_content[pos  /reso] = (float(seq.count('G') + seq.count('C')) /
-                                      (len(seq) - seq.count('N')))
-        except ZeroDivisionError:
-            gc_content[pos  /reso] = float('nan')
-    return gc_content
+    for beg in range(0, len(codes), chunk):
+        values = _GC_CODES[codes[beg:beg + chunk]]
+        starts = np.arange(0, len(values), resolution)
+        gc_count = np.add.reduceat(values == 1, starts, dtype=np.int64)
+        nt_count = (np.minimum(starts + resolution, len(values)) - starts -
+                    np.add.reduceat(values == -1, starts, dtype=np.int64))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gc_content.append(np.where(nt_count > 0,
+                                       gc_count / nt_count.astype(float),
+                                       float('nan')))
+    return np.concatenate(gc_content) if gc_content else np.zeros(0)
@@ -20,11 +20,17 @@ from random                       import getrandbits
 from tarfile                      import open as taropen
 from io                           import StringIO
 from shutil                       import copyfile
+from hashlib                      import md5
 from sys                          import stdout, stderr, exc_info, modules
 from distutils.version            import LooseVersion
+from warnings                     import warn
+from itertools                    import islice
 import os
+import heapq
 import multiprocessing as mu
 
+import numpy as np
+
 try:
     from lockfile                 import LockFile
 except ImportError:
@@ -39,9 +45,13 @@ from pysam                        import AlignmentFile
 from pytadbit.utils                 import printime
 from pytadbit.utils.file_handling   import mkdir, which
 from pytadbit.utils.extraviews      import nicer
-from pytadbit.mapping.filter        import MASKED
+from pytadbit.mapping.filter        import MASKED, filter_bitmask
+from pytadbit.parsers.pairs_parser  import is_pairs, iter_pairs_lines
+from pytadbit.parsers.pairs_parser  import read_pairs_index
 try:
-    from pytadbit.parsers.cooler_parser import cooler_file
+    from pytadbit.parsers.cooler_parser import cooler_file, parse_pixels
+    from pytadbit.parsers.cooler_parser import read_attrs, write_attrs
+    from pytadbit.parsers.cooler_parser import is_cooler
 except ImportError:
     pass
 
@@ -54,12 +64,27 @@ def filters_to_bin(filters):
     return sum((k in filters) * 2**(k-1) for k in MASKED)
 
 
-def print_progress(procs):
+def print_progress(procs, weights=None):
+    """
+    Prints one dot per finished process
+
+    :param procs: list of processes (AsyncResult objects)
+    :param None weights: list of weights of each process (e.g. number of reads
+       to process), if given the number of dots printed is proportional to the
+       sum of the weights of the finished processes
+    """
+    if weights:
+        total = float(sum(weights)) or 1.
     stdout.write('     ')
     prev_done = done = i = 0
     while done < len(procs):
         sleep(0.1)
-        done = sum(p.ready() for p in procs)
+        if weights:
+            done = int(len(procs) * sum(w for p, w in zip(procs, weights)
+                                        if p.ready()) / total)
+            done = len(procs) if all(p.ready() for p in procs) else done
+        else:
+            done = sum(p.ready() for p in procs)
         for i in range(prev_done, done):
             if not i % 10 and i:
                 stdout.write(' ')
@@ -90,9 +115,10 @@ def _map2sam_short(line, flag):
     # trans contact?
     if rname != rnext:
         flag += 1024 # filter_keys['trans-chromosomic'] = 2**10
-    r1r2 = ('{0}\t{1}\t{2}\t{3}\t0\t1P\t{4}\t{5}\t*\t*\t*\t'
+    # TLEN must be an integer (htslib rejects '*')
+    r1r2 = ('{0}\t{1}\t{2}\t{3}\t0\t1P\t{4}\t{5}\t0\t*\t*\t'
             'TC:i:{6}\n'
-            '{0}\t{1}\t{4}\t{5}\t0\t1S\t{2}\t{3}\t*\t*\t*\t'
+            '{0}\t{1}\t{4}\t{5}\t0\t1S\t{2}\t{3}\t0\t*\t*\t'
             'TC:i:{6}\n'
            ).format(
                qname,               # 0
@@ -207,13 +233,15 @@ def _map2sam_long(line, flag):
     return r1r2
 
 
-def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='samtools'):
+def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None,
+                    samtools=None, max_reads=250000):
     """
     function adapted from Enrique Vidal <enrique.vidal@crg.eu> scipt to convert
     2D beds into compressed BAM format.
 
-    Gets the *_both_filled_map.tsv contacts from TADbit (and the corresponding
-    filter files) and outputs a modified indexed BAM with the following fields:
+    Gets the *_both_filled_map.tsv contacts from TADbit, in 2D-bed or in
+    binary pairs format (and the corresponding filter files) and outputs a
+    modified indexed BAM with the following fields:
 
        - read ID
        - filtering flag (see codes in header)
@@ -230,12 +258,22 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
        - S1 and S2 tags are the strand orientation of the left and right read-end
 
     Each pair of contacts produces two lines in the output BAM
+
+    By default the BAM is written with pysam: reads are formatted and sorted
+    in parallel by runs of max_reads contacts, each run written to a
+    temporary BAM, and the runs are merged into the final BAM.
+
+    :param None samtools: path to samtools binary. If given, samtools is used
+       to compress and sort the BAM instead of pysam
+    :param 250000 max_reads: maximum number of contacts sorted in memory by
+       each process
     """
-    samtools = which(samtools)
-    if not samtools:
-        raise Exception('ERROR: samtools is needed to save a compressed '
-                        'version of the results. Check '
-                        'http://samtools.sourceforge.net/ \n')
+    if samtools:
+        samtools = which(samtools)
+        if not samtools:
+            raise Exception('ERROR: samtools is needed to save a compressed '
+                            'version of the results. Check '
+                            'http://samtools.sourceforge.net/ \n')
 
     # define filter codes
     filter_keys = OrderedDict()
@@ -245,17 +283,24 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
     output = ''
 
     # write header
-    output += ("\t".join(("@HD" ,"VN:1.5", "SO:queryname")) + '\n')
-    fhandler = open(infile)
-    line = next(fhandler)
-    # chromosome lengths
-    pos_fh = 0
-
-    while line.startswith('#'):
-        (_, _, cr, ln) = line.replace("\t", " ").strip().split(" ")
-        output += ("\t".join(("@SQ", "SN:" + cr, "LN:" + ln)) + '\n')
-        pos_fh += len(line)
+    output += ("\t".join(("@HD" ,"VN:1.5", "SO:queryname" if samtools else
+                          "SO:coordinate")) + '\n')
+    if is_pairs(infile):
+        fhandler = iter_pairs_lines(infile)
+        for cr, ln in read_pairs_index(infile)['chromosomes'].items():
+            output += ("\t".join(("@SQ", "SN:" + cr, "LN:%d" % ln)) + '\n')
+    else:
+        fhandler = open(infile)
         line = next(fhandler)
+        # chromosome lengths
+        pos_fh = 0
+
+        while line.startswith('#'):
+            (_, _, cr, ln) = line.replace("\t", " ").strip().split(" ")
+            output += ("\t".join(("@SQ", "SN:" + cr, "LN:" + ln)) + '\n')
+            pos_fh += len(line)
+            line = next(fhandler)
+        fhandler.seek(pos_fh)
 
     # filter codes
     for i in filter_keys:
@@ -279,9 +324,86 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
     output += ("\t".join(("@CO" ,"S2:i", "Strand of the 2nd read-end  (1: positive, 0: negative)\n")))
 
     # open and init filter files
-    if not valid:
-        filter_line, filter_handler = get_filters(infile, masked)
-    fhandler.seek(pos_fh)
+    filter_line, filter_handler = {}, {}
+    filters = [k for k in (masked or {}) if 'fnam' in masked[k]]
+    bitmask = filter_bitmask(masked, filters) if masked and not valid else None
+    if bitmask:
+        flagged_lines = _flag_lines_bitmask(fhandler, bitmask, filters)
+    else:
+        if not valid:
+            filter_line, filter_handler = get_filters(infile, masked)
+        flagged_lines = _flag_lines(fhandler, filter_line, filter_handler,
+                                    filter_keys)
+
+    if samtools:
+        _write_samtools_bam(flagged_lines, output, frmt, ncpus, outbam,
+                            samtools)
+    else:
+        _write_pysam_bam(flagged_lines, output, frmt, ncpus, outbam,
+                         max_reads)
+
+    # close file handlers
+    fhandler.close()
+    for i in filter_handler:
+        filter_handler[i].close()
+
+
+def _flag_lines(fhandler, filter_line, filter_handler, filter_keys):
+    """
+    Yields each line of the file of contacts with its filtering flag, the
+    sum of the codes of the filters listing its read (filter files are
+    sorted as the file of contacts).
+    """
+    for line in fhandler:
+        flag = 0
+        # check if read matches any filter
+        rid = line.split("\t")[0]
+        for i in filter_line:
+            if filter_line[i] == rid:
+                flag += filter_keys[i]
+                try:
+                    filter_line[i] = next(filter_handler[i]).strip()
+                except StopIteration:
+                    pass
+        yield line, flag
+
+
+def _flag_lines_bitmask(fhandler, bitmask, filters, chunk_size=1000000):
+    """
+    Yields each line of the file of contacts with its filtering flag, taken
+    from the bitmask of filters generated by
+    :func:`pytadbit.mapping.filter.filter_reads` (same codes as in BAM).
+    """
+    bits = 0
+    for k in filters:
+        bits |= 1 << (k - 1)
+    flags = np.load(bitmask, mmap_mode='r')
+    pos = 0
+    while True:
+        lines = list(islice(fhandler, chunk_size))
+        if not lines:
+            break
+        if pos + len(lines) > len(flags):
+            raise Exception('ERROR: bitmask of filters does not match the '
+                            'file of contacts')
+        for line, flag in zip(lines, (flags[pos:pos + len(lines)] & bits).tolist()):
+            yield line, flag
+        pos += len(lines)
+
+
+def _get_map2sam(frmt):
+    if frmt == 'mid':
+        return _map2sam_mid
+    elif frmt == 'long':
+        return _map2sam_long
+    return _map2sam_short
+
+
+def _write_samtools_bam(flagged_lines, header, frmt, ncpus, outbam, samtools):
+    """
+    Writes contacts in SAM format to samtools, that compresses, sorts and
+    indexes the BAM.
+    """
     # check samtools version number and modify command line
     version = LooseVersion([l.split()[1]
                             for l in Popen(samtools, stderr=PIPE,
@@ -293,44 +415,116 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
         ncpus, ncpus, pre,
         outbam + '.bam' if  version >= LooseVersion('1.3') else ''),  # in new version '.bam' is no longer added
                  shell=True, stdin=PIPE, universal_newlines=True)
-    proc.stdin.write(output)
-    if frmt == 'mid':
-        map2sam = _map2sam_mid
-    elif frmt == 'long':
-        map2sam = _map2sam_long
-    else:
-        map2sam = _map2sam_short
-
-    if valid:
-        for line in fhandler:
-            flag = 0
-            # get output in sam format
-            proc.stdin.write(map2sam(line, flag))
-    else:
-        for line in fhandler:
-            flag = 0
-            # check if read matches any filter
-            rid = line.split("\t")[0]
-            for i in filter_line:
-                if filter_line[i] == rid:
-                    flag += filter_keys[i]
-                    try:
-                        filter_line[i] = next(filter_handler[i]).strip()
-                    except StopIteration:
-                        pass
-            # get output in sam format
-            proc.stdin.write(map2sam(line, flag))
+    proc.stdin.write(header)
+    map2sam = _get_map2sam(frmt)
+    for line, flag in flagged_lines:
+        # get output in sam format
+        proc.stdin.write(map2sam(line, flag))
     proc.stdin.close()
     proc.wait()
 
     # Index BAM
     _ = Popen(samtools + ' index %s.bam' % (outbam), shell=True, universal_newlines=True).communicate()
 
-    # close file handlers
-    fhandler.close()
-    if not valid:
-        for i in filter_handler:
-            filter_handler[i].close()
+
+_BAM_WRITER = {}
+
+
+def _init_bam_writer(header, frmt):
+    """
+    Initializes a process formatting and sorting runs of contacts.
+    """
+    _BAM_WRITER.clear()
+    _BAM_WRITER.update({'header' : pysam.AlignmentHeader.from_text(header),
+                        'map2sam': _get_map2sam(frmt)})
+
+
+def _write_sorted_run(lines, flags, fname):
+    """
+    Converts contacts to reads (in a process initialized with
+    _init_bam_writer), sorts them by coordinate and writes them in an
+    uncompressed BAM file.
+    """
+    header  = _BAM_WRITER['header']
+    map2sam = _BAM_WRITER['map2sam']
+    reads = [pysam.AlignedSegment.fromstring(sam, header)
+             for line, flag in zip(lines, flags)
+             for sam in map2sam(line, flag).splitlines()]
+    reads.sort(key=_read_position)  # stable: input order kept for ties
+    out = AlignmentFile(fname, 'wb0', header=header)
+    for read in reads:
+        out.write(read)
+    out.close()
+    return fname
+
+
+def _read_position(read):
+    return read.reference_id, read.reference_start
+
+
+def _merge_sorted_runs(fnames, outfile, header, threads=1, mode='wb'):
+    """
+    Merges BAM files sorted by coordinate into one. Ties are kept in the
+    order of the input files.
+    """
+    runs = [AlignmentFile(fname, 'rb') for fname in fnames]
+    out = AlignmentFile(outfile, mode, header=header, threads=threads)
+    for read in heapq.merge(*runs, key=_read_position):
+        out.write(read)
+    out.close()
+    for run in runs:
+        run.close()
+    for fname in fnames:
+        os.remove(fname)
+
+
+def _write_pysam_bam(flagged_lines, header, frmt, ncpus, outbam, max_reads,
+                     max_open=256):
+    """
+    Writes contacts in a coordinate sorted and indexed BAM file using pysam.
+    Contacts are formatted and sorted in parallel by runs of max_reads, and
+    runs are merged (by groups of at most max_open files).
+    """
+    tmpdir = '%s_tmp_%016x' % (outbam, getrandbits(64))
+    mkdir(tmpdir)
+    pool = mu.Pool(ncpus, initializer=_init_bam_writer,
+                   initargs=(header, frmt))
+    procs = []
+    lines = []
+    flags = []
+    for line, flag in flagged_lines:
+        lines.append(line)
+        flags.append(flag)
+        if len(lines) < max_reads:
+            continue
+        # limit the number of runs waiting in memory
+        if len(procs) >= 2 * ncpus:
+            procs[-2 * ncpus].wait()
+        procs.append(pool.apply_async(_write_sorted_run, args=(
+            lines, flags, os.path.join(tmpdir, 'run_%d.bam' % len(procs)))))
+        lines = []
+        flags = []
+    if lines or not procs:
+        procs.append(pool.apply_async(_write_sorted_run, args=(
+            lines, flags, os.path.join(tmpdir, 'run_%d.bam' % len(procs)))))
+    pool.close()
+    pool.join()
+    fnames = [proc.get() for proc in procs]
+
+    header = pysam.AlignmentHeader.from_text(header)
+    level = 0
+    while len(fnames) > max_open:
+        merged = []
+        for i in range(0, len(fnames), max_open):
+            fname = os.path.join(tmpdir, 'merge_%d_%d.bam' % (level, i))
+            _merge_sorted_runs(fnames[i:i + max_open], fname, header,
+                               mode='wb0')
+            merged.append(fname)
+        fnames = merged
+        level += 1
+    _merge_sorted_runs(fnames, outbam + '.bam', header, threads=ncpus)
+    os.rmdir(tmpdir)
+    pysam.index(outbam + '.bam')
 
 
 def get_filters(infile, masked):
@@ -367,124 +561,112 @@ def get_filters(infile, masked):
     return filter_line, filter_handler
 
 
-def _read_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
-                   rand_hash, resolution, tmpdir, region, start, end,
-                   sum_columns=False):
-    bamfile = AlignmentFile(inbam, 'rb')
-    refs = bamfile.references
-    bam_start = start - START_ALIGNMENT
-    bam_start = max(0, bam_start)
-    try:
-        dico = {}
-        for r in bamfile.fetch(region=region,
-                               start=bam_start, end=end,  # coords starts at 0
-                               multiple_iterators=True):
-            if r.flag & filter_exclude:
-                continue
-            crm1 = r.reference_name
-            pos1 = r.reference_start + 1
-            crm2 = refs[r.mrnm]
-            pos2 = r.mpos + 1
-            try:
-                pos1 = sections1[(crm1, pos1 // resolution)]
-                pos2 = sections2[(crm2, pos2 // resolution)]
-            except KeyError:
-                continue  # not in the subset matrix we want
-            crm = crm1 * (crm1 == crm2)
-            try:
-                dico[(crm, pos1, pos2)] += 1
-            except KeyError:
-                dico[(crm, pos1, pos2)] = 1
-            # print '%-50s %5s %9s %5s %9s' % (r.query_name,
-            #                                  crm1, r.reference_start + 1,
-            #                                  crm2, r.mpos + 1)
-        out = open(os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                                '%s:%d-%d.tsv' % (region, start, end)), 'w')
-        out.write(''.join('%s\t%d\t%d\t%d\n' % (c, a, b, v)
-                          for (c, a, b), v in dico.items()))
-        out.close()
-        if sum_columns:
-            sumcol = {}
-            cisprc = {}
-            for (c, i, j), v in dico.items():
-                # out.write('%d\t%d\t%d\n' % (i, j, v))
-                try:
-                    sumcol[i] += v
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-                except KeyError:
-                    sumcol[i]  = v
-                    cisprc[i]  = [0, 0]
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-            return sumcol, cisprc
-    except Exception as e:
-        exc_type, exc_obj, exc_tb = exc_info()
-        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        print(e)
-        print(exc_type, fname, exc_tb.tb_lineno)
+def _matrix_frag_path(tmpdir, rand_hash, region, start, end):
+    return os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
+                        '%s:%d-%d.npy' % (region, start, end))
 
 
-def _read_half_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
-                        rand_hash, resolution, tmpdir, region, start, end,
-                        sum_columns=False):
-    bamfile = AlignmentFile(inbam, 'rb')
+def _write_matrix_frag(dico, tmpdir, rand_hash, region, start, end):
+    """
+    Writes the interactions of a chunk of the BAM file as a binary array of
+    int32 with one row per pixel and 4 columns: row, column, whether the
+    interaction is intra-chromosomal, and count.
+    """
+    pixels = np.empty((len(dico), 4), dtype=np.int32)
+    if dico:
+        pixels[:, :3] = list(dico.keys())
+        pixels[:, 3]  = list(dico.values())
+    np.save(_matrix_frag_path(tmpdir, rand_hash, region, start, end), pixels)
+
+
+_BAM_WORKER = {}
+
+
+def _init_bam_worker(inbam, filter_exclude, bins_pos1, bins_pos2, rand_hash,
+                     resolution, tmpdir):
+    """
+    Initializes a process reading chunks of a BAM file: opens the file, and
+    stores the parameters common to all chunks.
+
+    :param bins_pos1: dictionary with, for each chromosome of the rows of
+       the matrix, its first bin, its last bin (not included) and the shift
+       to add to a bin to get its index in the matrix
+    :param bins_pos2: same as bins_pos1 for the columns of the matrix
+    """
+    _BAM_WORKER.clear()
+    _BAM_WORKER.update({'bamfile'       : AlignmentFile(inbam, 'rb'),
+                        'filter_exclude': filter_exclude,
+                        'bins_pos1'     : bins_pos1,
+                        'bins_pos2'     : bins_pos2,
+                        'rand_hash'     : rand_hash,
+                        'resolution'    : resolution,
+                        'tmpdir'        : tmpdir})
+
+
+def _close_bam_worker():
+    _BAM_WORKER.pop('bamfile').close()
+
+
+def _read_bam_frag(region, start, end, sum_columns=False, half=False):
+    """
+    Reads the interactions of one chunk of the BAM file (in a process
+    initialized with _init_bam_worker) and writes them to disk.
+
+    :param False sum_columns: returns the sum of interactions per row, and
+       the sum of trans and cis interactions per row
+    :param False half: only keeps the upper half of the matrix
+    """
+    bamfile        = _BAM_WORKER['bamfile']
+    filter_exclude = _BAM_WORKER['filter_exclude']
+    bins_pos1      = _BAM_WORKER['bins_pos1']
+    bins_pos2      = _BAM_WORKER['bins_pos2']
+    resolution     = _BAM_WORKER['resolution']
     refs = bamfile.references
     bam_start = start - START_ALIGNMENT
     bam_start = max(0, bam_start)
-    section_pos = []
-    for sec in sections1:
-        if sec not in section_pos:
-            section_pos.append(sec[0])
-    for sec in sections2:
-        if sec not in section_pos:
-            section_pos.append(sec[0])
     try:
         dico = {}
         for r in bamfile.fetch(region=region,
-                               start=bam_start, end=end,  # coords starts at 0
-                               multiple_iterators=True):
+                               start=bam_start, end=end):  # coords starts at 0
             if r.flag & filter_exclude:
                 continue
             crm1 = r.reference_name
-            pos1 = r.reference_start + 1
             crm2 = refs[r.mrnm]
-            pos2 = r.mpos + 1
             try:
-                pos1 = sections1[(crm1, pos1 // resolution)]
-                pos2 = sections2[(crm2, pos2 // resolution)]
+                beg1, end1, shift1 = bins_pos1[crm1]
+                beg2, end2, shift2 = bins_pos2[crm2]
             except KeyError:
                 continue  # not in the subset matrix we want
-            if crm1 == crm2:
-                crm = crm1
-                if pos1 > pos2:
-                    continue
-            else:
-                if pos1 > pos2:
-                    continue
-                crm = ''
+            pos1 = (r.reference_start + 1) // resolution
+            pos2 = (r.mpos + 1) // resolution
+            if not (beg1 <= pos1 < end1 and beg2 <= pos2 < end2):
+                continue  # not in the subset matrix we want
+            pos1 += shift1
+            pos2 += shift2
+            if half and pos1 > pos2:
+                continue
+            key = (pos1, pos2, crm1 == crm2)
             try:
-                dico[(crm, pos1, pos2)] += 1
+                dico[key] += 1
             except KeyError:
-                dico[(crm, pos1, pos2)] = 1
+                dico[key] = 1
             # print '%-50s %5s %9s %5s %9s' % (r.query_name,
             #                                  crm1, r.reference_start + 1,
             #                                  crm2, r.mpos + 1)
-        out = open(os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                                '%s:%d-%d.tsv' % (region, start, end)), 'w')
-        out.write(''.join('%s\t%d\t%d\t%d\n' % (c, a, b, v)
-                          for (c, a, b), v in dico.items()))
-        out.close()
+        _write_matrix_frag(dico, _BAM_WORKER['tmpdir'],
+                           _BAM_WORKER['rand_hash'], region, start, end)
         if sum_columns:
             sumcol = {}
             cisprc = {}
-            for (c, i, j), v in dico.items():
+            for (i, j, cis), v in dico.items():
                 # out.write('%d\t%d\t%d\n' % (i, j, v))
                 try:
                     sumcol[i] += v
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
+                    cisprc[i][cis] += v
                 except KeyError:
                     sumcol[i]  = v
                     cisprc[i]  = [0, 0]
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
+                    cisprc[i][cis] += v
             return sumcol, cisprc
     except Exception as e:
         exc_type, exc_obj, exc_tb = exc_info()
@@ -493,11 +675,21 @@ def _read_half_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
         print(exc_type, fname, exc_tb.tb_lineno)
 
 
+def _read_half_bam_frag(region, start, end, sum_columns=False):
+    return _read_bam_frag(region, start, end, sum_columns=sum_columns,
+                          half=True)
+
+
 def read_bam(inbam, filter_exclude, resolution, ncpus=8,
              region1=None, start1=None, end1=None,
              region2=None, start2=None, end2=None, nchunks=100,
              tmpdir='.', verbose=True, normalize=False, max_size=None,
-             chr_order=None, half=False):
+             chr_order=None, half=False, mcool=None):
+
+    if mcool and not find_zoomify([mcool], inbam, resolution, filter_exclude):
+        warn('WARNING: %s was not generated from %s at %d with these filters, '
+             'reading the BAM file' % (mcool, inbam, resolution))
+        mcool = None
 
     bamfile = AlignmentFile(inbam, 'rb')
     bam_refs = bamfile.references
@@ -560,71 +752,24 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
             end_bin1 = total
             end1 = total * resolution
 
-    # define chunks, using at most 100 sub-divisions of region1
-    total = end_bin1 - start_bin1
-    regs  = []
-    begs  = []
-    ends  = []
-
-    njobs = min(total, nchunks) + 1
-
-    nbins = total // njobs + 1
-    for i in range(start_bin1, end_bin1, nbins):
-        if i + nbins > end_bin1:  # make sure that we stop at the right place
-            nbins = end_bin1 - i
-        try:
-            (crm1, beg1), (crm2, fin2) = bins[i], bins[i + nbins - 1]
-        except IndexError:
-            (crm1, beg1), (crm2, fin2) = bins[i], bins[-1]
-        if crm1 != crm2:
-            fin1 = sections[crm1]
-            regs.append(crm1)
-            begs.append(beg1 * resolution)
-            ends.append(fin1 * resolution + resolution)  # last nt included
-            # be sure we don't miss regions in between the start and end bins
-            start_chunk = i+fin1-beg1
-            end_chunk = i + nbins - 1 if i + nbins - 1 < len(bins) else len(bins) - 1
-            (crm1, beg1) = bins[start_chunk]
-            fin1 = beg1
-            for j in range(start_chunk, end_chunk+1):
-                (crm2, beg2) = bins[j]
-                if crm1 == crm2:
-                    fin1 = beg2
-                    continue
-                regs.append(crm1)
-                begs.append(beg1 * resolution)
-                fin1 = sections[crm1]
-                ends.append(fin1 * resolution + resolution - 1)  # last nt not included (overlap with next window)
-                (crm1, beg1) = (crm2, beg2)
-            regs.append(crm1)
-            begs.append(beg1 * resolution)
-            ends.append(fin1 * resolution + resolution - 1)  # last nt not included (overlap with next window)
-        else:
-            regs.append(crm1)
-            begs.append(beg1 * resolution)
-            ends.append(fin2 * resolution + resolution - 1)
+    # define chunks, using around nchunks sub-divisions of region1 with
+    # similar number of reads
+    regs, begs, ends, weights = _balanced_chunks(
+        bamfile, sections, section_pos, start_bin1, end_bin1, resolution,
+        nchunks)
     ends[-1] += 1  # last nucleotide included
-    # reduce dictionaries
-    all_bins = []
-    seenbins = set()
-    for crm in regions:
-        beg_crm = section_pos[crm][0]
-        if region1:
-            start = start_bin1 - beg_crm
-            end   = end_bin1   - beg_crm
-        else:
-            start = 0
-            end   = section_pos[crm][1] - section_pos[crm][0]
-        all_bins.extend([(crm, i) for i in range(start, end)
-                          if not (crm, i) in seenbins])
-        seenbins = set(all_bins)
-    del(seenbins)
-
-    bins_dict1 = dict((j, i) for i, j in enumerate(all_bins))
+    # first bin, last bin (not included), and shift to the matrix index of
+    # the bins of each chromosome
+    if region1:
+        beg_crm = section_pos[region1][0]
+        bins_pos1 = {region1: (start_bin1 - beg_crm, end_bin1 - beg_crm,
+                               beg_crm - start_bin1)}
+    else:
+        bins_pos1 = dict((crm, (0, sections[crm], section_pos[crm][0]))
+                         for crm in sections)
     if region2:
         if not region2 in section_pos:
             raise Exception('ERROR: chromosome %s not found' % region2)
-        bins = []
         beg_crm = section_pos[region2][0]
         if start2 is not None:
             start_bin2 = section_pos[region2][0] + start2 // resolution
@@ -636,14 +781,12 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
         else:
             end_bin2   = section_pos[region2][1]
             end2       = sections[region2] * resolution
-        start = start_bin2 - beg_crm
-        end   = end_bin2   - beg_crm
-        bins = [(region2, i) for i in range(start, end)]
-        bins_dict2 = dict([(j, i) for i, j in enumerate(bins)])
+        bins_pos2 = {region2: (start_bin2 - beg_crm, end_bin2 - beg_crm,
+                               beg_crm - start_bin2)}
     else:
         start_bin2 = start_bin1
         end_bin2 = end_bin1
-        bins_dict2 = bins_dict1
+        bins_pos2 = bins_pos1
 
     size1 = end_bin1 - start_bin1
     size2 = end_bin2 - start_bin2
@@ -653,40 +796,333 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
         raise Exception(('ERROR: matrix too large ({0}x{1}) should be at most '
                          '{2}x{2}').format(size1, size2, int(max_size**0.5)))
 
-    pool = mu.Pool(ncpus)
     # create random hash associated to the run:
     rand_hash = "%016x" % getrandbits(64)
 
     ## RUN!
+    mkdir(os.path.join(tmpdir, '_tmp_%s' % (rand_hash)))
+    if mcool:
+        if verbose:
+            printime('\n  - Reading pixels from %s' % (mcool))
+        _read_mcool_frags(mcool, resolution, bins_pos1, bins_pos2,
+                          (regs, begs, ends), rand_hash, tmpdir, half=half)
+        bin_coords = start_bin1, end_bin1, start_bin2, end_bin2
+        chunks = regs, begs, ends
+        return regions, rand_hash, bin_coords, chunks
     if verbose:
         printime('\n  - Parsing BAM (%d chunks)' % (len(regs)))
-    mkdir(os.path.join(tmpdir, '_tmp_%s' % (rand_hash)))
-    # empty all_bins array if we are not going to normalize
-    if not normalize:
-        all_bins = []
-    procs = []
     read_bam_frag = _read_half_bam_frag if half else _read_bam_frag
-    for i, (region, b, e) in enumerate(zip(regs, begs, ends)):
-        if ncpus == 1:
-            read_bam_frag(inbam, filter_exclude, all_bins,
-                          bins_dict1, bins_dict2, rand_hash,
-                          resolution, tmpdir, region, b, e)
-        else:
-            procs.append(pool.apply_async(
-                read_bam_frag, args=(inbam, filter_exclude, all_bins,
-                                     bins_dict1, bins_dict2, rand_hash,
-                                     resolution, tmpdir, region, b, e,)))
-    pool.close()
-    if verbose:
-        print_progress(procs)
-    pool.join()
+    initargs = (inbam, filter_exclude, bins_pos1, bins_pos2, rand_hash,
+                resolution, tmpdir)
+    _run_bam_frags(read_bam_frag, initargs, (regs, begs, ends), weights,
+                   ncpus, verbose)
     bin_coords = start_bin1, end_bin1, start_bin2, end_bin2
     chunks = regs, begs, ends
     return regions, rand_hash, bin_coords, chunks
 
 
-def _iter_matrix_frags(chunks, tmpdir, rand_hash, clean=False, verbose=True,
-                       include_chunk_count=False):
+def _read_mcool_frags(mcool, resolution, bins_pos1, bins_pos2, chunks,
+                      rand_hash, tmpdir, half=False):
+    """
+    Writes the sub-matrices of each chunk, as _read_bam_frag does, but taking
+    the interactions from a multi-resolution cooler generated by zoomify
+    instead of from the BAM file.
+    """
+    # only the rows and columns of the wanted regions are read (overlapping
+    # regions merged, so that each stored pixel is read once)
+    ranges = {}
+    for bins_pos in (bins_pos1, bins_pos2):
+        for crm, (beg, end, _) in bins_pos.items():
+            ranges.setdefault(crm, []).append((beg, end))
+    for crm, limits in ranges.items():
+        merged = []
+        for beg, end in sorted(limits):
+            if merged and beg <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((beg, end))
+        ranges[crm] = merged
+    names, chrom_offset, bin1, bin2, counts = parse_pixels(
+        mcool, resolution, ranges)
+    # the cooler stores the upper half of the matrix, add the lower one
+    lower = bin1 != bin2
+    bin1, bin2 = (np.concatenate((bin1, bin2[lower])),
+                  np.concatenate((bin2, bin1[lower])))
+    counts = np.concatenate((counts, counts[lower]))
+    # chromosome and position of each bin, as in _read_bam_frag
+    crm1 = np.searchsorted(chrom_offset, bin1, side='right') - 1
+    crm2 = np.searchsorted(chrom_offset, bin2, side='right') - 1
+    loc1 = bin1 - chrom_offset[crm1]
+    loc2 = bin2 - chrom_offset[crm2]
+    keep = np.ones(len(counts), dtype=bool)
+    shifts = []
+    for crm, loc, bins_pos in ((crm1, loc1, bins_pos1),
+                               (crm2, loc2, bins_pos2)):
+        beg, end, shift = np.zeros((3, len(names)), dtype=np.int64)
+        for i, name in enumerate(names):
+            if name in bins_pos:
+                beg[i], end[i], shift[i] = bins_pos[name]
+        keep &= (beg[crm] <= loc) & (loc < end[crm])
+        shifts.append(shift[crm])
+    pos1 = loc1 + shifts[0]
+    pos2 = loc2 + shifts[1]
+    if half:
+        keep &= pos1 <= pos2
+    cis = crm1 == crm2
+    # sort by chromosome and bin of the rows, to split them in chunks
+    max_bin = chrom_offset[-1] + 1
+    rows = (crm1 * max_bin + loc1)[keep]
+    pos1, pos2, cis, counts = pos1[keep], pos2[keep], cis[keep], counts[keep]
+    order = np.lexsort((pos2, rows))
+    rows, pos1, pos2, cis, counts = (rows[order], pos1[order], pos2[order],
+                                     cis[order], counts[order])
+    for region, start, end in zip(*chunks):
+        crm = names.index(region) * max_bin
+        beg = np.searchsorted(rows, crm + start // resolution)
+        fin = np.searchsorted(rows, crm + (end + 1) // resolution)
+        pixels = np.empty((fin - beg, 4), dtype=np.int32)
+        pixels[:, 0] = pos1[beg:fin]
+        pixels[:, 1] = pos2[beg:fin]
+        pixels[:, 2] = cis[beg:fin]
+        pixels[:, 3] = counts[beg:fin]
+        np.save(_matrix_frag_path(tmpdir, rand_hash, region, start, end),
+                pixels)
+
+
+def _sum_pixels(keys, values):
+    """
+    Sums the values of the pixels sharing the same key.
+
+    :returns: the sorted unique keys, and the sum of their values
+    """
+    keys, idx = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(idx, weights=values).astype(np.int64)
+
+
+def zoomify(inbam, resolutions, outcool,
+            filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10), ncpus=8, nchunks=100,
+            tmpdir='.', clean=True, verbose=True):
+    """
+    Writes a multi-resolution cooler from a BAM file containing interacting
+    reads. The BAM is parsed only once, at the finest resolution, and the
+    pixels of the coarser resolutions are obtained by summing finer pixels.
+
+    The cooler keeps track of the BAM file and of the filters used, so that
+    :func:`read_bam` (and the functions using it) can take the interactions
+    from it instead of parsing the BAM again.
+
+    Note: reads mapped on the very last nucleotide of a chromosome whose
+    length is a multiple of the resolution are counted in the last bin of
+    the chromosome (cooler bins do not go beyond chromosome ends).
+
+    :param inbam: path to BAM file (generated by TADbit)
+    :param resolutions: list of resolutions, all of them should be multiples
+       of the smallest one
+    :param outcool: path to the multi-resolution cooler file to be created
+       (overwritten if it exists)
+    :param (1, 2, 3, 4, 6, 7, 8, 9, 10) filter exclude: filters to define the
+       set of valid pair of reads.
+    :param 8 ncpus: number of cpus to use to read the BAM file
+    :param 100 nchunks: maximum number of chunks into which to cut the BAM
+    :param '.' tmpdir: where to write temporary files
+    :param True clean: remove temporary files
+    :param True verbose: speak
+
+    :returns: path to the cooler file
+    """
+    if 'h5py' not in modules:
+        raise Exception('ERROR: cooler output is not available. Probably ' +
+                        'you need to install h5py\n')
+    resolutions = sorted(set(resolutions))
+    finest = resolutions[0]
+    if any(reso % finest for reso in resolutions):
+        raise Exception('ERROR: all resolutions should be multiples of %d' % (
+            finest))
+    if not isinstance(filter_exclude, int):
+        filter_exclude = filters_to_bin(filter_exclude)
+
+    bamfile = AlignmentFile(inbam, 'rb')
+    sections = OrderedDict(list(zip(bamfile.references,
+                                    [x for x in bamfile.lengths])))
+    bamfile.close()
+
+    # for each resolution, index in the cooler of each bin of the finest
+    # resolution (as numbered by read_bam)
+    lookups = {}
+    nbins = {}
+    for reso in resolutions:
+        lookup = []
+        total = 0
+        for crm in sections:
+            nbin = -(-sections[crm] // reso)
+            pos = np.arange(sections[crm] // finest + 1) * finest // reso
+            lookup.append(total + np.minimum(pos, nbin - 1))
+            total += nbin
+        lookups[reso] = np.concatenate(lookup)
+        nbins[reso] = total
+
+    _, rand_hash, _, chunks = read_bam(
+        inbam, filter_exclude, finest, ncpus=ncpus, tmpdir=tmpdir,
+        nchunks=nchunks, verbose=verbose, half=True)
+
+    if verbose:
+        printime('  - Summing pixels')
+    pixels = dict((reso, ([], [])) for reso in resolutions)
+    for _, rows, cols, values, _ in _iter_matrix_arrays(
+            chunks, tmpdir, rand_hash, clean=clean, verbose=verbose):
+        for reso in resolutions:
+            bin1 = lookups[reso][rows]
+            bin2 = lookups[reso][cols]
+            # both halves of the matrix fall in the diagonal
+            vals = np.where((bin1 == bin2) & (rows != cols), 2 * values,
+                            values)
+            keys, sums = _sum_pixels(bin1 * nbins[reso] + bin2, vals)
+            pixels[reso][0].append(keys)
+            pixels[reso][1].append(sums)
+    if clean:
+        os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
+
+    if os.path.exists(outcool):
+        os.remove(outcool)
+    for reso in resolutions:
+        if verbose:
+            printime('  - Writing %s resolution' % (nicer(reso)))
+        keys, sums = pixels.pop(reso)
+        keys, sums = _sum_pixels(np.concatenate(keys), np.concatenate(sums))
+        out = cooler_file(outcool, reso, sections, list(sections))
+        out.create_bins()
+        out.prepare_matrix()
+        out.write_pixels(keys // nbins[reso], keys % nbins[reso], sums)
+        out.close()
+    write_attrs(outcool, {'tadbit-bam'           : os.path.basename(inbam),
+                          'tadbit-bam-size'      : os.path.getsize(inbam),
+                          'tadbit-filter-exclude': filter_exclude})
+    return outcool
+
+
+def find_zoomify(mcools, inbam, resolution, filter_exclude):
+    """
+    Searches, in a list of multi-resolution coolers, one generated by
+    zoomify from a given BAM file, with the same filters, and containing the
+    wanted resolution.
+
+    :param mcools: list of paths to cooler files
+    :param inbam: path to BAM file (generated by TADbit)
+    :param resolution: wanted resolution
+    :param filter_exclude: filters to define the set of valid pair of reads.
+
+    :returns: path to the cooler file, None if not found
+    """
+    if not isinstance(filter_exclude, int):
+        filter_exclude = filters_to_bin(filter_exclude)
+    for mcool in mcools:
+        try:
+            attrs = read_attrs(mcool)
+        except (IOError, OSError, NameError):  # NameError: no h5py
+            continue
+        if (attrs.get('tadbit-bam') == os.path.basename(inbam) and
+            attrs.get('tadbit-bam-size') == os.path.getsize(inbam) and
+            attrs.get('tadbit-filter-exclude') == filter_exclude and
+            is_cooler(mcool, resolution)):
+            return mcool
+    return None
+
+
+def _run_bam_frags(read_bam_frag, initargs, chunks, weights, ncpus=8,
+                   verbose=True):
+    """
+    Parses chunks of a BAM file, largest chunks first, each process opening
+    the BAM file once (see _init_bam_worker).
+    """
+    regs, begs, ends = chunks
+    order = sorted(range(len(regs)), key=lambda i: -weights[i])
+    if ncpus == 1:
+        _init_bam_worker(*initargs)
+        for i in order:
+            read_bam_frag(regs[i], begs[i], ends[i])
+        _close_bam_worker()
+    else:
+        pool = mu.Pool(ncpus, initializer=_init_bam_worker, initargs=initargs)
+        procs = [pool.apply_async(read_bam_frag, args=(regs[i], begs[i], ends[i]))
+                 for i in order]
+        pool.close()
+        if verbose:
+            print_progress(procs, weights=[weights[i] for i in order])
+        pool.join()
+
+
+def _balanced_chunks(bamfile, sections, section_pos, start_bin, end_bin,
+                     resolution, nchunks):
+    """
+    Cuts a genomic region in chunks with similar number of reads. The number
+    of reads per chromosome is taken from the statistics of the BAM index
+    (reads are considered uniformly distributed inside chromosomes).
+    Chromosomes missing from the index statistics are given the mean number
+    of reads per bin of the others (all chromosomes are weighted by their
+    number of bins if none is found).
+
+    :param bamfile: pysam AlignmentFile
+    :param sections: dictionary with chromosome names and number of bins
+    :param section_pos: dictionary with chromosome names and their first and
+       last bin in the genome
+    :param start_bin: first bin of the region
+    :param end_bin: last bin of the region (not included)
+    :param resolution: bin size
+    :param nchunks: approximate number of chunks wanted
+
+    :returns: lists of chromosome names, start and end positions of each
+       chunk, and the estimated number of reads in each chunk
+    """
+    try:
+        nreads = dict((s.contig, s.mapped)
+                      for s in bamfile.get_index_statistics())
+    except (AttributeError, ValueError):  # old pysam or no index
+        nreads = {}
+    # mean number of reads per bin, for chromosomes without statistics
+    known = [crm for crm in sections if crm in nreads]
+    nbins = sum(sections[crm] for crm in known)
+    reads_per_bin = (float(sum(nreads[crm] for crm in known)) / nbins
+                     if nbins else 1.)
+    # parts of each chromosome inside the region
+    segments = []
+    for crm in sections:
+        beg = max(start_bin, section_pos[crm][0])
+        end = min(end_bin, section_pos[crm][1])
+        if beg >= end:
+            continue
+        if crm in nreads:
+            weight = (end - beg) * nreads[crm] / float(sections[crm])
+        else:
+            weight = (end - beg) * reads_per_bin
+        segments.append((crm, beg - section_pos[crm][0],
+                         end - section_pos[crm][0], weight))
+    total = sum(w for _, _, _, w in segments)
+    target = total / nchunks if total else None
+    regs    = []
+    begs    = []
+    ends    = []
+    weights = []
+    for crm, beg, end, weight in segments:
+        nsplit = int(round(weight / target)) if target else 1
+        nsplit = max(1, min(end - beg, nsplit))
+        limits = [beg + (end - beg) * k // nsplit for k in range(nsplit + 1)]
+        for beg1, end1 in zip(limits[:-1], limits[1:]):
+            regs.append(crm)
+            begs.append(beg1 * resolution)
+            ends.append(end1 * resolution - 1)  # last nt not included (overlap with next window)
+            weights.append(weight * (end1 - beg1) / (end - beg))
+    return regs, begs, ends, weights
+
+
+def _iter_matrix_arrays(chunks, tmpdir, rand_hash, clean=False,
+                        verbose=True):
+    """
+    Iterates over the sub-matrices written by read_bam, one chunk at a time.
+
+    :yields: the chromosome read in the chunk, and the arrays of rows,
+       columns, values, and of booleans set to True for intra-chromosomal
+       interactions
+    """
     if verbose:
         stdout.write('     ')
     countbin = 0
@@ -699,23 +1135,48 @@ def _iter_matrix_frags(chunks, tmpdir, rand_hash, clean=False, verbose=True,
             stdout.write('.')
             stdout.flush()
 
-        fname = os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                             '%s:%d-%d.tsv' % (region, start, end))
-        if include_chunk_count:
-            for l in open(fname):
-                c, a, b, v = l.split('\t')
-                yield countbin, c, int(a), int(b), int(v)
-        else:
-            for l in open(fname):
-                c, a, b, v = l.split('\t')
-                yield c, int(a), int(b), int(v)
+        fname = _matrix_frag_path(tmpdir, rand_hash, region, start, end)
+        pixels = np.load(fname)
+        yield (region, pixels[:, 0], pixels[:, 1], pixels[:, 3],
+               pixels[:, 2].astype(bool))
         if clean:
-            os.system('rm -f %s' % fname)
+            os.remove(fname)
     if verbose:
         print('%s %9s\n' % (' ' * (54 - (countbin % 50) - (countbin % 50) // 10),
                             '%s/%s' % (len(chunks[0]),len(chunks[0]))))
 
 
+def _iter_matrix_frags(chunks, tmpdir, rand_hash, clean=False, verbose=True,
+                       include_chunk_count=False):
+    for countbin, (region, rows, cols, values, cis) in enumerate(
+            _iter_matrix_arrays(chunks, tmpdir, rand_hash, clean=clean,
+                                verbose=verbose)):
+        crms = ('', region)
+        for a, b, v, c in zip(rows.tolist(), cols.tolist(), values.tolist(),
+                              cis.tolist()):
+            if include_chunk_count:
+                yield countbin, crms[c], a, b, v
+            else:
+                yield crms[c], a, b, v
+
+
+def _not_bad(bins, bads):
+    """
+    :returns: boolean array, True for the bins that are not in bads
+    """
+    if not bads:
+        return np.ones(len(bins), dtype=bool)
+    return ~np.isin(bins, np.fromiter(bads, dtype=np.int64, count=len(bads)))
+
+
+def _bias_array(bias):
+    """
+    :returns: biases stored in a dictionary (bin -> bias) as an array
+    """
+    return np.array([bias.get(b, float('nan'))
+                     for b in range(max(bias) + 1 if bias else 0)])
+
+
 def get_biases_region(biases, bin_coords, check_resolution=None):
     """
     Retrieve biases, decay, and bad bins from a dictionary, and re-index it
@@ -752,12 +1213,227 @@ def get_biases_region(biases, bin_coords, check_resolution=None):
     return bias1, bias2, decay, bads1, bads2
 
 
+class BAMTileCache(object):
+    """
+    Least recently used cache of the interactions read from TADbit BAM
+    files. Interactions are stored in tiles, each tile holding the
+    interactions of a given number of consecutive bins of a chromosome with
+    the whole genome. Queries on overlapping regions are thus assembled from
+    the tiles already read, and only the missing tiles are read from the BAM.
+
+    Tiles are identified by the path, modification time and size of the BAM
+    file, the filters applied, the resolution, the chromosome and the
+    position of the tile.
+
+    :param 500 max_memory: maximum memory (in Mb) used by the cache, the
+       least recently used tiles are removed when it is exceeded
+    :param 100 tile_bins: number of bins (rows) per tile
+    :param None cache_dir: folder where to store the tiles on disk, to be
+       reused between sessions
+    """
+    def __init__(self, max_memory=500, tile_bins=100, cache_dir=None):
+        self.max_memory = max_memory * 1024**2
+        self.tile_bins = tile_bins
+        self.cache_dir = cache_dir
+        if cache_dir:
+            mkdir(cache_dir)
+        self._tiles = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def clear(self):
+        """
+        Removes all tiles from memory (not from disk)
+        """
+        self._tiles.clear()
+        self.nbytes = 0
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, '%s.npy' % md5(
+            repr(key).encode()).hexdigest())
+
+    def _add(self, key, tile):
+        self._tiles[key] = tile
+        self.nbytes += tile.nbytes
+        while self.nbytes > self.max_memory and len(self._tiles) > 1:
+            _, old = self._tiles.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def _get(self, key):
+        try:
+            tile = self._tiles.pop(key)  # moved to the end (most recent)
+            self._tiles[key] = tile
+            return tile
+        except KeyError:
+            pass
+        if self.cache_dir and os.path.exists(self._disk_path(key)):
+            tile = np.load(self._disk_path(key))
+            self._add(key, tile)
+            return tile
+        return None
+
+    def get_rows(self, inbam, filter_exclude, resolution, region, beg, end,
+                 ncpus=8, tmpdir='.', verbose=False):
+        """
+        Get the interactions of some consecutive bins of a chromosome with
+        the whole genome.
+
+        :param inbam: path to BAM file (generated by TADbit)
+        :param filter_exclude: filters to define the set of valid pair of
+           reads (as an integer, see filters_to_bin)
+        :param resolution: resolution of the bins
+        :param region: chromosome name
+        :param beg: first bin (in the chromosome)
+        :param end: last bin (in the chromosome, not included)
+        :param 8 ncpus: number of cpus to use to read the BAM file
+        :param '.' tmpdir: where to write temporary files
+        :param False verbose: speak
+
+        :returns: an array of int32 with one row per pixel and 4 columns:
+           the bin in the chromosome, the bin in the genome (in the order
+           of the BAM) of the interacting bin, whether the interaction is
+           intra-chromosomal, and count
+        """
+        stat = os.stat(inbam)
+        key = (os.path.realpath(inbam), stat.st_mtime, stat.st_size,
+               filter_exclude, resolution, region)
+        tiles = range(beg // self.tile_bins,
+                      (end - 1) // self.tile_bins + 1)
+        pixels = dict((t, self._get(key + (t, ))) for t in tiles)
+        missing = [t for t in tiles if pixels[t] is None]
+        self.hits += len(pixels) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            for t, tile in self._read_tiles(inbam, filter_exclude, resolution,
+                                            region, missing, ncpus, tmpdir,
+                                            verbose):
+                pixels[t] = tile
+                self._add(key + (t, ), tile)
+                if self.cache_dir:
+                    np.save(self._disk_path(key + (t, )), tile)
+        pixels = np.concatenate([pixels[t] for t in tiles])
+        return pixels[(beg <= pixels[:, 0]) & (pixels[:, 0] < end)]
+
+    def _read_tiles(self, inbam, filter_exclude, resolution, region, tiles,
+                    ncpus, tmpdir, verbose):
+        bamfile = AlignmentFile(inbam, 'rb')
+        sections = OrderedDict(list(zip(bamfile.references,
+                                        [x // resolution + 1
+                                         for x in bamfile.lengths])))
+        bamfile.close()
+        # rows in chromosome coordinates, columns in genomic coordinates
+        bins_pos2 = {}
+        total = 0
+        for crm in sections:
+            bins_pos2[crm] = (0, sections[crm], total)
+            total += sections[crm]
+        bins_pos1 = {region: (0, sections[region], 0)}
+        regs = []
+        begs = []
+        ends = []
+        for t in tiles:
+            regs.append(region)
+            begs.append(t * self.tile_bins * resolution)
+            ends.append(min((t + 1) * self.tile_bins, sections[region])
+                        * resolution - 1)
+        rand_hash = "%016x" % getrandbits(64)
+        mkdir(os.path.join(tmpdir, '_tmp_%s' % (rand_hash)))
+        initargs = (inbam, filter_exclude, bins_pos1, bins_pos2, rand_hash,
+                    resolution, tmpdir)
+        if verbose:
+            printime('  - Parsing BAM (%d tiles)' % (len(tiles)))
+        _run_bam_frags(_read_bam_frag, initargs, (regs, begs, ends),
+                       [1] * len(tiles), ncpus, verbose)
+        for t, start, end in zip(tiles, begs, ends):
+            fname = _matrix_frag_path(tmpdir, rand_hash, region, start, end)
+            yield t, np.load(fname)
+            os.remove(fname)
+        os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
+
+
+_TILE_CACHE = []
+
+
+def _default_tile_cache():
+    if not _TILE_CACHE:
+        _TILE_CACHE.append(BAMTileCache())
+    return _TILE_CACHE[0]
+
+
+def _cached_matrix_arrays(cache, inbam, filter_exclude, resolution,
+                          region1, start1, end1, region2, start2, end2,
+                          ncpus, tmpdir, max_size, chr_order, verbose):
+    """
+    Equivalent to read_bam followed by _iter_matrix_arrays, for a matrix
+    restricted to one or two chromosomes, but taking the interactions from
+    a BAMTileCache.
+    """
+    bamfile = AlignmentFile(inbam, 'rb')
+    sections = OrderedDict(list(zip(bamfile.references,
+                                    [x // resolution + 1
+                                     for x in bamfile.lengths])))
+    bamfile.close()
+    genome_pos = {}
+    total = 0
+    for crm in sections:
+        genome_pos[crm] = total
+        total += sections[crm]
+    # matrix coordinates as defined in read_bam
+    bam_refs = list(sections)
+    if chr_order:
+        bam_refs = [crm for crm in chr_order if crm in sections]
+        if not bam_refs:
+            raise Exception('''ERROR: Wrong number of chromosomes in chr_order.
+                Found %s in bam file \n''' % (' '.join(sections)))
+    section_pos = {}
+    total = 0
+    for crm in bam_refs:
+        section_pos[crm] = (total, total + sections[crm])
+        total += sections[crm]
+    if region2 and not region2 in section_pos:
+        raise Exception('ERROR: chromosome %s not found' % region2)
+    if not region2:
+        region2, start2, end2 = region1, start1, end1
+    bin_coords = []
+    for region, start, end in ((region1, start1, end1),
+                               (region2, start2, end2)):
+        beg_crm, end_crm = section_pos[region]
+        bin_coords.append(beg_crm + (start // resolution if start is not None
+                                     else 0))
+        bin_coords.append(beg_crm + end // resolution if end is not None
+                          else end_crm)
+    start_bin1, end_bin1, start_bin2, end_bin2 = bin_coords
+    size1 = end_bin1 - start_bin1
+    size2 = end_bin2 - start_bin2
+    if verbose:
+        printime('\n  (Matrix size %dx%d)' % (size1, size2))
+    if max_size and max_size < size1 * size2:
+        raise Exception(('ERROR: matrix too large ({0}x{1}) should be at most '
+                         '{2}x{2}').format(size1, size2, int(max_size**0.5)))
+    # first and last bins in the chromosomes
+    beg1 = start_bin1 - section_pos[region1][0]
+    end1 = end_bin1 - section_pos[region1][0]
+    beg2 = start_bin2 - section_pos[region2][0] + genome_pos[region2]
+    end2 = end_bin2 - section_pos[region2][0] + genome_pos[region2]
+    pixels = cache.get_rows(inbam, filter_exclude, resolution, region1, beg1,
+                            end1, ncpus=ncpus, tmpdir=tmpdir, verbose=verbose)
+    pixels = pixels[(beg2 <= pixels[:, 1]) & (pixels[:, 1] < end2)]
+    arrays = [(region1, pixels[:, 0] - beg1, pixels[:, 1] - beg2,
+               pixels[:, 3], pixels[:, 2].astype(bool))]
+    return tuple(bin_coords), arrays
+
+
 def get_matrix(inbam, resolution, biases=None,
                filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
                region1=None, start1=None, end1=None,
                region2=None, start2=None, end2=None, dico=None, clean=False,
                return_headers=False, tmpdir='.', normalization='raw', ncpus=8,
-               nchunks=100, verbose=False, max_size=None, chr_order=None):
+               nchunks=100, verbose=False, max_size=None, chr_order=None,
+               mcool=None, cache=None):
     """
     Get matrix from a BAM file containing interacting reads. The matrix
     will be extracted from the genomic BAM, the genomic coordinates of this
@@ -792,6 +1468,11 @@ def get_matrix(inbam, resolution, biases=None,
     :param 100 nchunks: maximum number of chunks into which to cut the BAM
     :param None max_size: maximum size of matrix to read
     :param None chr_order: chromosome order
+    :param None mcool: multi-resolution cooler generated by :func:`zoomify`
+       from the same BAM file, to read the interactions from
+    :param None cache: a :class:`BAMTileCache` to keep the interactions read
+       in memory, and to reuse them in following calls. If True, a cache
+       shared by all calls is used. Only used when region1 is defined
 
     :returns: dictionary with keys being tuples of the indexes of interacting
        bins: dico[(bin1, bin2)] = interactions
@@ -800,12 +1481,23 @@ def get_matrix(inbam, resolution, biases=None,
     if not isinstance(filter_exclude, int):
         filter_exclude = filters_to_bin(filter_exclude)
 
-    regions, rand_hash, bin_coords, chunks = read_bam(
-        inbam, filter_exclude, resolution, ncpus=ncpus,
-        region1=region1, start1=start1, end1=end1,
-        region2=region2, start2=start2, end2=end2,
-        tmpdir=tmpdir, nchunks=nchunks, verbose=verbose,
-        max_size=max_size, chr_order=chr_order)
+    if cache is True:
+        cache = _default_tile_cache()
+    if isinstance(cache, BAMTileCache) and region1 and not mcool:
+        bin_coords, matrix_arrays = _cached_matrix_arrays(
+            cache, inbam, filter_exclude, resolution,
+            region1, start1, end1, region2, start2, end2,
+            ncpus, tmpdir, max_size, chr_order, verbose)
+        rand_hash = None  # nothing to clean
+    else:
+        regions, rand_hash, bin_coords, chunks = read_bam(
+            inbam, filter_exclude, resolution, ncpus=ncpus,
+            region1=region1, start1=start1, end1=end1,
+            region2=region2, start2=start2, end2=end2,
+            tmpdir=tmpdir, nchunks=nchunks, verbose=verbose,
+            max_size=max_size, chr_order=chr_order, mcool=mcool)
+        matrix_arrays = _iter_matrix_arrays(chunks, tmpdir, rand_hash,
+                                            clean=clean, verbose=verbose)
 
     if region1:
         regions = [region1]
@@ -845,22 +1537,39 @@ def get_matrix(inbam, resolution, biases=None,
         raise NotImplementedError(('ERROR: %s normalization not implemented '
                                    'here') % normalization)
 
+    if normalization in ('norm', 'decay'):
+        bias_array1 = _bias_array(bias1)
+        bias_array2 = _bias_array(bias2)
+
     return_something = False
     if dico is None:
         return_something = True
-        dico = dict(((i, j), transform_value(c, i, j, v))
-                    for c, i, j, v in _iter_matrix_frags(
-                        chunks, tmpdir, rand_hash, clean=clean, verbose=verbose)
-                    if i not in bads1 and j not in bads2)
+        dico = {}
         # pull all sub-matrices and write full matrix
+        for region, rows, cols, values, cis in matrix_arrays:
+            keep = _not_bad(rows, bads1) & _not_bad(cols, bads2)
+            rows, cols, values, cis = rows[keep], cols[keep], values[keep], cis[keep]
+            if normalization == 'norm':
+                values = values / bias_array1[rows] / bias_array2[cols]
+            elif normalization == 'decay':
+                crms = ('', region)
+                values = [transform_value(crms[c], i, j, v) for i, j, v, c in
+                          zip(rows.tolist(), cols.tolist(), values.tolist(),
+                              cis.tolist())]
+            if not isinstance(values, list):
+                values = values.tolist()
+            dico.update(zip(zip(rows.tolist(), cols.tolist()), values))
     else: # dico probably an HiC data object
-        for _, i, j, v in _iter_matrix_frags(
-                chunks, tmpdir, rand_hash,
-                clean=clean, verbose=verbose):
-            if i not in bads1 and j not in bads2:
-                dico[i, j] = v
+        for _, rows, cols, values, _ in matrix_arrays:
+            keep = _not_bad(rows, bads1) & _not_bad(cols, bads2)
+            if hasattr(dico, '_update_coo'):
+                dico._update_coo(rows[keep], cols[keep], values[keep])
+            else:
+                for i, j, v in zip(rows[keep].tolist(), cols[keep].tolist(),
+                                   values[keep].tolist()):
+                    dico[i, j] = v
 
-    if clean:
+    if clean and rand_hash:
         os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
     if return_something:
         if return_headers:
@@ -896,7 +1605,7 @@ def write_matrix(inbam, resolution, biases, outdir,
                  region2=None, start2=None, end2=None, extra='',
                  half_matrix=True, nchunks=100, tmpdir='.', append_to_tar=None,
                  ncpus=8, cooler=False, cooler_name=None, row_names=False,
-                 chr_order=None, verbose=True):
+                 chr_order=None, verbose=True, mcool=None):
     """
     Writes matrix file from a BAM file containing interacting reads. The matrix
     will be extracted from the genomic BAM, the genomic coordinates of this
@@ -938,6 +1647,8 @@ def write_matrix(inbam, resolution, biases, outdir,
        WARNING: results in two extra columns
     :param None chr_order: chromosome order
     :param 100 nchunks: maximum number of chunks into which to cut the BAM
+    :param None mcool: multi-resolution cooler generated by :func:`zoomify`
+       from the same BAM file, to read the interactions from
 
     :returns: path to output files
     """
@@ -961,7 +1672,7 @@ def write_matrix(inbam, resolution, biases, outdir,
         region1=region1, start1=start1, end1=end1,
         region2=region2, start2=start2, end2=end2,
         tmpdir=tmpdir, nchunks=nchunks, chr_order=chr_order,
-        verbose=verbose, half=half_matrix)
+        verbose=verbose, half=half_matrix, mcool=mcool)
 
     if region1:
         regions = [region1]
@@ -1192,18 +1903,20 @@ def write_matrix(inbam, resolution, biases, outdir,
     if 'raw&decay' in normalizations and not cooler:
         write = write_raw_and_expc(write)
 
-    if cooler:
-        for ichunk, c, j, k, v in _iter_matrix_frags(chunks, tmpdir, rand_hash,
-                                                     verbose=verbose, clean=clean,
-                                                     include_chunk_count=True):
-            if j not in bads1 and k not in bads2:
+    for ichunk, (region, rows, cols, values, cis) in enumerate(
+            _iter_matrix_arrays(chunks, tmpdir, rand_hash, verbose=verbose,
+                                clean=clean)):
+        keep = _not_bad(rows, bads1) & _not_bad(cols, bads2)
+        rows, cols, values = rows[keep].tolist(), cols[keep].tolist(), values[keep].tolist()
+        if cooler:
+            for j, k, v in zip(rows, cols, values):
                 out_raw.write_iter(ichunk, j, k, v)
+        else:
+            crms = ('', region)
+            for j, k, v, c in zip(rows, cols, values, cis[keep].tolist()):
+                write(crms[c], j, k, v)
+    if cooler:
         out_raw.close()
-    else:
-        for c, j, k, v in _iter_matrix_frags(chunks, tmpdir, rand_hash,
-                                             verbose=verbose, clean=clean):
-            if j not in bads1 and k not in bads2:
-                write(c, j, k, v)
 
     fnames = {}
     if append_to_tar:
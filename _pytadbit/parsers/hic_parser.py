@@ -12,6 +12,7 @@ from io                              import IOBase
 from collections                     import OrderedDict
 from warnings                        import warn
 from math                            import sqrt, isnan
+import os
 try:
     from pickle5                     import load  # python < 3.8
 except ImportError:
@@ -21,8 +22,10 @@ from pysam                           import AlignmentFile
 
 import numpy as np
 from pytadbit.parsers.gzopen         import gzopen
-from pytadbit                        import HiC_data
-from pytadbit.parsers.hic_bam_parser import get_matrix
+from pytadbit                        import HiC_data, SparseHiC_data
+from pytadbit                        import MmapHiC_data
+from pytadbit.parsers.hic_bam_parser import get_matrix, read_bam, filters_to_bin
+from pytadbit.parsers.hic_bam_parser import _iter_matrix_arrays
 try:
     from pytadbit.parsers.cooler_parser import parse_cooler, is_cooler
 except ImportError:
@@ -554,7 +557,8 @@ def load_hic_data_from_reads(fnam, resolution, **kwargs):
 
 def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
                            filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
-                           region=None, nchunks=100, verbose=True, clean=True):
+                           region=None, nchunks=100, verbose=True, clean=True,
+                           sparse=False, mmap=None, mcool=None):
     """
     :param fnam: TADbit-generated BAM file with read-ends1 and read-ends2
     :param resolution: the resolution of the experiment (size of a bin in
@@ -569,6 +573,15 @@ def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
     :param 100 nchunks: maximum number of chunks into which to cut the BAM
     :param True verbose: speak
     :param True clean: remove temps
+    :param False sparse: store interactions in numpy arrays
+       (:class:`pytadbit.hic_data.SparseHiC_data`) instead of a dictionary.
+       Much lighter in memory for genome-wide high resolution matrices
+    :param None mmap: path to a folder where to store the interactions
+       (:class:`pytadbit.hic_data.MmapHiC_data`). The matrix is written
+       there chunk by chunk, and read from disk only when needed
+    :param None mcool: multi-resolution cooler generated by
+       :func:`pytadbit.parsers.hic_bam_parser.zoomify` from the same BAM
+       file, to read the interactions from
 
     :returns: HiC_data object
     """
@@ -591,8 +604,13 @@ def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
 
     chromosomes = {region: genome_seq[region]} if region else genome_seq
     dict_sec = dict([(j, i) for i, j in enumerate(sections)])
-    imx = HiC_data((), size, chromosomes=chromosomes, dict_sec=dict_sec,
-                   resolution=resolution)
+    if mmap:
+        imx = MmapHiC_data(mmap, (), size, chromosomes=chromosomes,
+                           dict_sec=dict_sec, resolution=resolution)
+    else:
+        hic_class = SparseHiC_data if sparse else HiC_data
+        imx = hic_class((), size, chromosomes=chromosomes, dict_sec=dict_sec,
+                        resolution=resolution)
 
     if biases:
         if isinstance(biases, basestring):
@@ -621,11 +639,36 @@ def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
             imx.bias     = biases['biases']
         imx.expected = biases['decay']
 
-    get_matrix(fnam, resolution, biases=None, filter_exclude=filter_exclude,
-               normalization='raw', tmpdir=tmpdir, clean=clean,
-               ncpus=ncpus, nchunks=nchunks, dico=imx, region1=region,
-               verbose=verbose)
+    if mmap:
+        _bam_to_mmap(fnam, resolution, imx, filter_exclude, region, tmpdir,
+                     ncpus, nchunks, verbose, clean, mcool=mcool)
+    else:
+        get_matrix(fnam, resolution, biases=None, filter_exclude=filter_exclude,
+                   normalization='raw', tmpdir=tmpdir, clean=clean,
+                   ncpus=ncpus, nchunks=nchunks, dico=imx, region1=region,
+                   verbose=verbose, mcool=mcool)
     imx._symmetricize()
     imx.symmetricized = True
+    if mmap:
+        imx.save()
 
     return imx
+
+
+def _bam_to_mmap(fnam, resolution, imx, filter_exclude, region, tmpdir,
+                 ncpus, nchunks, verbose, clean, mcool=None):
+    """
+    Reads the upper half of the matrix from the BAM and appends it, chunk by
+    chunk, to a MmapHiC_data object
+    """
+    if not isinstance(filter_exclude, int):
+        filter_exclude = filters_to_bin(filter_exclude)
+    regions, rand_hash, _, chunks = read_bam(
+        fnam, filter_exclude, resolution, ncpus=ncpus,
+        region1=region, tmpdir=tmpdir, nchunks=nchunks, verbose=verbose,
+        half=True, mcool=mcool)
+    for _, rows, cols, values, _ in _iter_matrix_arrays(
+            chunks, tmpdir, rand_hash, clean=clean, verbose=verbose):
+        imx._append_coo(rows.astype(np.int64), cols.astype(np.int64), values)
+    if clean:
+        os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
@@ -3,14 +3,17 @@
 """
 from __future__ import print_function
 
-from bisect                               import bisect_right as bisect
 from warnings                             import warn
-from sys                                  import stdout
 from subprocess                           import Popen
+import heapq
 import os
+import multiprocessing as mu
+
+import numpy as np
 
 from pytadbit.utils.file_handling         import magic_open
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import re_sites_index
+from pytadbit.mapping.restriction_enzymes import locate_re_sites
 
 try:
     basestring
@@ -19,7 +22,7 @@ except NameError:
 
 def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
               genome_seq=None, re_name=None, verbose=False, clean=True,
-              **kwargs):
+              ncpus=1, max_memory=1000, re_cache=None, **kwargs):
     """
     Parse map files
 
@@ -46,6 +49,13 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
        multiple-contacts
     :param False compress: compress (gzip) input map files. This is done in the
        background while next MAP files are parsed, or while files are sorted.
+    :param 1 ncpus: number of input files (e.g. windows of the iterative
+       mapping) parsed and sorted in parallel
+    :param 1000 max_memory: memory (in Mb) available to buffer reads before
+       sorting them in temporary files
+    :param None re_cache: directory where to cache the RE sites found in the
+       genome (e.g. next to the reference genome), see
+       :func:`pytadbit.mapping.restriction_enzymes.re_sites_index`
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -58,16 +68,13 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
     if (f_names2 and not out_file2) or (not f_names2 and out_file2):
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print('Searching and mapping RE sites to the reference genome')
     if len(re_name) == 1 and re_name[0] in (None, 'None'):
         frags = {}
-        read_read = read_read_nofrags
     else:
-        frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                             verbose=verbose)
-        read_read = read_read_frags
+        frags = re_sites_index(re_name, genome_seq, cache_dir=re_cache,
+                               verbose=verbose)
 
     if isinstance(f_names1, basestring):
         f_names1 = [f_names1]
@@ -80,8 +87,9 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
         fnames = (f_names1,)
         outfiles = (out_file1, )
 
-    # max number of reads per intermediate files for sorting
-    max_size = 1000000
+    # max number of reads per intermediate files for sorting (each CPU sorts
+    # its own buffer)
+    max_size = max(1000, int(max_memory * 2**20 / _READ_MEMORY) // ncpus)
 
     windows = {}
     multis  = {}
@@ -91,14 +99,14 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
             print('Loading read' + str(read + 1))
         windows[read] = {}
         num = 0
-        # iteration over reads
-        nfile = 0
         tmp_files = []
-        reads     = []
-        for fnam in fnames[read]:
-            try:
-                fhandler = magic_open(fnam)
-            except IOError:
+        # iteration over input files (in parallel), each one split in sorted
+        # temporary files
+        runs = _runs_from_files(_map_file_to_runs, [
+            (fnam, outfiles[read], nfile, max_size, verbose)
+            for nfile, fnam in enumerate(fnames[read])], frags, ncpus)
+        for fnam, run in zip(fnames[read], runs):
+            if run is None:
                 warn('WARNING: file "%s" not found\n' % fnam)
                 continue
             # get the iteration number of the iterative mapping
@@ -106,156 +114,199 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
                 num = int(fnam.split('.')[-1].split(':')[0])
             except:
                 num += 1
-            # set read counter
-            if verbose:
-                print('loading file: %s' % (fnam))
-            # start parsing
-            read_count = 0
-            try:
-                while not False:
-                    for _ in range(max_size):
-                        try:
-                            reads.append(read_read(next(fhandler), frags,
-                                                   frag_chunk))
-                        except KeyError:
-                            # Chromosome not in hash
-                            continue
-                        read_count += 1
-                    nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            except StopIteration:
-                fhandler.close()
-                nfile += 1
-                write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            windows[read][num] = read_count
+            tmp_files.extend(run[0])
+            windows[read][num] = run[1]
             if kwargs.get('compress', False) and fnam.endswith('.map'):
                 print('compressing input MAP file')
                 procs.append(Popen(['gzip', fnam]))
-        nfile += 1
-        write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
 
-        # we have now sorted temporary files
-        # we do merge sort for eah pair
-        if verbose:
-            stdout.write('Merge sort')
-            stdout.flush()
-        while len(tmp_files) > 1:
-            file1 = tmp_files.pop(0)
-            try:
-                file2 = tmp_files.pop(0)
-            except IndexError:
-                break
-            if verbose:
-                stdout.write('.')
-            stdout.flush()
-            nfile += 1
-            tmp_files.append(merge_sort(file1, file2, outfiles[read], nfile))
+        # we have now sorted temporary files, merged all at once
         if verbose:
-            stdout.write('\n')
-        tmp_name = tmp_files[0]
-
-        if verbose:
-            print('Getting Multiple contacts')
-        reads_fh = open(outfiles[read], 'w')
-        ## Also pipe file header
-        # chromosome sizes (in order)
-        reads_fh.write('# Chromosome lengths (order matters):\n')
-        for crm in genome_seq:
-            reads_fh.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
-        reads_fh.write('# Mapped\treads count by iteration\n')
-        for size in windows[read]:
-            reads_fh.write('# MAPPED %d %d\n' % (size, windows[read][size]))
-
-        ## Multicontacts
-        tmp_reads_fh = open(tmp_name)
-        try:
-            read_line = next(tmp_reads_fh)
-        except StopIteration:
-            raise StopIteration('ERROR!\n Nothing parsed, check input files and'
-                                ' chromosome names (in genome.fasta and SAM/MAP'
-                                ' files).')
-        prev_head = read_line.split('\t', 1)[0]
-        prev_head = prev_head.split('~' , 1)[0]
-        prev_read = read_line
-        multis[read] = {}
-        multi = 0
-        for read_line in tmp_reads_fh:
-            head = read_line.split('\t', 1)[0]
-            head = head.split('~' , 1)[0]
-            if head == prev_head:
-                prev_read =  prev_read.strip() + '|||' + read_line
-                multi += 1
-            else:
-                reads_fh.write(prev_read)
-                prev_read = read_line
-                try:
-                    multis[read][multi] += 1
-                except KeyError:
-                    multis[read][multi] = 1
-                multi = 0
-            prev_head = head
-        reads_fh.write(prev_read)
-        reads_fh.close()
-        tmp_reads_fh.close()
-        if clean:
-            os.system('rm -rf ' + tmp_name)
+            print('Merge sort %d temporary files and getting multiple '
+                  'contacts' % len(tmp_files))
+        multis[read] = write_parsed_reads(merge_reads(tmp_files, clean),
+                                          outfiles[read], genome_seq,
+                                          windows[read])
     # wait for compression to finish
     for p in procs:
         p.communicate()
     return windows, multis
 
 
+# approximate memory used by a buffered read (line of text)
+_READ_MEMORY = 256
+# number of reads searched at once in the index of RE sites
+_BATCH_SIZE = 100000
+
+_FRAGS = {}
+
+
+def _init_frags(frags):
+    global _FRAGS
+    _FRAGS = frags
+
+
+def _runs_from_files(func, args, frags, ncpus):
+    """
+    Calls func on each input file, in parallel if ncpus > 1 (RE sites are
+    shared with the worker processes when they are created).
+
+    :yields: the result of each call, in the order of the input files
+    """
+    if ncpus > 1 and len(args) > 1:
+        pool = mu.Pool(min(ncpus, len(args)), initializer=_init_frags,
+                       initargs=(frags, ))
+        procs = [pool.apply_async(func, args=arg) for arg in args]
+        pool.close()
+        for proc in procs:
+            yield proc.get()
+        pool.join()
+    else:
+        _init_frags(frags)
+        for arg in args:
+            yield func(*arg)
+
+
+def _map_file_to_runs(fnam, outfile, nfile, max_size, verbose):
+    """
+    Parses a MAP file into sorted temporary files of at most max_size reads.
+
+    :returns: the list of temporary files and the number of reads parsed
+       (None if the file is not found)
+    """
+    try:
+        fhandler = magic_open(fnam)
+    except IOError:
+        return None
+    if verbose:
+        print('loading file: %s' % (fnam))
+    tmp_files = []
+    reads = []
+    batch = []
+    read_count = 0
+    for line in fhandler:
+        try:
+            batch.append(parse_map_line(line))
+        except KeyError:
+            # unmapped read
+            continue
+        if len(batch) >= _BATCH_SIZE:
+            read_count += locate_reads(batch, _FRAGS, reads)
+            batch = []
+            if len(reads) >= max_size:
+                write_reads_to_file(reads, outfile, tmp_files,
+                                    '%03d_%03d' % (nfile, len(tmp_files)))
+    fhandler.close()
+    read_count += locate_reads(batch, _FRAGS, reads)
+    write_reads_to_file(reads, outfile, tmp_files,
+                        '%03d_%03d' % (nfile, len(tmp_files)))
+    return tmp_files, read_count
+
+
+def _read_id(line):
+    return line.split('\t', 1)[0].split('~')[0]
+
+
 def write_reads_to_file(reads, outfiles, tmp_files, nfile):
     if not reads: # can be...
         return
     tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_%03d_' % nfile) + outfiles.split('/')[-1]])
+                            [('tmp_%s_' % nfile) + outfiles.split('/')[-1]])
     tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
     tmp_files.append(tmp_name)
     out = open(tmp_name, 'w')
-    out.write(''.join(sorted(reads, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
+    out.write(''.join(sorted(reads, key=_read_id)))
     out.close()
     del(reads[:])  # empty list
 
 
-def merge_sort(file1, file2, outfiles, nfile):
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_merged_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_file = open(tmp_name, 'w')
-    fh1 = open(file1)
-    fh2 = open(file2)
-    greater = lambda x, y: x.split('\t', 1)[0].split('~')[0] > y.split('\t', 1)[0].split('~')[0]
-    read1 = next(fh1)
-    read2 = next(fh2)
-    while True:
-        if greater(read2, read1):
-            tmp_file.write(read1)
-            try:
-                read1 = next(fh1)
-            except StopIteration:
-                tmp_file.write(read2)
-                break
+def merge_reads(tmp_files, clean=True):
+    """
+    K-way merge of temporary files of reads sorted by read ID. Reads with
+    the same ID are kept in the order of the temporary files.
+
+    :param tmp_files: list of paths to sorted temporary files
+    :param True clean: remove temporary files once merged
+
+    :yields: lines of the temporary files
+    """
+    fhandlers = [open(fname) for fname in tmp_files]
+    try:
+        for line in heapq.merge(*fhandlers, key=_read_id):
+            yield line
+    finally:
+        for fhandler in fhandlers:
+            fhandler.close()
+        if clean:
+            for fname in tmp_files:
+                os.remove(fname)
+
+
+def write_parsed_reads(reads, out_file, genome_seq, windows):
+    """
+    Writes the header and the reads (sorted by read ID) of a parsed file,
+    joining with '|||' the reads with the same ID (multiple contacts).
+
+    :param reads: iterable of lines (sorted by read ID)
+    :param out_file: path to output file
+    :param genome_seq: dictionary of chromosome sequences (only lengths are
+       used)
+    :param windows: dictionary with the number of reads mapped on each
+       iteration of the iterative mapping
+
+    :returns: dictionary with the number of reads (values) per number of
+       extra contacts (keys)
+    """
+    reads_fh = open(out_file, 'w')
+    ## Also pipe file header
+    # chromosome sizes (in order)
+    reads_fh.write('# Chromosome lengths (order matters):\n')
+    for crm in genome_seq:
+        reads_fh.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
+    reads_fh.write('# Mapped\treads count by iteration\n')
+    for size in windows:
+        reads_fh.write('# MAPPED %d %d\n' % (size, windows[size]))
+
+    ## Multicontacts
+    reads = iter(reads)
+    try:
+        read_line = next(reads)
+    except StopIteration:
+        reads_fh.close()
+        raise StopIteration('ERROR!\n Nothing parsed, check input files and'
+                            ' chromosome names (in genome.fasta and SAM/MAP'
+                            ' files).')
+    prev_head = read_line.split('\t', 1)[0]
+    prev_head = prev_head.split('~' , 1)[0]
+    prev_read = read_line
+    multis = {}
+    multi = 0
+    for read_line in reads:
+        head = read_line.split('\t', 1)[0]
+        head = head.split('~' , 1)[0]
+        if head == prev_head:
+            prev_read =  prev_read.strip() + '|||' + read_line
+            multi += 1
         else:
-            tmp_file.write(read2)
+            reads_fh.write(prev_read)
+            prev_read = read_line
             try:
-                read2 = next(fh2)
-            except StopIteration:
-                tmp_file.write(read1)
-                break
-    for read in fh1:
-        tmp_file.write(read)
-    for read in fh2:
-        tmp_file.write(read)
-    fh1.close()
-    fh2.close()
-    tmp_file.close()
-    os.system('rm -f ' + file1)
-    os.system('rm -f ' + file2)
-    return tmp_name
-
-
-def read_read_nofrags(r, _, __):
+                multis[multi] += 1
+            except KeyError:
+                multis[multi] = 1
+            multi = 0
+        prev_head = head
+    reads_fh.write(prev_read)
+    reads_fh.close()
+    return multis
+
+
+def parse_map_line(r):
+    """
+    :returns: read ID, chromosome, position (end of the read for reads mapped
+       on the reverse strand), strand (1 if positive) and length of a read in
+       MAP format
+    """
     name, seq, _, _, ali = r.split('\t')[:5]
     try:
         crm, strand, pos = ali.split(':')[:3]
@@ -268,39 +319,47 @@ def read_read_nofrags(r, _, __):
         pos = int(pos)
     else:
         pos = int(pos) + len_seq - 1 # remove 1 because all inclusive
-    return ('%s\t%s\t%d\t%d\t%d\t0\t0\n' % (
-        name, crm, pos, positive, len_seq))
+    return name, crm, pos, positive, len_seq
 
 
-def read_read_frags(r, frags, frag_chunk):
-    name, seq, _, _, ali = r.split('\t')[:5]
-    try:
-        crm, strand, pos = ali.split(':')[:3]
-    except ValueError:
-        raise KeyError()
-    crm = crm.split()[0]
-    positive = strand == '+'
-    len_seq  = len(seq)
-    if positive:
-        pos = int(pos)
-    else:
-        pos = int(pos) + len_seq - 1 # remove 1 because all inclusive
-    frag_piece = frags[crm][pos // frag_chunk]
-    idx = bisect(frag_piece, pos)
-    try:
-        next_re = frag_piece[idx]
-    except IndexError:
-        # case where part of the read is mapped outside chromosome
-        count = 0
-        while idx >= len(frag_piece) and count < len_seq:
-            pos -= 1
-            count += 1
-            frag_piece = frags[crm][pos // frag_chunk]
-            idx = bisect(frag_piece, pos)
-        if count >= len_seq:
-            raise Exception('Read mapped mostly outside ' +
-                            'chromosome\n(also reference genome can be truncated)')
-        next_re = frag_piece[idx]
-    prev_re = frag_piece[idx - 1 if idx else 0]
-    return ('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-        name, crm, pos, positive, len_seq, prev_re, next_re))
+def locate_reads(batch, frags, reads):
+    """
+    Finds the closest RE sites of a batch of reads and appends them, as lines
+    of text, to a list of reads. Reads on chromosomes without RE sites are
+    skipped.
+
+    :param batch: list of reads (as returned by :func:`parse_map_line`)
+    :param frags: dictionary of arrays of RE sites per chromosome as returned
+       by :func:`pytadbit.mapping.restriction_enzymes.re_sites_index`. If
+       empty, RE sites are set to 0.
+    :param reads: list where to append the reads
+
+    :returns: number of reads appended
+    """
+    if not batch:
+        return 0
+    if not frags:
+        reads.extend(['%s\t%s\t%d\t%d\t%d\t0\t0\n' % read for read in batch])
+        return len(batch)
+    names, crms, pos, positive, lengths = zip(*batch)
+    pos = np.array(pos)
+    lengths = np.array(lengths)
+    prev_re = np.zeros(len(batch), dtype=int)
+    next_re = np.zeros(len(batch), dtype=int)
+    keep = np.zeros(len(batch), dtype=bool)
+    crm_idx = {}
+    for i, crm in enumerate(crms):
+        crm_idx.setdefault(crm, []).append(i)
+    for crm, idx in crm_idx.items():
+        if not crm in frags:
+            # Chromosome not in hash
+            continue
+        pos[idx], prev_re[idx], next_re[idx] = locate_re_sites(
+            frags[crm], pos[idx], lengths[idx])
+        keep[idx] = True
+    pos, prev_re, next_re = pos.tolist(), prev_re.tolist(), next_re.tolist()
+    keep = np.flatnonzero(keep).tolist()
+    reads.extend(['%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
+        names[i], crms[i], pos[i], positive[i], lengths[i], prev_re[i],
+        next_re[i]) for i in keep])
+    return len(keep)
@@ -0,0 +1,290 @@
+"""
+18 oct 2026
+
+Binary, columnar storage of the pairs of mapped read-ends (same information as
+the tab separated 2D-bed files generated by
+:func:`pytadbit.mapping.get_intersection`).
+
+File layout:
+   - magic string
+   - blocks of pairs, each column of each block compressed separately (zlib)
+   - footer (JSON) with the chromosome sizes, the columns and the index of
+     blocks (offsets, sizes and genomic extent of the first read-end)
+   - offset of the footer (8 bytes) and magic string
+"""
+
+from collections import OrderedDict
+from mmap        import mmap, ACCESS_READ
+import json
+import struct
+import zlib
+
+import numpy as np
+
+
+PAIRS_MAGIC = b'TADbit-pairs\x01\n'
+
+# one column per field of the 2D-bed format (except the read ID)
+PAIRS_COLUMNS = OrderedDict((('chrom1' , '<i4'), ('pos1'   , '<i4'),
+                             ('strand1', 'i1' ), ('len1'   , '<i4'),
+                             ('rs1'    , '<i4'), ('re1'    , '<i4'),
+                             ('chrom2' , '<i4'), ('pos2'   , '<i4'),
+                             ('strand2', 'i1' ), ('len2'   , '<i4'),
+                             ('rs2'    , '<i4'), ('re2'    , '<i4')))
+
+
+def is_pairs(fname):
+    """
+    Check if a file is in TADbit binary pairs format
+
+    :param fname: path to file
+    """
+    try:
+        with open(fname, 'rb') as fh:
+            return fh.read(len(PAIRS_MAGIC)) == PAIRS_MAGIC
+    except (IOError, OSError):
+        return False
+
+
+class PairsWriter(object):
+    """
+    Writes pairs of read-ends in TADbit binary pairs format. Pairs are
+    buffered and written by blocks of block_size pairs.
+
+    :param fname: path to output file
+    :param chromosomes: ordered dictionary of chromosome names and lengths
+    :param 1000000 block_size: number of pairs per block
+    :param 1 compress: zlib compression level, with 0 columns are stored
+       uncompressed and can be read directly from the memory map.
+    """
+
+    def __init__(self, fname, chromosomes, block_size=1000000, compress=1):
+        self.fname       = fname
+        self.chromosomes = OrderedDict(chromosomes)
+        self.crm_ids     = dict((c, i) for i, c in enumerate(self.chromosomes))
+        self.block_size  = block_size
+        self.compress    = compress
+        self.blocks      = []
+        self.count       = 0
+        self._names      = []
+        self._columns    = dict((k, []) for k in PAIRS_COLUMNS)
+        self._buffered   = 0
+        self._out        = open(fname, 'wb')
+        self._out.write(PAIRS_MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, names, columns):
+        """
+        :param names: list of read IDs
+        :param columns: dictionary with an array (or list) of values for each
+           of the columns in PAIRS_COLUMNS (chromosomes as indexes in the list
+           of chromosomes)
+        """
+        self._names.extend(names)
+        for k in PAIRS_COLUMNS:
+            self._columns[k].append(np.asarray(columns[k], dtype=PAIRS_COLUMNS[k]))
+        self._buffered += len(names)
+        while self._buffered >= self.block_size:
+            self._flush(self.block_size)
+
+    def write_lines(self, lines):
+        """
+        :param lines: list of lines in 2D-bed format, already split by tabs
+        """
+        if not lines:
+            return
+        names, columns = lines_to_columns(lines, self.crm_ids)
+        self.write(names, columns)
+
+    def _flush(self, size):
+        if not self._buffered:
+            return
+        names = self._names[:size]
+        del self._names[:size]
+        columns = {}
+        for k in PAIRS_COLUMNS:
+            vals = np.concatenate(self._columns[k])
+            columns[k] = vals[:size]
+            self._columns[k] = [vals[size:]]
+        self._buffered -= len(names)
+        block = {'offset': self._out.tell(), 'rows': len(names),
+                 'start': [int(columns['chrom1'][0]), int(columns['pos1'][0])],
+                 'end'  : [int(columns['chrom1'][-1]), int(columns['pos1'][-1])],
+                 'sizes': []}
+        chunks = [np.ascontiguousarray(columns[k]).tobytes() for k in PAIRS_COLUMNS]
+        chunks.append('\n'.join(names).encode())
+        for chunk in chunks:
+            if self.compress:
+                chunk = zlib.compress(chunk, self.compress)
+            block['sizes'].append(len(chunk))
+            self._out.write(chunk)
+        self.blocks.append(block)
+        self.count += len(names)
+
+    def close(self):
+        if self._out.closed:
+            return
+        self._flush(self._buffered)
+        footer = json.dumps({'chromosomes': list(self.chromosomes.items()),
+                             'columns'    : list(PAIRS_COLUMNS.items()),
+                             'compress'   : self.compress,
+                             'count'      : self.count,
+                             'blocks'     : self.blocks}).encode()
+        offset = self._out.tell()
+        self._out.write(footer)
+        self._out.write(struct.pack('<Q', offset))
+        self._out.write(PAIRS_MAGIC)
+        self._out.close()
+
+
+def lines_to_columns(lines, crm_ids):
+    """
+    :param lines: list of lines in 2D-bed format, already split by tabs
+    :param crm_ids: dictionary with the index of each chromosome
+
+    :returns: list of read IDs and dictionary of arrays, one per column (in
+       PAIRS_COLUMNS)
+    """
+    names, cr1, ps1, sd1, ln1, rs1, re1, cr2, ps2, sd2, ln2, rs2, re2 = zip(*lines)
+    return names, {'chrom1' : [crm_ids[c] for c in cr1],
+                   'pos1'   : np.array(ps1, dtype=int),
+                   'strand1': np.array(sd1, dtype=int),
+                   'len1'   : np.array(ln1, dtype=int),
+                   'rs1'    : np.array(rs1, dtype=int),
+                   're1'    : np.array(re1, dtype=int),
+                   'chrom2' : [crm_ids[c] for c in cr2],
+                   'pos2'   : np.array(ps2, dtype=int),
+                   'strand2': np.array(sd2, dtype=int),
+                   'len2'   : np.array(ln2, dtype=int),
+                   'rs2'    : np.array(rs2, dtype=int),
+                   're2'    : np.array([v.rstrip() for v in re2], dtype=int)}
+
+
+def read_pairs_index(fname):
+    """
+    Reads the footer of a TADbit binary pairs file
+
+    :param fname: path to file
+
+    :returns: a dictionary with the chromosomes (ordered dictionary of names
+       and lengths), the total number of pairs ('count') and the list of
+       blocks
+    """
+    with open(fname, 'rb') as fh:
+        fh.seek(-8 - len(PAIRS_MAGIC), 2)
+        offset = struct.unpack('<Q', fh.read(8))[0]
+        if fh.read(len(PAIRS_MAGIC)) != PAIRS_MAGIC:
+            raise Exception('ERROR: %s is not a complete TADbit pairs file' % (
+                fname))
+        end = fh.tell() - 8 - len(PAIRS_MAGIC)
+        fh.seek(offset)
+        index = json.loads(fh.read(end - offset).decode())
+    index['chromosomes'] = OrderedDict((c, l) for c, l in index['chromosomes'])
+    return index
+
+
+def iter_pairs(fname, columns=None, names=True, blocks=None, region=None,
+               start=None, end=None):
+    """
+    Iterates over the blocks of a TADbit binary pairs file (memory mapped).
+
+    :param fname: path to file
+    :param None columns: list of columns to load (all by default)
+    :param True names: load also read IDs
+    :param None blocks: list of indexes of the blocks to read (all by
+       default)
+    :param None region: chromosome name. If given, only the pairs with their
+       first read-end in this chromosome are returned, and only the blocks
+       overlapping it (according to the index) are read
+    :param None start: first position (of the first read-end) in the region
+    :param None end: last position (included) in the region
+
+    :yields: list of read IDs (None if names is False) and dictionary of
+       arrays, one per column
+    """
+    index = read_pairs_index(fname)
+    columns = columns or list(PAIRS_COLUMNS)
+    position = dict((k, i) for i, k in enumerate(PAIRS_COLUMNS))
+    blocks = range(len(index['blocks'])) if blocks is None else blocks
+    if region is not None:
+        try:
+            crm = list(index['chromosomes']).index(region)
+        except ValueError:
+            raise Exception('ERROR: chromosome %s not found' % region)
+        first = [crm, start or 0]
+        last = [crm, index['chromosomes'][region] if end is None else end]
+        # pairs are sorted by first read-end, blocks store their extent
+        blocks = [b for b in blocks if index['blocks'][b]['start'] <= last
+                  and index['blocks'][b]['end'] >= first]
+        load = list(columns) + [k for k in ('chrom1', 'pos1')
+                                if not k in columns]
+    else:
+        load = columns
+    with open(fname, 'rb') as fh:
+        if not index['count']:
+            return
+        mm = mmap(fh.fileno(), 0, access=ACCESS_READ)
+        try:
+            for b in blocks:
+                block = index['blocks'][b]
+                starts = np.cumsum([block['offset']] + block['sizes'])
+                values = {}
+                for k in load:
+                    i = position[k]
+                    if index['compress']:
+                        values[k] = np.frombuffer(
+                            zlib.decompress(mm[starts[i]:starts[i + 1]]),
+                            dtype=PAIRS_COLUMNS[k])
+                    else:
+                        values[k] = np.frombuffer(
+                            mm, dtype=PAIRS_COLUMNS[k], count=block['rows'],
+                            offset=int(starts[i]))
+                reads = None
+                if names:
+                    reads = mm[starts[-2]:starts[-1]]
+                    if index['compress']:
+                        reads = zlib.decompress(reads)
+                    reads = reads.decode().split('\n')
+                if region is not None:
+                    keep = None
+                    if block['start'] < first or block['end'] > last:
+                        keep = np.flatnonzero((values['chrom1'] == crm) &
+                                              (values['pos1'] >= first[1]) &
+                                              (values['pos1'] <= last[1]))
+                    values = dict((k, values[k] if keep is None else
+                                   values[k][keep]) for k in columns)
+                    if reads is not None and keep is not None:
+                        reads = [reads[i] for i in keep]
+                yield reads, values
+                del values
+        finally:
+            try:
+                mm.close()
+            except BufferError:  # arrays still pointing to the memory map
+                pass
+
+
+def iter_pairs_lines(fname, region=None, start=None, end=None):
+    """
+    Iterates over the pairs of a TADbit binary pairs file as lines in 2D-bed
+    format (as written by :func:`pytadbit.mapping.get_intersection`).
+
+    :param fname: path to file
+    :param None region: chromosome name of the first read-end (see
+       :func:`iter_pairs`)
+    :param None start: first position of the first read-end in the region
+    :param None end: last position (included) of the first read-end in the
+       region
+    """
+    crms = list(read_pairs_index(fname)['chromosomes'])
+    for reads, values in iter_pairs(fname, region=region, start=start,
+                                    end=end):
+        cols = [[crms[c] for c in values[k]] if k.startswith('chrom') else
+                values[k].tolist() for k in PAIRS_COLUMNS]
+        for row in zip(reads, *cols):
+            yield '%s\t%s\t%d\t%d\t%d\t%d\t%d\t%s\t%d\t%d\t%d\t%d\t%d\n' % row
@@ -7,7 +7,12 @@ from builtins import next
 from itertools import combinations
 from bisect import bisect_right as bisect
 from pysam import Samfile
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import re_sites_index
+from pytadbit.parsers                     import map_parser
+from pytadbit.parsers.map_parser          import _READ_MEMORY, _runs_from_files
+from pytadbit.parsers.map_parser          import _BATCH_SIZE, locate_reads
+from pytadbit.parsers.map_parser          import merge_reads, write_parsed_reads
+from pytadbit.parsers.map_parser          import write_reads_to_file
 from shutil import copyfileobj
 from warnings import warn
 import os
@@ -21,7 +26,8 @@ except NameError:
 
 def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
               genome_seq=None, re_name=None, verbose=False, clean=True,
-              mapper=None, **kwargs):
+              mapper=None, ncpus=1, max_memory=1000, re_cache=None,
+              **kwargs):
     """
     Parse sam/bam file using pysam tools.
 
@@ -43,6 +49,15 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     :param re_name: name of the restriction enzyme used
     :param None mapper: software used to map (supported are GEM and BOWTIE2).
        Guessed from file by default.
+    :param True clean: remove temporary files required for indentification of
+       multiple-contacts
+    :param 1 ncpus: number of input files (e.g. windows of the iterative
+       mapping) parsed and sorted in parallel
+    :param 1000 max_memory: memory (in Mb) available to buffer reads before
+       sorting them in temporary files
+    :param None re_cache: directory where to cache the RE sites found in the
+       genome (e.g. next to the reference genome), see
+       :func:`pytadbit.mapping.restriction_enzymes.re_sites_index`
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -55,11 +70,10 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     if (f_names2 and not out_file2) or (not f_names2 and out_file2):
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print('Searching and mapping RE sites to the reference genome')
-    frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                         verbose=verbose)
+    frags = re_sites_index(re_name, genome_seq, cache_dir=re_cache,
+                           verbose=verbose)
 
     if isinstance(f_names1, basestring):
         f_names1 = [f_names1]
@@ -72,8 +86,13 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
         fnames = (f_names1,)
         outfiles = (out_file1, )
 
-    # max number of reads per intermediate files for sorting
-    max_size = 1000000
+    # max number of reads per intermediate files for sorting (each CPU sorts
+    # its own buffer)
+    max_size = max(1000, int(max_memory * 2**20 / _READ_MEMORY) // ncpus)
+
+    # guess mapper used
+    if not mapper:
+        mapper = _guess_mapper([f for fnams in fnames for f in fnams])
 
     windows = {}
     multis  = {}
@@ -83,164 +102,110 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
             print('Loading read' + str(read + 1))
         windows[read] = {}
         num = 0
-        # iteration over reads
-        nfile = 0
         tmp_files = []
-        reads     = []
-        for fnam in fnames[read]:
-            try:
-                fhandler = Samfile(fnam)
-            except IOError:
+        # iteration over input files (in parallel), each one split in sorted
+        # temporary files
+        runs = _runs_from_files(_sam_file_to_runs, [
+            (fnam, outfiles[read], nfile, mapper, max_size, verbose)
+            for nfile, fnam in enumerate(fnames[read])], frags, ncpus)
+        for fnam, run in zip(fnames[read], runs):
+            if run is None:
                 print('WARNING: file "%s" not found' % fnam)
                 continue
-            except ValueError:
-                raise Exception('ERROR: not a SAM/BAM file\n%s' % fnam)
             # get the iteration number of the iterative mapping
             try:
                 num = int(fnam.split('.')[-1].split(':')[0])
             except:
                 num += 1
-            # set read counter
+            tmp_files.extend(run[0])
             windows[read].setdefault(num, 0)
-            # guess mapper used
-            if not mapper:
-                mapper = fhandler.header['PG'][0]['ID']
-            if mapper.lower()=='gem':
-                condition = lambda x: x[1][0][0] != 'N'
-            elif mapper.lower() in ['bowtie', 'bowtie2']:
-                condition = lambda x: 'XS' == x[0][0]
-            else:
-                warn('WARNING: unrecognized mapper used to generate file\n')
-                condition = lambda x: x[1][1] != 1
-            if verbose:
-                print('loading SAM file from %s: %s' % (mapper, fnam))
-            # getrname chromosome names
-            i = 0
-            crm_dict = {}
-            while True:
-                try:
-                    crm_dict[i] = fhandler.getrname(i)
-                    i += 1
-                except ValueError:
-                    break
-            # iteration over reads
-            sub_count = 0  # to empty read buffer
-            for r in fhandler:
-                if r.is_unmapped:
-                    continue
-                if condition(r.tags):
-                    continue
-                positive = not r.is_reverse
-                crm      = crm_dict[r.tid]
-                len_seq  = len(r.seq)
-                if positive:
-                    pos = r.pos + 1
-                else:
-                    pos = r.pos + len_seq
-                try:
-                    frag_piece = frags[crm][pos // frag_chunk]
-                except KeyError:
-                    # Chromosome not in hash
-                    continue
-                idx = bisect(frag_piece, pos)
-                try:
-                    next_re = frag_piece[idx]
-                except IndexError:
-                    # case where part of the read is mapped outside chromosome
-                    count = 0
-                    while idx >= len(frag_piece) and count < len_seq:
-                        pos -= 1
-                        count += 1
-                        frag_piece = frags[crm][pos // frag_chunk]
-                        idx = bisect(frag_piece, pos)
-                    if count >= len_seq:
-                        raise Exception('Read mapped mostly outside ' +
-                                        'chromosome\n(also reference genome can be truncated)')
-                    next_re    = frag_piece[idx]
-                prev_re    = frag_piece[idx - 1 if idx else 0]
-                name       = r.qname
-                reads.append('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-                    name, crm, pos, positive, len_seq, prev_re, next_re))
-                windows[read][num] += 1
-                sub_count += 1
-                if sub_count >= max_size:
-                    sub_count = 0
-                    nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            nfile += 1
-            write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-
-
-        # we have now sorted temporary files
-        # we do merge sort for eah pair
-        if verbose:
-            stdout.write('Merge sort')
-            stdout.flush()
-        while len(tmp_files) > 1:
-            file1 = tmp_files.pop(0)
-            try:
-                file2 = tmp_files.pop(0)
-            except IndexError:
-                break
-            if verbose:
-                stdout.write('.')
-            stdout.flush()
-            nfile += 1
-            tmp_files.append(merge_sort(file1, file2, outfiles[read], nfile))
-        if verbose:
-            stdout.write('\n')
-        tmp_name = tmp_files[0]
+            windows[read][num] += run[1]
 
+        # we have now sorted temporary files, merged all at once
         if verbose:
-            print('Getting Multiple contacts')
-        reads_fh = open(outfiles[read], 'w')
-        ## Also pipe file header
-        # chromosome sizes (in order)
-        reads_fh.write('# Chromosome lengths (order matters):\n')
-        for crm in genome_seq:
-            reads_fh.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
-        reads_fh.write('# Mapped\treads count by iteration\n')
-        for size in windows[read]:
-            reads_fh.write('# MAPPED %d %d\n' % (size, windows[read][size]))
-
-        ## Multicontacts
-        tmp_reads_fh = open(tmp_name)
-        try:
-            read_line = next(tmp_reads_fh)
-        except StopIteration:
-            raise StopIteration('ERROR!\n Nothing parsed, check input files and'
-                                ' chromosome names (in genome.fasta and SAM/MAP'
-                                ' files).')
-        prev_head = read_line.split('\t', 1)[0]
-        prev_head = prev_head.split('~' , 1)[0]
-        prev_read = read_line
-        multis[read] = {}
-        multi = 0
-        for read_line in tmp_reads_fh:
-            head = read_line.split('\t', 1)[0]
-            head = head.split('~' , 1)[0]
-            if head == prev_head:
-                prev_read =  prev_read.strip() + '|||' + read_line
-                multi += 1
-            else:
-                reads_fh.write(prev_read)
-                prev_read = read_line
-                try:
-                    multis[read][multi] += 1
-                except KeyError:
-                    multis[read][multi] = 1
-                multi = 0
-            prev_head = head
-        reads_fh.write(prev_read)
-        reads_fh.close()
-        tmp_reads_fh.close()
-        if clean:
-            os.system('rm -rf ' + tmp_name)
+            print('Merge sort %d temporary files and getting multiple '
+                  'contacts' % len(tmp_files))
+        multis[read] = write_parsed_reads(merge_reads(tmp_files, clean),
+                                          outfiles[read], genome_seq,
+                                          windows[read])
     # wait for compression to finish
     for p in procs:
         p.communicate()
     return windows, multis
 
+
+def _guess_mapper(fnames):
+    for fnam in fnames:
+        try:
+            return Samfile(fnam).header['PG'][0]['ID']
+        except IOError:
+            continue
+        except ValueError:
+            raise Exception('ERROR: not a SAM/BAM file\n%s' % fnam)
+
+
+def _sam_file_to_runs(fnam, outfile, nfile, mapper, max_size, verbose):
+    """
+    Parses a SAM/BAM file into sorted temporary files of at most max_size
+    reads.
+
+    :returns: the list of temporary files and the number of reads parsed
+       (None if the file is not found)
+    """
+    try:
+        fhandler = Samfile(fnam)
+    except IOError:
+        return None
+    except ValueError:
+        raise Exception('ERROR: not a SAM/BAM file\n%s' % fnam)
+    if mapper.lower()=='gem':
+        condition = lambda x: x[1][0][0] != 'N'
+    elif mapper.lower() in ['bowtie', 'bowtie2']:
+        condition = lambda x: 'XS' == x[0][0]
+    else:
+        warn('WARNING: unrecognized mapper used to generate file\n')
+        condition = lambda x: x[1][1] != 1
+    if verbose:
+        print('loading SAM file from %s: %s' % (mapper, fnam))
+    # getrname chromosome names
+    i = 0
+    crm_dict = {}
+    while True:
+        try:
+            crm_dict[i] = fhandler.getrname(i)
+            i += 1
+        except ValueError:
+            break
+    # iteration over reads
+    tmp_files = []
+    reads = []
+    batch = []
+    read_count = 0
+    for r in fhandler:
+        if r.is_unmapped:
+            continue
+        if condition(r.tags):
+            continue
+        positive = not r.is_reverse
+        len_seq  = len(r.seq)
+        if positive:
+            pos = r.pos + 1
+        else:
+            pos = r.pos + len_seq
+        batch.append((r.qname, crm_dict[r.tid], pos, positive, len_seq))
+        if len(batch) >= _BATCH_SIZE:
+            read_count += locate_reads(batch, map_parser._FRAGS, reads)
+            batch = []
+            if len(reads) >= max_size:
+                write_reads_to_file(reads, outfile, tmp_files,
+                                    '%03d_%03d' % (nfile, len(tmp_files)))
+    read_count += locate_reads(batch, map_parser._FRAGS, reads)
+    fhandler.close()
+    write_reads_to_file(reads, outfile, tmp_files,
+                        '%03d_%03d' % (nfile, len(tmp_files)))
+    return tmp_files, read_count
+
+
 def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
                  tmp_format=False, **kwargs):
     """
@@ -437,18 +402,6 @@ def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
 
     return out_file
 
-def write_reads_to_file(reads, outfiles, tmp_files, nfile):
-    if not reads: # can be...
-        return
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_files.append(tmp_name)
-    out = open(tmp_name, 'w')
-    out.write(''.join(sorted(reads, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
-    out.close()
-    del(reads[:]) # empty list
-
 def write_paired_reads_to_file(reads, outfiles, tmp_files, nfile):
     if not reads: # can be...
         return
@@ -7,8 +7,9 @@ from os                           import path, listdir
 from pytadbit.parsers.hic_parser  import read_matrix
 from pytadbit.tadbit_py           import _tadbit_wrapper
 from math                         import isnan, sqrt
-from scipy.sparse.csr             import csr_matrix
-from scipy.stats                  import mannwhitneyu
+from scipy.sparse                 import csr_matrix, issparse
+from scipy.special                import binom
+from scipy.stats                  import norm
 import numpy as np
 
 
@@ -32,7 +33,7 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
     :param x: a square matrix of interaction counts in the HI-C data or a list
        of such matrices for replicated experiments. The counts must be evenly
        sampled and not normalized. x might be either a list of list, a path to
-       a file or a file handler
+       a file or a file handler (or a scipy sparse matrix with use_topdom)
     :argument 'visibility' norm: kind of normalization to use. Choose between
        'visibility' of 'Imakaev'
     :argument None remove: a python list of lists of booleans mapping positively
@@ -53,7 +54,10 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
        boundaries, and the corresponding list associated log likelihoods.
        If no weights are given, it may also return calculated weights.
     """
-    nums = [hic_data for hic_data in read_matrix(x, one=False)]
+    if use_topdom and issparse(x):
+        nums = [x]
+    else:
+        nums = [hic_data for hic_data in read_matrix(x, one=False)]
 
     if not use_topdom:
         size = len(nums[0])
@@ -89,10 +93,11 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
         ret = TopDom(nums[0],window_size=topdom_window)
 
 
+        # TopDom ends are exclusive, TADbit ones inclusive
         for key in sorted(ret):
             result['tag'].append(ret[key]['tag'])
             result['start'].append(ret[key]['start'])
-            result['end'].append(ret[key]['end'])
+            result['end'].append(ret[key]['end'] - 1)
             if ret[key]['tag'] == 'domain':
                 result['score'].append(ret[key]['score'])
             else:
@@ -182,24 +187,28 @@ def TopDom(hic_data,window_size,statFilter=True):
     """
     Python implementation of the algorithm TopDom for the identification of TADs. See http://www.ncbi.nlm.nih.gov/pubmed/26704975 and http://zhoulab.usc.edu/TopDom/
 
-    :param hic_data: a list corresponding to the Hi-C data
+    Only the diagonals of the matrix closer than 2 * window_size to the main
+    diagonal are used (and loaded in memory).
+
+    :param hic_data: a list corresponding to the Hi-C data, or a scipy sparse
+       matrix
     :param window_size: window size parameter for the TopDom algorithm
     :param True statFilter: whether to apply or not statistical filtering for false detection of TADs
 
     :returns: the :py:func:`list` of topologically associated domains, boundaries and gaps. Domains include the mean value
         of computed p-values by Wilcox Ranksum Test as score while boundaries and gaps have a score of zero.
     """
-    n_bins = len(hic_data)
-    mean_cf = np.zeros(n_bins)
+    if issparse(hic_data):
+        csr_mat = csr_matrix(hic_data, dtype=float)
+    else:
+        csr_mat = hic_data.get_hic_data_as_csr()
+    n_bins = csr_mat.shape[0]
     pvalue = np.ones(n_bins)
 
     local_ext = np.ones(n_bins)*(-0.5)
 
     #Step 1
-    csr_mat = hic_data.get_hic_data_as_csr()
-    for i in range(n_bins):
-        diamond_mean = Get_Diamond_Matrix_Mean(data=csr_mat, i=i, size=window_size)
-        mean_cf[i] = diamond_mean
+    mean_cf = _diamond_means(csr_mat, window_size)
 
     #Step 2
     gap_idx = Which_Gap_Region(data=csr_mat)
@@ -216,35 +225,18 @@ def TopDom(hic_data,window_size,statFilter=True):
 
     if statFilter:
         #Step 3
-        lil_mat = csr_mat.todense()
-        for k in range(1,(2*window_size)):
-
-            mat_row = []
-            mat_column = []
-            my_range = list(range((n_bins*k), (n_bins*n_bins), 1+n_bins))
-            mat_values = np.empty(len(my_range))
-            col_arr = 0
-            for j in my_range:
-                mat_row.append(int(round(j//lil_mat.shape[0])))
-                mat_column.append(j%lil_mat.shape[0])
-                mat_values[col_arr] = lil_mat[int(round(j//lil_mat.shape[0])),j%lil_mat.shape[0]]
-                col_arr = col_arr + 1
-            
-            scale_values = scale(mat_values)
-            
-            for i in range(len(mat_row)):
-                lil_mat[mat_column[i],mat_row[i]] = scale_values[i]
-
+        # each upper diagonal k (up to 2 * window_size) replaced by the
+        # scaled values of the lower diagonal k
+        band = [None] + [scale(csr_mat.diagonal(-k)) if k < n_bins else np.zeros(0)
+                         for k in range(1, 2 * window_size)]
 
         for key in proc_regions:
             start = proc_regions[key]['start']
             end = proc_regions[key]['end']
 
-            pvalue[start:end] = Get_Pvalue(data=lil_mat[start:end+1, start:end+1], size=window_size, scale=1)
+            pvalue[start:end] = _topdom_pvalues(band, start, end, size=window_size)
 
-        for i in range(len(local_ext)):
-            if local_ext[i] == -1 and pvalue[i] < 0.05:
-                local_ext[i] = -2
+        local_ext[(local_ext == -1) & (pvalue < 0.05)] = -2
         local_ext[local_ext==-1] = 0
         local_ext[local_ext==-2] = -1
 
@@ -262,38 +254,57 @@ def TopDom(hic_data,window_size,statFilter=True):
 
     return domains
 
-def Get_Diamond_Matrix_Mean(data, i, size):
-
+def _diamond_means(data, size):
+    """
+    Mean of the interactions between the size bins upstream of each bin
+    (including it) and the size bins downstream, computed from the prefix
+    sums of the diagonals of the matrix (NaN for the last bin).
+    """
     n_bins = data.shape[1]
-    if i==n_bins-1:
-        return
-    
-    lowerbound = max( 0, i-size+1 )
-    upperbound = min( i+size+1, n_bins)
-    
-    return (data[lowerbound:(i+1),(i+1):upperbound].mean())
+    pos = np.arange(n_bins - 1)
+    lowerbound = np.maximum(0, pos - size + 1)
+    upperbound = np.minimum(pos + size + 1, n_bins)
+    sums = np.zeros(n_bins - 1)
+    for k in range(1, min(2 * size, n_bins)):
+        cumsum = np.concatenate(([0], np.cumsum(data.diagonal(k))))
+        # rows of the diamond crossing diagonal k
+        beg = np.maximum(lowerbound, pos + 1 - k)
+        end = np.minimum(pos, upperbound - 1 - k) + 1
+        inside = end > beg
+        sums[inside] += cumsum[end[inside]] - cumsum[beg[inside]]
+    mean_cf = np.empty(n_bins)
+    mean_cf.fill(np.nan)
+    mean_cf[:-1] = sums / ((pos + 1 - lowerbound) * (upperbound - pos - 1))
+    return mean_cf
 
 def Which_Gap_Region(data):
 
     n_bins = data.shape[1]
-    
+
+    # for each bin, the closest bin upstream (or itself) with which it
+    # interacts (-1 if none)
+    coo = data.tocoo()
+    nonzero = coo.data != 0
+    rows, cols = coo.row[nonzero], coo.col[nonzero]
+    left = np.ones(n_bins, dtype=int) * -1
+    np.maximum.at(left, np.maximum(rows, cols), np.minimum(rows, cols))
+
     gap = np.zeros(n_bins)
-    
+
+    # a stretch of bins i..j is a gap if its sub-matrix is empty
     i=0
     while i < n_bins:
-    
+
         j = i + 1
-        while j < n_bins:
-            if data[i:j+1, i:j+1].sum() == 0:
-                gap[i:j+1] = -0.5
-                j = j+1
-            else:
-                break
-        
+        while j < n_bins and left[i] < i and left[j] < i:
+            j = j+1
+        if j > i + 1:
+            gap[i:j] = -0.5
+
         i = j
-    
+
     idx = np.where(gap==-0.5)[0]
-    
+
     #return dict(zip(idx,idx))
     return idx
 
@@ -380,9 +391,8 @@ def Data_Norm(x, y):
     scale_x = 1 / ( np.abs(np.diff(x) ) ).mean()
     scale_y = 1 / ( np.abs(np.diff(y) ) ).mean()
 
-    for i in range(1,len(x)):
-        ret_x[i] = ret_x[i-1] + (diff_x[i-1]*scale_x)
-        ret_y[i] = ret_y[i-1] + (diff_y[i-1]*scale_y)
+    ret_x[1:] = np.cumsum(np.concatenate(([ret_x[0]], diff_x * scale_x)))[1:]
+    ret_y[1:] = np.cumsum(np.concatenate(([ret_y[0]], diff_y * scale_y)))[1:]
 
 
     #return dict(zip(ret_x,ret_y))
@@ -476,68 +486,283 @@ def scale(y):
 
     return x
 
-def Get_Pvalue(data, size, scale):
-
-    n_bins = data.shape[0]
-    pvalue = np.ones(n_bins-1)
-
-    for i in range(1,n_bins):
-        dia = Get_Diamond_Matrix2(data, i, size=size)
-        ups = Get_Upstream_Triangle(data, i, size=size)
-        downs = Get_Downstream_Triangle(data, i, size=size)
-
-        wil_test =  mannwhitneyu(x=dia*scale, y=ups+downs, use_continuity=True, alternative='less')
-        pvalue[i-1] = wil_test.pvalue
-
-
-    pvalue[ np.isnan(pvalue) ] = 1
+def _topdom_pvalues(band, start, end, size):
+    """
+    p-values of the Wilcoxon rank-sum test comparing, for each bin of a
+    region (but the first), the interactions of its diamond to the ones
+    of the upstream and downstream triangles.
+
+    :param band: list of the scaled upper diagonals of the matrix (index
+       being the distance to the main diagonal)
+    :param start: first bin of the region
+    :param end: last bin of the region (included)
+    :param size: window size
+    """
+    n_bins = end - start + 1
+    pos = np.arange(1, n_bins)
+
+    # cells (row, column) of the diamond and triangles relative to the bin
+    dia = [(-k, c) for k in range(1, size + 1) for c in range(size)]
+    ups = [(p - size - 1, q - size - 1) for p in range(size + 1)
+           for q in range(p + 1, size + 1)]
+    downs = [(p, q) for p in range(size) for q in range(p + 1, size)]
+
+    def get_cells(cells):
+        rows = pos[:, None] + np.array([r for r, _ in cells], dtype=int)
+        cols = pos[:, None] + np.array([c for _, c in cells], dtype=int)
+        valid = (rows >= 0) & (cols < n_bins)
+        values = np.empty(rows.shape)
+        values.fill(np.nan)
+        for k in set(c - r for r, c in cells):
+            diag = (cols - rows == k) & valid
+            values[diag] = band[k][start + rows[diag]]
+        return values, valid
+
+    x, valid_x = get_cells(dia)
+    y, valid_y = get_cells(ups + downs)
+    # NaNs are excluded from the diamond, and zeros from the triangles (where
+    # NaNs lead to a p-value of 1)
+    x[~valid_x] = np.nan
+    nan_y = (valid_y & np.isnan(y)).any(axis=1)
+    y[~valid_y | (y == 0)] = np.nan
+
+    pvalue = _mannwhitneyu_less(x, y)
+    pvalue[nan_y | np.isnan(pvalue)] = 1
 
     return(pvalue)
 
-def Get_Diamond_Matrix2(data, i, size):
-
-    n_bins = data.shape[0]
-    #new_mat = np.ones_like(data)*np.NaN
-    new_mat = np.ones(shape=(size,size))*np.NaN
-
-    for k in range(1,size+1):
-        if i-(k-1) >= 1 and i < n_bins:
-            lower = min(i+1, n_bins)
-            upper = min(i+size, n_bins)
-            new_mat[size-(k-1)-1,0:(upper-lower+1)] = data[i-(k-1)-1,lower-1:upper]
-
-    new_mat = new_mat[np.logical_not(np.isnan(new_mat))]
-
-    return ((new_mat.transpose()).flatten()).tolist()
-
-def Get_Upstream_Triangle(data, i, size):
-
-    lower = max(1, i-size)
-    tmp_mat = data[lower-1:i,lower-1:i]
-
-    triag = (np.triu(tmp_mat,k=1).flatten())
+def _mannwhitneyu_less(x, y):
+    """
+    Mann-Whitney U test (alternative hypothesis: x lower than y, with
+    continuity correction) for each row of x and y (NaNs being excluded), as
+    computed by scipy.stats.mannwhitneyu (exact test for small samples
+    without ties, normal approximation otherwise).
+    """
+    n1 = np.sum(~np.isnan(x), axis=1)
+    n2 = np.sum(~np.isnan(y), axis=1)
+    pvalue = np.ones(len(x))
+
+    # U statistic of y, by chunks of rows
+    u_stat = np.zeros(len(x))
+    chunk = max(1, (1 << 22) // max(1, x.shape[1] * y.shape[1]))
+    for beg in range(0, len(x), chunk):
+        xx = x[beg:beg + chunk, :, None]
+        yy = y[beg:beg + chunk, None, :]
+        u_stat[beg:beg + chunk] = (np.sum(xx < yy, axis=(1, 2)) +
+                                   0.5 * np.sum(xx == yy, axis=(1, 2)))
+
+    # tie correction (sum of t^3 - t for each group of t equal values)
+    values = np.sort(np.hstack((x, y)), axis=1)
+    start = np.ones(values.shape, dtype=bool)
+    start[:, 1:] = values[:, 1:] != values[:, :-1]
+    groups = np.cumsum(start, axis=1) - 1 + np.arange(len(values))[:, None] * values.shape[1]
+    present = ~np.isnan(values)
+    counts = np.bincount(groups[present], minlength=values.size).astype(float)
+    tie_term = np.bincount(np.arange(values.size) // values.shape[1],
+                           weights=counts ** 3 - counts, minlength=len(values)
+                           )[:len(values)]
+    ties = tie_term > 0
+
+    exact = (n1 > 0) & (n2 > 0) & ((n1 <= 8) | (n2 <= 8)) & ~ties
+    asymptotic = (n1 > 0) & (n2 > 0) & ~exact
+    for m, n in set(zip(n1[exact], n2[exact])):
+        rows = exact & (n1 == m) & (n2 == n)
+        cdf = _mwu_cdf(m, n)
+        pvalue[rows] = np.clip(cdf[m * n - u_stat[rows].astype(int)], 0, 1)
+
+    n1, n2 = n1[asymptotic].astype(float), n2[asymptotic].astype(float)
+    n = n1 + n2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.sqrt(n1*n2/12 * ((n + 1) - tie_term[asymptotic]/(n*(n-1))))
+        z = (u_stat[asymptotic] - n1 * n2 / 2 - 0.5) / s
+    pvalue[asymptotic] = np.clip(norm.sf(z), 0, 1)
+    return pvalue
+
+# cumulative distributions of the U statistic, by sizes of the samples
+_MWU_CDF = {}
+
+def _mwu_cdf(m, n):
+    """
+    Cumulative distribution of the Mann-Whitney U statistic for samples of
+    sizes m and n, under the null hypothesis.
+    """
+    if (m, n) in _MWU_CDF:
+        return _MWU_CDF[m, n]
+    # number of arrangements giving each value of U (Mann and Whitney 1947)
+    counts = [[np.ones(1)] * (n + 1)]
+    for i in range(1, m + 1):
+        counts.append([np.ones(1)])
+        for j in range(1, n + 1):
+            cnt = np.zeros(i * j + 1)
+            cnt[j:] += counts[i - 1][j]
+            cnt[:len(counts[i][j - 1])] += counts[i][j - 1]
+            counts[i].append(cnt)
+    _MWU_CDF[m, n] = np.cumsum(counts[m][n] / binom(m + n, m))
+    return _MWU_CDF[m, n]
+
+
+def _band_prefix_sums(rows, cols, values, size, width, dtype=float):
+    """
+    2D cumulative sums of a band of the upper triangle of a matrix, stored in
+    diagonal coordinates (only the first width diagonals are kept).
+
+    :param rows: rows of the interactions (relative to the chromosome)
+    :param cols: columns of the interactions (cols - rows must be lower than
+       width)
+    :param values: values of the interactions
+    :param size: number of rows/columns of the matrix
+    :param width: number of diagonals in the band
+    :param float dtype: type of the sums
+
+    :returns: the prefix sums along the anti-diagonals of the band, and
+       cumulative sum of the rows of the band (see :func:`_band_rectangle`)
+    """
+    # cumulative sums of each row of the band (index: distance to diagonal)
+    band = np.zeros((size, width + 1), dtype=dtype)
+    band[rows, cols - rows + 1] = values
+    np.cumsum(band, axis=1, out=band)
+    rows_total = np.zeros(size + 1, dtype=dtype)
+    np.cumsum(band[:, -1], out=rows_total[1:])
+    # partial row sums shifted by the distance to the diagonal, and summed
+    # along the anti-diagonals
+    anti = np.zeros((size + width + 1, width + 2), dtype=dtype)
+    anti[np.arange(size)[:, None] + np.arange(width + 1),
+         np.arange(width + 1)] = band
+    anti = np.cumsum(anti[:, ::-1], axis=1)[:, ::-1]
+    return anti, rows_total
+
+
+def _band_prefix(prefix, beg, end):
+    """
+    Sum of the cells (i, j) of the band with i < beg and i <= j < end
+    """
+    anti, rows_total = prefix
+    width = anti.shape[1] - 2
+    beg = np.minimum(beg, end)
+    dist = np.minimum(end - beg, width)
+    return anti[beg + dist, dist + 1] + rows_total[beg + dist - width]
 
-    return triag[triag!=0].tolist()
 
-def Get_Downstream_Triangle(data, i, size):
+def _band_rectangle(prefix, row1, row2, col1, col2):
+    """
+    Sum of the cells of the band within rows row1 to row2 and columns col1 to
+    col2 (all included). Each argument can be an array of positions.
+    """
+    return (_band_prefix(prefix, row2 + 1, col2 + 1) -
+            _band_prefix(prefix, row1    , col2 + 1) -
+            _band_prefix(prefix, row2 + 1, col1    ) +
+            _band_prefix(prefix, row1    , col1    ))
 
-    n_bins = data.shape[0]
-    if i==n_bins:
-        return NaN
 
-    upperbound = min(i+size, n_bins)
-    tmp_mat = data[i:upperbound, i:upperbound]
+def _window_means(values, valid, delta):
+    """
+    Mean of the valid values in the delta bins before, and in the delta bins
+    after each bin.
+    """
+    size = len(values)
+    vals = np.zeros(size + 2 * delta)
+    vals[delta:delta + size] = np.where(valid, values, 0)
+    nums = np.zeros(size + 2 * delta)
+    nums[delta:delta + size] = valid
+    up_sum = np.zeros(size)
+    dw_sum = np.zeros(size)
+    up_num = np.zeros(size)
+    dw_num = np.zeros(size)
+    for spos in range(1, delta + 1):
+        up_sum += vals[delta - spos:delta - spos + size]
+        dw_sum += vals[delta + spos:delta + spos + size]
+        up_num += nums[delta - spos:delta - spos + size]
+        dw_num += nums[delta + spos:delta + spos + size]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return up_sum / up_num, dw_sum / dw_num
+
+
+def _insulation_tracks(hic_data, dists, normalize=False, delta=0):
+    """
+    Insulation scores of all bins for all the pairs of distances, from the
+    prefix sums of the band of each chromosome (see :func:`insulation_score`).
 
-    triag = (np.triu(tmp_mat,k=1).flatten())
+    :returns: insulation scores, deltas and positions where they are defined,
+       as arrays with one row per pair of distances and one column per bin
+    """
+    bias = hic_data.bias
+    bads = hic_data.bads
+    decay = hic_data.expected
+    if not decay or not bias:
+        raise Exception('ERROR: HiC_data should be normalized by visibility '
+                        'and by expected')
 
-    return triag[triag!=0].tolist()
+    insidx = np.empty((len(dists), len(hic_data)))
+    insidx.fill(np.nan)
+    deltas = insidx.copy()
+    valid = np.zeros(insidx.shape, dtype=bool)
+    # the window of the largest distance covers at most 2 * end diagonals
+    width = 2 * max(end for _, end in dists) + 1
+    for crm in hic_data.chromosomes:
+        beg, end = hic_data.section_pos[crm]
+        size = end - beg
+        windows = [(num, dist, wend) for num, (dist, wend) in enumerate(dists)
+                   if size > 2 * wend]
+        if not windows:
+            continue
+        if crm in decay:
+            this_decay = decay[crm]
+        else:
+            this_decay = decay
+        # only the distances used by the windows are normalized by expected
+        expc = np.ones(width)
+        for k in set(k for _, dist, wend in windows
+                     for k in range(2 * dist, 2 * wend + 1)):
+            expc[k] = this_decay[k]
+        good = np.ones(size, dtype=bool)
+        good[[b - beg for b in bads if beg <= b < end]] = False
+        biases = hic_data._bias_array(beg, end)
+
+        rows, cols, values = hic_data._coo_region(beg, end, beg, end)
+        rows = rows - beg
+        cols = cols - beg
+        keep = (cols >= rows) & (cols - rows < width)
+        keep[keep] &= good[rows[keep]] & good[cols[keep]]
+        rows, cols = rows[keep], cols[keep]
+        values = (values[keep] / biases[rows] / biases[cols] /
+                  expc[cols - rows])
+        prefix = _band_prefix_sums(rows, cols, values, size, width)
+        # number of interactions, to get exact zeros in empty windows
+        counts = _band_prefix_sums(rows, cols, values != 0, size, width,
+                                   dtype=int)
+
+        for num, dist, wend in windows:
+            pos = np.arange(wend, size - wend)
+            vals = _band_rectangle(prefix, pos - wend, pos - dist,
+                                   pos + dist, pos + wend)
+            vals[_band_rectangle(counts, pos - wend, pos - dist,
+                                 pos + dist, pos + wend) == 0] = 0
+            if normalize:
+                total = vals.mean()
+                if total == 0:
+                    total = float('nan')
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    vals = np.log2(vals / total)
+            insidx[num, beg + pos] = vals
+            valid[num, beg + pos] = True
+            if delta:
+                up_vals, dw_vals = _window_means(insidx[num, beg:end],
+                                                 valid[num, beg:end], delta)
+                with np.errstate(invalid='ignore'):
+                    deltas[num, beg + pos] = (up_vals - dw_vals)[pos]
+    return insidx, deltas, valid
 
 
 def insulation_score(hic_data, dists, normalize=False, resolution=1,
-                     delta=0, silent=False, savedata=None, savedeltas=None):
+                     delta=0, silent=False, savedata=None, savedeltas=None,
+                     as_array=False):
     """
     Compute insulation score.
 
+    For each chromosome, the 2D cumulative sums of the band of the normalized
+    matrix (up to the largest distance) are computed once, and used to get the
+    sum of each window for all the pairs of distances.
+
     :param hic_dada: HiC_data object already normalized
     :param dists: list of pairs of distances between which to compute the
        insulation score. E.g. 4,5 means that for a given bin B(i), all
@@ -550,87 +775,23 @@ def insulation_score(hic_data, dists, normalize=False, resolution=1,
     :param False silent:
     :param None savedata: path to file where to save result
     :param None savedeltas: path to file where to save deltas
+    :param False as_array: return numpy arrays with one row per pair of
+       distances and one column per bin (NaN where the insulation score is
+       not computed), instead of dictionaries
 
     :returns: dictionary with insulation score
     """
-    bias = hic_data.bias
-    bads = hic_data.bads
-    decay = hic_data.expected
-    if not decay or not bias:
-        raise Exception('ERROR: HiC_data should be normalized by visibility '
-                        'and by expected')
-
-    insidx = {}
-    deltas = {}
-    for dist, end in dists:
-        if not silent:
+    dists = [tuple(dist) for dist in dists]
+    if not silent:
+        for dist, end in dists:
             print(' - computing insulation in band %d-%d' % (dist, end))
-        insidx[(dist, end)] = {}
-        deltas[(dist, end)] = {}
-        for crm in hic_data.chromosomes:
-            if crm in decay:
-                this_decay = decay[crm]
-            else:
-                this_decay = decay
-            total = 0
-            count = 0
-            for pos in range(hic_data.section_pos[crm][0] + end,
-                             hic_data.section_pos[crm][1] - end):
-                val = sum(hic_data[i, j] / bias[i] / bias[j] / this_decay[abs(j-i)]
-                          for i in range(pos - end, pos - dist + 1)
-                          if not i in bads
-                          for j in range(pos + dist, pos + end + 1)
-                          if not j in bads)
-                total += val
-                count += 1
-                insidx[(dist, end)][pos] = val
-            if normalize:
-                try:
-                    total /= float(count)
-                except ZeroDivisionError:
-                    pass
-                if total == 0:
-                    total = float('nan')
-                for pos in range(hic_data.section_pos[crm][0] + end,
-                                 hic_data.section_pos[crm][1] - end):
-                    try:
-                        with np.errstate(divide='ignore'):
-                            insidx[(dist, end)][pos] = np.log2(insidx[(dist, end)][pos] / total)
-                    except ZeroDivisionError:
-                        insidx[(dist, end)][pos] = float('nan')
-            if deltas:
-                for pos in range(hic_data.section_pos[crm][0] + end,
-                                 hic_data.section_pos[crm][1] - end):
-                    up_vals = []
-                    dw_vals = []
-                    for spos in range(delta):
-                        try:
-                            up_vals.append(insidx[(dist, end)][pos - delta + spos])
-                        except KeyError:
-                            pass
-                        try:
-                            dw_vals.append(insidx[(dist, end)][pos + delta - spos])
-                        except KeyError:
-                            pass
-                    with np.errstate(invalid='ignore'):
-                        deltas[(dist, end)][pos] = (np.mean(up_vals) - np.mean(dw_vals))
-
-    if savedata:
-        out = open(savedata, 'w')
-        out.write('# CRM\tCOORD\t' + '\t'.join(['%d-%d' % (d1, d2)
-                                                for d1, d2 in dists]) +
-                  '\n')
-        for crm in hic_data.section_pos:
-            for pos in range(*hic_data.section_pos[crm]):
-                beg = (pos - hic_data.section_pos[crm][0]) * resolution
-                out.write('{}\t{}-{}\t{}\n'.format(
-                    crm, beg + 1, beg + resolution,
-                    '\t'.join([str(insidx[dist].get(pos, 'NaN'))
-                               for dist in dists])))
-        out.close()
+    ins_array, delta_array, valid = _insulation_tracks(
+        hic_data, dists, normalize=normalize, delta=delta)
 
-    if savedeltas:
-        out = open(savedeltas, 'w')
+    for fname, array in ((savedata, ins_array), (savedeltas, delta_array)):
+        if not fname:
+            continue
+        out = open(fname, 'w')
         out.write('# CRM\tCOORD\t' + '\t'.join(['%d-%d' % (d1, d2)
                                                 for d1, d2 in dists]) +
                   '\n')
@@ -639,53 +800,92 @@ def insulation_score(hic_data, dists, normalize=False, resolution=1,
                 beg = (pos - hic_data.section_pos[crm][0]) * resolution
                 out.write('{}\t{}-{}\t{}\n'.format(
                     crm, beg + 1, beg + resolution,
-                    '\t'.join([str(deltas[dist].get(pos, 'NaN'))
-                               for dist in dists])))
+                    '\t'.join([str(float(array[num, pos]))
+                               if valid[num, pos] else 'NaN'
+                               for num in range(len(dists))])))
         out.close()
 
+    if as_array:
+        if delta:
+            return ins_array, delta_array
+        return ins_array
+
+    insidx = {}
+    deltas = {}
+    for num, dist in enumerate(dists):
+        positions = np.flatnonzero(valid[num]).tolist()
+        insidx[dist] = dict(zip(positions, ins_array[num, positions].tolist()))
+        deltas[dist] = dict(zip(positions, delta_array[num, positions].tolist()))
     if delta:
         return insidx, deltas
     return insidx
 
 
+def _track_array(track, default, size):
+    """
+    Array of the values of an insulation (or delta) track, with the given
+    default value where not defined. Index is shifted by one, so that the
+    position -1 is also defined.
+    """
+    array = np.empty(size + 2)
+    array.fill(default)
+    positions = np.fromiter(track.keys(), dtype=int, count=len(track))
+    values = np.fromiter(track.values(), dtype=float, count=len(track))
+    keep = (positions >= -1) & (positions <= size)
+    array[positions[keep] + 1] = values[keep]
+    return array
+
+
 def insulation_to_borders(ins_score, deltas, min_strength=0.1):
     """
     Best (for human-like genome size) according to https://doi.org/10.1038/nature14450
     is (at 10kb resolution) to use awindow size of 500 kb (use the function
     insulation_score with dist=(1,50)) and a delta of 100 kb (10 bins).
 
+    :param ins_score: insulation score of one pair of distances, either as a
+       dictionary or as an array (as returned by :func:`insulation_score`,
+       positions with NaN are not defined)
+    :param deltas: deltas of the same pair of distances (dictionary or array)
+    :param 0.1 min_strength: minimum strength of the borders returned
 
     :returns: the position in bin of each border, and the intensity of the
        border (sigmoid normalized, from 0 to 1)
     """
-    borders = []
-    for pos in range(max(ins_score)):
-        if (ins_score.get(pos, 100) >= ins_score.get(pos + 1, -100)
-            or
-            ins_score.get(pos, 100) >= ins_score.get(pos - 1, -100)):
-            continue
-        if not (deltas.get(pos - 1, 100) > 0 and
-                deltas.get(pos + 1, -100) < 0):
-            continue
-        # left
-        lo = 1
-        prev_lv = deltas.get(pos - 1, 100)
-        while pos - 1 - lo > 0:
-            lv = deltas.get(pos - 1 - lo, 100)
-            if lv < prev_lv:
-                break
-            prev_lv = lv
-            lo += 1
-        # right
-        ro = 1
-        prev_rv = deltas.get(pos + 1, -100)
-        while pos + 1 + ro <= len(deltas):
-            rv = deltas.get(pos + 1 + ro, -100)
-            if rv > prev_rv:
-                break
-            prev_rv = rv
-            ro += 1
-        strength = 1. / (1 + np.exp(-(prev_lv - prev_rv))) * 2 - 1
-        if strength > min_strength:
-            borders.append((pos, strength))
-    return borders
+    if not isinstance(ins_score, dict):
+        defined = np.flatnonzero(~np.isnan(ins_score))
+        ins_score = dict(zip(defined.tolist(), np.asarray(ins_score)[defined]))
+        deltas = dict(zip(defined.tolist(), np.asarray(deltas)[defined]))
+    if not ins_score:
+        return []
+    last = max(ins_score)
+    num_deltas = len(deltas)
+    size = max(last, num_deltas) + 2
+    # arrays shifted by one position (index 0 is position -1)
+    ins_self = _track_array(ins_score, 100, size)
+    ins_next = _track_array(ins_score, -100, size)
+    delta_lo = _track_array(deltas, 100, size)
+    delta_hi = _track_array(deltas, -100, size)
+    pos = np.arange(last)
+    # local minima of the insulation score
+    with np.errstate(invalid='ignore'):
+        ok = ~((ins_self[pos + 1] >= ins_next[pos + 2]) |
+               (ins_self[pos + 1] >= ins_next[pos]))
+        # with deltas going from positive to negative
+        ok &= (delta_lo[pos] > 0) & (delta_hi[pos + 2] < 0)
+    pos = pos[ok]
+    if not len(pos):
+        return []
+    # deltas increase to the left of the border (position 0 is never reached)
+    idx = np.arange(size + 2)
+    with np.errstate(invalid='ignore'):
+        stop = (idx <= 2) | np.r_[True, delta_lo[:-1] < delta_lo[1:]]
+    left = np.maximum.accumulate(np.where(stop, idx, 0))
+    # and decrease to the right (up to the number of deltas)
+    with np.errstate(invalid='ignore'):
+        stop = (idx > num_deltas) | np.r_[delta_hi[1:] > delta_hi[:-1], True]
+    right = np.minimum.accumulate(np.where(stop, idx, size + 1)[::-1])[::-1]
+    prev_lv = delta_lo[left[pos]]
+    prev_rv = delta_hi[right[pos + 2]]
+    strength = 1. / (1 + np.exp(-(prev_lv - prev_rv))) * 2 - 1
+    keep = strength > min_strength
+    return list(zip(pos[keep].tolist(), strength[keep].tolist()))
@@ -34,10 +34,11 @@ from pytadbit.mapping.filter         import MASKED
 from pytadbit.utils.file_handling    import mkdir
 from pytadbit.utils                  import printime
 from pytadbit.parsers.hic_bam_parser import filters_to_bin
-from pytadbit.parsers.hic_bam_parser import write_matrix, get_matrix
+from pytadbit.parsers.hic_bam_parser import write_matrix, get_matrix, zoomify
 from pytadbit.parsers.tad_parser     import parse_tads
 from pytadbit.utils.sqlite_utils     import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils     import add_path, get_jobid, print_db, retry
+from pytadbit.utils.sqlite_utils     import get_zoomify
 from pytadbit.utils.extraviews       import tadbit_savefig, nicer
 from pytadbit.utils.extraviews       import plot_HiC_matrix, format_HiC_axes
 
@@ -180,6 +181,20 @@ def run(opts):
 
     out_files = {}
     out_plots = {}
+    out_mcool = None
+
+    if opts.zoomify:
+        printime('Building multi-resolution cooler')
+        out_mcool = path.join(outdir, 'zoomify_%s.mcool' % param_hash)
+        mcool = zoomify(mreads, [opts.reso] + opts.zoomify, out_mcool,
+                        filter_exclude=opts.filter, ncpus=opts.cpus,
+                        nchunks=opts.nchunks, tmpdir=tmpdir, clean=clean,
+                        verbose=not opts.quiet)
+    else:
+        mcool = get_zoomify(opts.workdir, mreads, opts.reso, opts.filter,
+                            tmpdb=opts.tmpdb)
+        if mcool:
+            printime('Reading interactions from %s' % mcool)
 
     if opts.matrix or opts.plot:
         sections, section_pos = get_sections(mreads, opts.chr_name)
@@ -198,7 +213,8 @@ def run(opts):
                     return_headers=True,
                     nchunks=opts.nchunks, verbose=not opts.quiet,
                     clean=clean, max_size=max_size,
-                    chr_order=opts.chr_name)
+                    chr_order=opts.chr_name, mcool=mcool,
+                    cache=True)  # same region for each normalization
             except NotImplementedError:
                 if norm == "raw&decay":
                     warn('WARNING: raw&decay normalization not implemented '
@@ -314,7 +330,7 @@ def run(opts):
             tmpdir=tmpdir, append_to_tar=None, ncpus=opts.cpus,
             nchunks=opts.nchunks, verbose=not opts.quiet,
             extra=param_hash, cooler=opts.cooler, clean=clean,
-            chr_order=opts.chr_name))
+            chr_order=opts.chr_name, mcool=mcool))
 
     if clean:
         printime('Cleaning')
@@ -323,11 +339,13 @@ def run(opts):
     if not opts.interactive:
         printime('Saving to DB')
         finish_time = time.localtime()
-        save_to_db(opts, launch_time, finish_time, out_files, out_plots)
+        save_to_db(opts, launch_time, finish_time, out_files, out_plots,
+                   out_mcool)
 
 
 @retry(lite.OperationalError, tries=20, delay=2)
-def save_to_db(opts, launch_time, finish_time, out_files, out_plots):
+def save_to_db(opts, launch_time, finish_time, out_files, out_plots,
+               out_mcool=None):
     if 'tmpdb' in opts and opts.tmpdb:
         # check lock
         while path.exists(path.join(opts.workdir, '__lock_db')):
@@ -389,6 +407,7 @@ def save_to_db(opts, launch_time, finish_time, out_files, out_plots):
             add_path(cur, out_files[fnam], fnam + '_MATRIX', jobid, opts.workdir)
         for fnam in out_plots:
             add_path(cur, out_plots[fnam], fnam + '_FIGURE', jobid, opts.workdir)
+        add_path(cur, out_mcool, 'HIC_MCOOL', jobid, opts.workdir)
         if not opts.quiet:
             print_db(cur, 'JOBs')
             print_db(cur, 'PATHs')
@@ -423,6 +442,10 @@ def check_options(opts):
     if not path.exists(opts.workdir):
         raise IOError('ERROR: workdir not found.')
 
+    if opts.zoomify and any(reso % opts.reso for reso in opts.zoomify):
+        raise Exception('ERROR: zoomify resolutions should be multiples of '
+                        'the resolution (%d)' % opts.reso)
+
     # check resume
     if opts.triangular and opts.coord2:
         raise NotImplementedError('ERROR: triangular is only available for '
@@ -540,6 +563,15 @@ def populate_args(parser):
                         help='''Write i,j,v matrix in cooler format instead of text.
                         ''')
 
+    outopt.add_argument('--zoomify', dest='zoomify', metavar="INT", nargs='+',
+                        default=None, type=int,
+                        help='''coarser resolutions at which to store the
+                        interactions, together with the one of -r, in a
+                        multi-resolution cooler. The BAM is parsed only once.
+                        This cooler is stored in the database, and later runs
+                        of bin, normalize and segment read the interactions
+                        from it instead of parsing the BAM.''')
+
     outopt.add_argument('--rownames', dest='row_names', action='store_true',
                         default=False,
                         help='''To store row names in the output text matrix.
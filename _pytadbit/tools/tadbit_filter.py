@@ -23,8 +23,9 @@ from pytadbit.utils.file_handling    import mkdir
 from pytadbit.utils.sqlite_utils     import get_jobid, add_path, get_path_id, print_db
 from pytadbit.utils.sqlite_utils     import already_run, digest_parameters, retry
 from pytadbit.mapping.analyze        import fragment_size
-from pytadbit.mapping.filter         import filter_reads, apply_filter
+from pytadbit.mapping.filter         import filter_reads, apply_filter, MASKED
 from pytadbit.parsers.hic_bam_parser import bed2D_to_BAMhic
+from pytadbit.parsers.pairs_parser   import is_pairs
 
 
 DESC = "Filter parsed Hi-C reads and get valid pair of reads to work with"
@@ -38,12 +39,21 @@ def run(opts):
 
     param_hash = digest_parameters(opts)
 
+    ext = 'pairs' if opts.pairs and not opts.fast_fragment else 'tsv'
     reads = path.join(opts.workdir, '03_filtered_reads',
-                      'all_r1-r2_intersection_%s.tsv' % param_hash)
+                      'all_r1-r2_intersection_%s.%s' % (param_hash, ext))
     mreads = path.join(opts.workdir, '03_filtered_reads',
-                       'valid_r1-r2_intersection_%s.tsv' % param_hash)
-
-    if not opts.resume:
+                       'valid_r1-r2_intersection_%s.%s' % (param_hash, ext))
+
+    if opts.resume:
+        # apply a new combination of filters to already filtered reads
+        (reads, count, multiples, median, max_f, mad, hist_path,
+         masked) = load_filters_fromdb(opts)
+        # valid pairs in the same format as the resumed reads
+        ext = 'pairs' if is_pairs(reads) else 'tsv'
+        mreads = path.join(opts.workdir, '03_filtered_reads',
+                           'valid_r1-r2_intersection_%s.%s' % (param_hash, ext))
+    else:
         mkdir(path.join(opts.workdir, '03_filtered_reads'))
 
         if opts.fast_fragment:
@@ -57,7 +67,8 @@ def run(opts):
             # compute the intersection of the two read ends
             print('Getting intersection between read 1 and read 2')
             count, multiples = get_intersection(fname1, fname2, reads,
-                                                compress=opts.compress_input)
+                                                compress=opts.compress_input,
+                                                pairs=opts.pairs, ncpus=opts.cpus)
 
         # compute insert size
         print('Get insert size...')
@@ -101,7 +112,8 @@ def run(opts):
                               min_frag_size=opts.min_frag_size,
                               re_proximity=opts.re_proximity,
                               strict_duplicates=opts.strict_duplicates,
-                              min_dist_to_re=min_dist, fast=True)
+                              min_dist_to_re=min_dist, fast=True,
+                              ncpus=opts.cpus)
 
     n_valid_pairs = apply_filter(reads, mreads, masked, filters=opts.apply)
 
@@ -353,6 +365,80 @@ def load_parameters_fromdb(opts):
     return fname1, fname2
 
 
+def load_filters_fromdb(opts):
+    """
+    Get the outputs of the last filtering job (intersected reads, statistics
+    and filters) in order to apply a new combination of filters.
+    """
+    if 'tmpdb' in opts and opts.tmpdb:
+        dbfile = opts.tmpdb
+    else:
+        dbfile = path.join(opts.workdir, 'trace.db')
+    con = lite.connect(dbfile)
+    with con:
+        cur = con.cursor()
+        # filters are stored by the job that computed them, jobs resuming it
+        # only add their valid pairs (filters are moved to them if forced)
+        try:
+            cur.execute("""
+            select max(JOBid) from FILTER_OUTPUTs where Name != 'valid-pairs'
+            """)
+            jobid = cur.fetchall()[0][0]
+        except lite.OperationalError:
+            jobid = None
+        if jobid is None:
+            raise Exception('ERROR: no filtering job found to resume')
+        cur.execute("""
+        select PATHs.Path, FILTER_OUTPUTs.Name, FILTER_OUTPUTs.Count,
+               FILTER_OUTPUTs.PATHid
+        from FILTER_OUTPUTs join PATHs on FILTER_OUTPUTs.PATHid = PATHs.Id
+        where FILTER_OUTPUTs.JOBid = %d
+        """ % (jobid))
+        masked = {}
+        valid_id = None
+        filter_ids = dict((MASKED[k]['name'], k) for k in MASKED)
+        for fpath, name, fcount, pathid in cur.fetchall():
+            if name == 'valid-pairs':
+                valid_id = pathid
+                continue
+            masked[filter_ids[name]] = {'name' : name, 'reads': int(fcount),
+                                        'fnam' : fpath}
+        if not masked or valid_id is None:
+            raise Exception('ERROR: no filtering job found to resume')
+        cur.execute("""
+        select Total_interactions, Multiple_interactions,
+               Median_fragment_length, MAD_fragment_length, Max_fragment_length
+        from INTERSECTION_OUTPUTs where PATHid = %d
+        """ % (valid_id))
+        real_count, mults, median, mad, max_f = cur.fetchall()[0]
+        # filter files are named after the file of intersected reads
+        k = min(masked)
+        suffix = '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
+        reads = masked[k]['fnam'][:-len(suffix)]
+        # histogram of fragment sizes, stored with the intersected reads
+        cur.execute("""
+        select Path from PATHs where Type = 'FIGURE' and (JOBid = %d or JOBid in
+            (select JOBid from PATHs where Path = '%s'))
+        order by Id
+        """ % (jobid, reads))
+        hist_path = cur.fetchall()
+        hist_path = path.join(opts.workdir, hist_path[0][0]) if hist_path else None
+    for k in masked:
+        masked[k]['fnam'] = path.join(opts.workdir, masked[k]['fnam'])
+    reads = path.join(opts.workdir, reads)
+    multiples = dict((int(k), int(v)) for k, v in (
+        m.split(':') for m in mults.split()))
+    # number of reads before counting each possible pair of multi-contacts
+    count = real_count
+    for mult in multiples:
+        count = count + multiples[mult] - multiples[mult] * ((mult * (mult + 1)) // 2)
+    bitmask = reads + '_filters.npy'
+    if path.exists(bitmask):
+        for k in masked:
+            masked[k]['bitmask'] = bitmask
+    return reads, count, multiples, median, max_f, mad, hist_path, masked
+
+
 def populate_args(parser):
     """
     parse option from call
@@ -470,6 +556,12 @@ def populate_args(parser):
                         format. Short contains only positions of reads mapped,
                         mid everything but restriction sites.''')
 
+    output.add_argument('--pairs', dest='pairs', default=False,
+                        action='store_true',
+                        help='''store intersected (and valid) pairs of reads
+                        in TADbit binary pairs format instead of 2D-bed (tab
+                        separated) files.''')
+
     output.add_argument('--valid', dest='valid', default=False,
                         action='store_true',
                         help='''stores only valid-pairs discards filtered out
@@ -482,8 +574,10 @@ def populate_args(parser):
                         in losing data''')
 
     glopts.add_argument('--samtools', dest='samtools', metavar="PATH",
-                        action='store', default='samtools', type=str,
-                        help='''path samtools binary''')
+                        action='store', default=None, type=str,
+                        help='''path samtools binary, if given samtools is
+                        used to compress and sort the output BAM (by default
+                        it is written with pysam)''')
 
     parser.add_argument_group(glopts)
 
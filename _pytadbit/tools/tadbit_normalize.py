@@ -14,9 +14,9 @@ from os                                   import path, remove, system
 from sys                                  import exc_info, stdout
 from string                               import ascii_letters
 from random                               import random
-from shutil                               import copyfile, rmtree
+from shutil                               import copyfile
 from collections                          import OrderedDict, defaultdict
-from pickle                               import dump, load, HIGHEST_PROTOCOL
+from pickle                               import dump, HIGHEST_PROTOCOL
 from traceback                            import print_exc
 from multiprocessing                      import cpu_count
 import multiprocessing  as mu
@@ -25,9 +25,13 @@ import time
 
 from pysam                                import AlignmentFile
 from numpy                                import nanmean, isnan, nansum, nanpercentile, seterr
+from numpy                                import array, zeros, empty, concatenate
+from numpy                                import frombuffer, flatnonzero, bincount
+from numpy                                import absolute, add, save, int32, int64
+from numpy                                import load as load_array
 from matplotlib                           import pyplot as plt
 
-from pytadbit                             import load_hic_data_from_bam
+from pytadbit.hic_data                    import SparseHiC_data
 from pytadbit.utils.sqlite_utils          import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils          import add_path, get_jobid, print_db, retry
 from pytadbit.utils.file_handling         import mkdir
@@ -104,20 +108,21 @@ def run(opts):
         mappability = parse_mappability_bedGraph(
             opts.mappability, opts.reso,
             wanted_chrom=refs[0] if len(refs)==1 else None)
-        # resize chomosomes
+        # resize chomosomes (same number of bins as GC content)
         for c in refs:
+            nbins = (len(genome[c]) - 1) // opts.reso + 1
             if not c in mappability:
-                mappability[c] = [float('nan')] * (len(refs) // opts.reso + 1)
-            if len(mappability[c]) < len(refs) // opts.reso + 1:
-                mappability[c] += [float('nan')] * (
-                    (len(refs) // opts.reso + 1) - len(mappability[c]))
+                mappability[c] = [float('nan')] * nbins
+            if len(mappability[c]) < nbins:
+                mappability[c] += [float('nan')] * (nbins - len(mappability[c]))
+            mappability[c] = mappability[c][:nbins]
         # concatenates
         mappability = reduce(lambda x, y: x + y,
                              (mappability.get(c, []) for c in refs))
 
         printime('  - Computing GC content per bin (removing Ns)')
         gc_content = get_gc_content(genome, opts.reso, chromosomes=refs,
-                                    n_cpus=opts.cpus)
+                                    cache_dir=path.dirname(path.abspath(opts.fasta)))
         # pad mappability at the end if the size is close to gc_content
         if len(mappability)<len(gc_content) and len(mappability)/len(gc_content) > 0.95:
             mappability += [float('nan')] * (len(gc_content)-len(mappability))
@@ -592,131 +597,100 @@ def nice(reso):
 ################################################################################
 ## TODO: This should be handled in the hic bam parser
 
-def read_bam_frag_valid(inbam, filter_exclude, all_bins, sections,
-                        resolution, outdir, extra_out,region, start, end,
-                        next_position=1, last_position=None):
-    
+_BAM_WORKER = {}
+
+
+def _init_bam_worker(inbam, filter_exclude, section_pos, resolution, outdir,
+                     extra_out, bin_counts, next_position=1,
+                     last_position=None):
+    """
+    Initializes a process reading chunks of a BAM file: opens the file, and
+    stores the parameters common to all chunks.
+
+    :param section_pos: dictionary with, for each chromosome, its first and
+       last bin (not included) in the genome
+    :param bin_counts: shared array (multiprocessing.RawArray) where to sum,
+       for each bin, its cis interactions, total interactions, interactions
+       closer than next_position and interactions between next_position and
+       last_position
+    """
     if last_position is None:
         last_position = next_position * 5
-    
-    bamfile = AlignmentFile(inbam, 'rb')
-    refs = bamfile.references
-    try:
-        dico = {}
-        for r in bamfile.fetch(region=region,
-                               start=start - (1 if start else 0), end=end,  # coords starts at 0
-                               multiple_iterators=True):
-            crm1 = r.reference_name
-            pos1 = r.reference_start + 1
-            crm2 = refs[r.mrnm]
-            pos2 = r.mpos + 1
-            try:
-                pos1 = sections[(crm1, pos1 // resolution)]
-                pos2 = sections[(crm2, pos2 // resolution)]
-            except KeyError:
-                continue  # not in the subset matrix we want
-            try:
-                dico[(pos1, pos2)] += 1
-            except KeyError:
-                dico[(pos1, pos2)] = 1
-        cisprc = {}
-        for (i, j), v in dico.items():
-            if all_bins[i][0] == all_bins[j][0]:
-                diff = abs(j - i)
-                try:
-                    cisprc[i][0] += v  # add to cis interactions
-                    cisprc[i][1] += v  # add to total interactions
-                    if diff <= next_position:
-                        cisprc[i][2] += v  # add to total interactions
-                    elif diff <= last_position:
-                        cisprc[i][3] += v  # add to total interactions
-                except KeyError:
-                    if diff <= next_position:
-                        cisprc[i] = [v, v, v, 0]
-                    elif diff <= last_position:
-                        cisprc[i] = [v, v, 0, v]
-                    else:
-                        cisprc[i] = [v, v, 0, 0]
-            else:
-                try:
-                    cisprc[i][1] += v  # only add to total interactions
-                except KeyError:
-                    cisprc[i] = [0, v, 0, 0]
-        out = open(path.join(outdir,
-                             'tmp_%s:%d-%d_%s.pickle' % (region, start, end, extra_out)), 'wb')
-        dump(dico, out, HIGHEST_PROTOCOL)
-        out.close()
-        out = open(path.join(outdir,
-                             'tmp_bins_%s:%d-%d_%s.pickle' % (region, start, end, extra_out)), 'wb')
-        dump(cisprc, out, HIGHEST_PROTOCOL)
-        out.close()
-    except Exception as e:
-        exc_type, exc_obj, exc_tb = exc_info()
-        fname = path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        print(e)
-        print(exc_type, fname, exc_tb.tb_lineno)
+    _BAM_WORKER.clear()
+    _BAM_WORKER.update({'bamfile'       : AlignmentFile(inbam, 'rb'),
+                        'filter_exclude': filter_exclude,
+                        'section_pos'   : section_pos,
+                        'resolution'    : resolution,
+                        'outdir'        : outdir,
+                        'extra_out'     : extra_out,
+                        'bin_counts'    : frombuffer(bin_counts, dtype=int64
+                                                     ).reshape(-1, 4),
+                        'next_position' : next_position,
+                        'last_position' : last_position})
 
 
-def read_bam_frag_filter(inbam, filter_exclude, all_bins, sections,
-                         resolution, outdir, extra_out,region, start, end,
-                         next_position=1, last_position=None):
+def _close_bam_worker():
+    _BAM_WORKER.pop('bamfile').close()
 
-    if last_position is None:
-        last_position = next_position * 5
 
-    bamfile = AlignmentFile(inbam, 'rb')
+def _matrix_frag_path(outdir, region, start, end, extra_out):
+    return path.join(outdir, 'tmp_%s:%d-%d_%s.npy' % (region, start, end,
+                                                       extra_out))
+
+
+def read_bam_frag(region, start, end):
+    """
+    Reads the interactions of one chunk of the BAM file (in a process
+    initialized with _init_bam_worker), writes them to disk as an array of
+    rows, columns and counts, and adds the cis and total interactions of
+    each bin to the shared array of counts per bin.
+    """
+    bamfile        = _BAM_WORKER['bamfile']
+    filter_exclude = _BAM_WORKER['filter_exclude']
+    section_pos    = _BAM_WORKER['section_pos']
+    resolution     = _BAM_WORKER['resolution']
+    next_position  = _BAM_WORKER['next_position']
+    last_position  = _BAM_WORKER['last_position']
     refs = bamfile.references
     try:
         dico = {}
         for r in bamfile.fetch(region=region,
-                               start=start - (1 if start else 0), end=end,  # coords starts at 0
-                               multiple_iterators=True):
+                               start=start - (1 if start else 0), end=end):  # coords starts at 0
             if r.flag & filter_exclude:
                 continue
             crm1 = r.reference_name
-            pos1 = r.reference_start + 1
             crm2 = refs[r.mrnm]
-            pos2 = r.mpos + 1
             try:
-                pos1 = sections[(crm1, pos1 // resolution)]
-                pos2 = sections[(crm2, pos2 // resolution)]
+                beg1, end1 = section_pos[crm1]
+                beg2, end2 = section_pos[crm2]
             except KeyError:
                 continue  # not in the subset matrix we want
+            pos1 = beg1 + (r.reference_start + 1) // resolution
+            pos2 = beg2 + (r.mpos + 1) // resolution
+            if pos1 >= end1 or pos2 >= end2:
+                continue  # not in the subset matrix we want
             try:
                 dico[(pos1, pos2)] += 1
             except KeyError:
                 dico[(pos1, pos2)] = 1
-        cisprc = {}
-        for (i, j), v in dico.items():
-            if all_bins[i][0] == all_bins[j][0]:  # same chromosome
-                diff = abs(j - i)
-                try:
-                    cisprc[i][0] += v  # add to cis interactions
-                    cisprc[i][1] += v  # add to total interactions
-                    if diff <= next_position:
-                        cisprc[i][2] += v  # add to total interactions
-                    elif diff <= last_position:
-                        cisprc[i][3] += v  # add to total interactions
-                except KeyError:
-                    if diff <= next_position:
-                        cisprc[i] = [v, v, v, 0]
-                    elif diff <= last_position:
-                        cisprc[i] = [v, v, 0, v]
-                    else:
-                        cisprc[i] = [v, v, 0, 0]
-            else:
-                try:
-                    cisprc[i][1] += v  # only add to total interactions
-                except KeyError:
-                    cisprc[i] = [0, v ,0, 0]
-        out = open(path.join(outdir,
-                             'tmp_%s:%d-%d_%s.pickle' % (region, start, end, extra_out)), 'wb')
-        dump(dico, out, HIGHEST_PROTOCOL)
-        out.close()
-        out = open(path.join(outdir, 'tmp_bins_%s:%d-%d_%s.pickle' % (
-            region, start, end, extra_out)), 'wb')
-        dump(cisprc, out, HIGHEST_PROTOCOL)
-        out.close()
+        pixels = empty((len(dico), 3), dtype=int32)
+        if dico:
+            pixels[:, :2] = list(dico.keys())
+            pixels[:, 2]  = list(dico.values())
+        save(_matrix_frag_path(_BAM_WORKER['outdir'], region, start, end,
+                               _BAM_WORKER['extra_out']), pixels)
+        # all rows belong to the chromosome of the chunk, and no other chunk
+        # holds these rows, so no lock is needed to sum in the shared array
+        rows, cols, values = pixels.T
+        beg_crm, end_crm = section_pos[region]
+        cis = (beg_crm <= cols) & (cols < end_crm)
+        diff = absolute(cols - rows)
+        bin_counts = _BAM_WORKER['bin_counts']
+        add.at(bin_counts[:, 0], rows, values * cis)
+        add.at(bin_counts[:, 1], rows, values)
+        add.at(bin_counts[:, 2], rows, values * (cis & (diff <= next_position)))
+        add.at(bin_counts[:, 3], rows, values * (cis & (diff > next_position)
+                                                 & (diff <= last_position)))
     except Exception as e:
         exc_type, exc_obj, exc_tb = exc_info()
         fname = path.split(exc_tb.tb_frame.f_code.co_filename)[1]
@@ -789,36 +763,27 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
     print('      -> trans interactions are defined as being bellow {}'.format(
         nicer(trans_limit * resolution)))
 
-    bins_dict = dict([(j, i) for i, j in enumerate(bins)])
-    pool = mu.Pool(ncpus)
+    # interactions per bin, summed by all processes in shared memory
+    bin_counts = mu.RawArray('q', total * 4)
+    # each process opens the BAM file once
+    pool = mu.Pool(ncpus, initializer=_init_bam_worker,
+                   initargs=(inbam, 0 if only_valid else filter_exclude,
+                             section_pos, resolution, outdir, extra_out,
+                             bin_counts, cis_limit, trans_limit))
     procs = []
-    read_bam_frag = read_bam_frag_valid if only_valid else read_bam_frag_filter
     for i, (region, start, end) in enumerate(zip(regs, begs, ends)):
-        procs.append(pool.apply_async(
-            read_bam_frag, args=(inbam, filter_exclude, bins, bins_dict,
-                                 resolution, outdir, extra_out,
-                                 region, start, end, cis_limit, trans_limit)))
+        procs.append(pool.apply_async(read_bam_frag, args=(region, start, end)))
     pool.close()
     print_progress(procs)
     pool.join()
+    fnames = [_matrix_frag_path(outdir, region, start, end, extra_out)
+              for region, start, end in zip(regs, begs, ends)]
+
     ## COLLECT RESULTS
-    cisprc = {}
-    printime('  - Collecting cis and total interactions per bin (%d chunks)' % (len(regs)))
-    stdout.write('     ')
-    for countbin, (region, start, end) in enumerate(zip(regs, begs, ends)):
-        if not countbin % 10 and countbin:
-            stdout.write(' ')
-        if not countbin % 50 and countbin:
-            stdout.write(' %9s\n     ' % ('%s/%s' % (countbin , len(regs))))
-        stdout.write('.')
-        stdout.flush()
-
-        fname = path.join(outdir,
-                          'tmp_bins_%s:%d-%d_%s.pickle' % (region, start, end, extra_out))
-        tmp_cisprc = load(open(fname,'rb'))
-        system('rm -f %s' % fname)
-        cisprc.update(tmp_cisprc)
-    stdout.write('\n')
+    printime('  - Collecting cis and total interactions per bin')
+    bin_counts = frombuffer(bin_counts, dtype=int64).reshape(-1, 4)
+    nonzero = flatnonzero(bin_counts[:, 1])
+    cisprc = dict(zip(nonzero.tolist(), bin_counts[nonzero].tolist()))
 
     # get cis/trans ratio
     for k in cisprc:
@@ -902,11 +867,9 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
 
     if normalization == 'ICE':
         printime('  - ICE normalization')
-        hic_data = load_hic_data_from_bam(
-            inbam, resolution, filter_exclude=filter_exclude,
-            tmpdir=outdir, ncpus=ncpus, nchunks=max_njobs)
+        hic_data = _load_hic_data(fnames, sections, bins, resolution)
         hic_data.bads = badcol
-        hic_data.normalize_hic(iterations=100, max_dev=0.000001)
+        hic_data.normalize_hic(iterations=100, max_dev=0.000001, sparse=True)
         biases = hic_data.bias.copy()
         del(hic_data)
     elif normalization == 'Vanilla':
@@ -926,12 +889,10 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
             print("biases", "mappability", "n_rsites", "cg_content")
             print(len(biases), len(mappability), len(n_rsites), len(cg_content))
             raise Exception('Error: not all arrays have the same size')
-        tmp_oneD = path.join(outdir,'tmp_oneD_%s' % (extra_out))
-        mkdir(tmp_oneD)
-        biases = oneD(tmp_dir=tmp_oneD, p_fit=p_fit, tot=biases, map=mappability,
-                      res=n_rsites, cg=cg_content, seed=seed)
-        biases = dict((k, b) for k, b in enumerate(biases))
-        rmtree(tmp_oneD)
+        biases = oneD(p_fit=p_fit, tot=biases, map=mappability,
+                      res=n_rsites, cg=cg_content, seed=seed,
+                      sections=list(section_pos.values()), ncpus=ncpus)
+        biases = dict((k, b) for k, b in enumerate(biases.tolist()))
     elif normalization == 'custom':
         n_pos = 0
         biases = {}
@@ -957,48 +918,15 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
         raise NotImplementedError('ERROR: method %s not implemented' %
                                   normalization)
 
-    # collect subset-matrices and write genomic one
-    # out = open(os.path.join(outdir,
-    #                         'hicdata_%s.abc' % (nicer(resolution).replace(' ', ''))), 'w')
-    printime('  - Getting sum of normalized bins')
-    pool = mu.Pool(ncpus)
-    procs = []
-    for i, (region, start, end) in enumerate(zip(regs, begs, ends)):
-        fname = path.join(outdir,
-                          'tmp_%s:%d-%d_%s.pickle' % (region, start, end, extra_out))
-        procs.append(pool.apply_async(sum_nrm_matrix,
-                                      args=(fname, biases,)))
-    pool.close()
-    print_progress(procs)
-    pool.join()
+    printime('  - Getting sums of normalized interactions')
+    sumnrm, cis, total, nrmdiag, rawdiag, npixdiag = _sum_normalized(
+        fnames, biases, badcol, section_pos, size)
 
     # to correct biases
-    sumnrm = sum(p.get() for p in procs)
-
     target = (sumnrm / float(size * size * factor))**0.5
     biases = dict([(b, biases[b] * target) for b in biases])
 
     if not normalize_only:
-        printime('  - Computing Cis percentage')
-        # Calculate Cis percentage
-
-        pool = mu.Pool(ncpus)
-        procs = []
-        for i, (region, start, end) in enumerate(zip(regs, begs, ends)):
-            fname = path.join(outdir,
-                              'tmp_%s:%d-%d_%s.pickle' % (region, start, end, extra_out))
-            procs.append(pool.apply_async(get_cis_perc,
-                                          args=(fname, biases, badcol, bins)))
-        pool.close()
-        print_progress(procs)
-        pool.join()
-
-        # collect results
-        cis = total = 0
-        for proc in procs:
-            c, t = proc.get()
-            cis += c
-            total += t
         norm_cisprc = float(cis) / total
         print('    * Cis-percentage: %.1f%%' % (norm_cisprc * 100))
     else:
@@ -1007,35 +935,17 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
     printime('  - Rescaling decay')
     # normalize decay by size of the diagonal, and by Vanilla correction
     # (all cells must still be equals to 1 in average)
-
-    pool = mu.Pool(ncpus)
-    procs = []
-    for i, (region, start, end) in enumerate(zip(regs, begs, ends)):
-        fname = path.join(outdir,
-                          'tmp_%s:%d-%d_%s.pickle' % (region, start, end, extra_out))
-        procs.append(pool.apply_async(sum_dec_matrix,
-                                      args=(fname, biases, badcol, bins)))
-    pool.close()
-    print_progress(procs)
-    pool.join()
-
-    # collect results
     nrmdec = {}
     rawdec = {}
-    for proc in procs:
-        tmpnrm, tmpraw = proc.get()
-        for c, d in tmpnrm.items():
-            for k, v in d.items():
-                try:
-                    nrmdec[c][k] += v
-                    rawdec[c][k] += tmpraw[c][k]
-                except KeyError:
-                    try:
-                        nrmdec[c][k]  = v
-                        rawdec[c][k] = tmpraw[c][k]
-                    except KeyError:
-                        nrmdec[c] = {k: v}
-                        rawdec[c] = {k: tmpraw[c][k]}
+    for crm in sections:
+        beg_chr, end_chr = section_pos[crm]
+        dists = flatnonzero(npixdiag[beg_chr:end_chr])
+        if not len(dists):
+            continue
+        nrmdec[crm] = dict(zip(dists.tolist(),
+                               (nrmdiag[beg_chr + dists] / target**2).tolist()))
+        rawdec[crm] = dict(zip(dists.tolist(),
+                               rawdiag[beg_chr + dists].tolist()))
     # count the number of cells per diagonal
     # TODO: parallelize
     # find largest chromosome
@@ -1107,56 +1017,68 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
     return biases, nrmdec, badcol, raw_cisprc, norm_cisprc
 
 
-def sum_dec_matrix(fname, biases, badcol, bins):
-    dico = load(open(fname,'rb'))
-    rawdec = {}
-    nrmdec = {}
-    for (i, j), v in dico.items():
-        if i < j:
-            continue
-        # different chromosome
-        c = bins[i][0]
-        if c != bins[j][0]:
-            continue
-        if i in badcol or j in badcol:
-            continue
-        k = i - j
-        val = v / biases[i] / biases[j]
-        try:
-            nrmdec[c][k] += val
-            rawdec[c][k] += v
-        except KeyError:
-            try:
-                nrmdec[c][k] = val
-                rawdec[c][k] = v
-            except KeyError:
-                nrmdec[c] = {k: val}
-                rawdec[c] = {k: v}
-    system('rm -f %s' % (fname))
-    return nrmdec, rawdec
-
-
-def get_cis_perc(fname, biases, badcol, bins):
-    dico = load(open(fname,'rb'))
-    cis = total = 0
-    for (i, j), v in dico.items():
-        if i <= j:
-            continue
-        if i in badcol or j in badcol:
-            continue
-        val = v / biases[i] / biases[j]
-        # same chromosome
-        if bins[i][0] == bins[j][0]:
-            cis += val
-        total += val
-    return cis, total
-
-
-def sum_nrm_matrix(fname, biases):
-    dico = load(open(fname,'rb'))
-    sumnrm = nansum([v / biases[i] / biases[j]
-                     for (i, j), v in dico.items()])
-    return sumnrm
+def _load_hic_data(fnames, sections, bins, resolution):
+    """
+    Loads the interactions written by read_bam_frag into a SparseHiC_data
+    object.
+    """
+    rows = []
+    cols = []
+    values = []
+    for fname in fnames:
+        pixels = load_array(fname)
+        upper = pixels[:, 0] <= pixels[:, 1]
+        rows.append(pixels[upper, 0])
+        cols.append(pixels[upper, 1])
+        values.append(pixels[upper, 2])
+    hic_data = SparseHiC_data((), len(bins), chromosomes=sections,
+                              dict_sec=dict((b, i) for i, b in enumerate(bins)),
+                              resolution=resolution, symmetricized=True)
+    hic_data._load_coo(concatenate(rows).astype(int64),
+                       concatenate(cols).astype(int64), concatenate(values))
+    return hic_data
+
+
+def _sum_normalized(fnames, biases, badcol, section_pos, size):
+    """
+    Sums the normalized interactions written by read_bam_frag (files are
+    removed).
+
+    :returns: the sum of all normalized interactions, the sum of cis and of
+       all normalized interactions between good columns (lower half of the
+       matrix), and, for each chromosome and each distance from the
+       diagonal, the sum of normalized interactions, of raw interactions and
+       the number of pixels (arrays indexed by the first bin of the
+       chromosome plus the distance)
+    """
+    bias = array([biases.get(k, float('nan')) for k in range(size)])
+    bad = zeros(size, dtype=bool)
+    bad[[k for k in badcol if k < size]] = True
+    crm_ids = zeros(size, dtype=int64)
+    crm_beg = zeros(size, dtype=int64)
+    for c, (beg_chr, end_chr) in enumerate(section_pos.values()):
+        crm_ids[beg_chr:end_chr] = c
+        crm_beg[beg_chr:end_chr] = beg_chr
+    sumnrm = cis = total = 0.
+    nrmdiag = zeros(size)
+    rawdiag = zeros(size)
+    npixdiag = zeros(size, dtype=int64)
+    for fname in fnames:
+        i, j, v = load_array(fname).T
+        val = v / bias[i] / bias[j]
+        sumnrm += nansum(val)
+        good = ~(bad[i] | bad[j])
+        same = crm_ids[i] == crm_ids[j]
+        lower = good & (i > j)
+        cis += val[lower & same].sum()
+        total += val[lower].sum()
+        diag = good & same & (i >= j)
+        dist = crm_beg[i[diag]] + i[diag] - j[diag]
+        nrmdiag += bincount(dist, weights=val[diag], minlength=size)
+        rawdiag += bincount(dist, weights=v[diag], minlength=size)
+        npixdiag += bincount(dist, minlength=size)
+        remove(fname)
+    return sumnrm, cis, total, nrmdiag, rawdiag, npixdiag
 
 
 class SmartFormatter(HelpFormatter):
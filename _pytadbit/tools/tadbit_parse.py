@@ -17,6 +17,7 @@ from argparse                       import HelpFormatter
 from pickle                         import load, UnpicklingError
 from warnings                       import warn
 from functools                      import reduce
+from multiprocessing                import cpu_count
 
 import time
 import logging
@@ -86,11 +87,15 @@ def run(opts):
         if opts.mapped1 or opts.mapped2:
             counts, multis = parse_sam(f_names1, f_names2, out_file1=out_file1,
                                        out_file2=out_file2, re_name=renz, verbose=True,
-                                       genome_seq=genome, compress=opts.compress_input)
+                                       genome_seq=genome, compress=opts.compress_input,
+                                       ncpus=opts.cpus,
+                                       re_cache=path.dirname(path.abspath(opts.genome[0])))
         else:
             counts, multis = parse_map(f_names1, f_names2, out_file1=out_file1,
                                        out_file2=out_file2, re_name=renz, verbose=True,
-                                       genome_seq=genome, compress=opts.compress_input)
+                                       genome_seq=genome, compress=opts.compress_input,
+                                       ncpus=opts.cpus,
+                                       re_cache=path.dirname(path.abspath(opts.genome[0])))
     else:
         counts = {}
         counts[0] = {}
@@ -371,6 +376,12 @@ def populate_args(parser):
                         done. This is done in background, while next MAP file is
                         processed, or while reads are sorted.''')
 
+    glopts.add_argument("-C", "--cpus", dest="cpus", type=int,
+                        default=cpu_count(), help='''[%(default)s] Maximum
+                        number of CPU cores  available in the execution host.
+                        Input files (e.g. windows of the iterative mapping) are
+                        parsed in parallel (if 0 all available)''')
+
     glopts.add_argument('--tmpdb', dest='tmpdb', action='store', default=None,
                         metavar='PATH', type=str,
                         help='''if provided uses this directory to manipulate the
@@ -402,6 +413,8 @@ def check_options(opts):
         raise NotImplementedError('ERROR: not yet there')
 
     if not opts.genome: raise Exception('ERROR: genome parameter required.')
+    if opts.cpus == 0:
+        opts.cpus = cpu_count()
     if not opts.workdir: raise Exception('ERROR: workdir parameter required.')
 
     # check skip
@@ -16,6 +16,7 @@ from random                         import random
 from warnings                       import warn
 from pickle                        import load
 from multiprocessing                import cpu_count
+import multiprocessing as mu
 from traceback                      import print_exc
 import sqlite3 as lite
 import time
@@ -24,6 +25,7 @@ from pytadbit                       import load_hic_data_from_bam
 from pytadbit                       import tadbit
 from pytadbit.utils.sqlite_utils    import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils    import add_path, get_jobid, print_db, retry
+from pytadbit.utils.sqlite_utils    import get_zoomify
 from pytadbit.utils.file_handling   import mkdir
 from pytadbit.parsers.tad_parser    import parse_tads
 from pytadbit.parsers.genome_parser import parse_fasta, get_gc_content
@@ -66,10 +68,14 @@ def run(opts):
     region = None
     if opts.crms and len(opts.crms) == 1:
         region = opts.crms[0]
+    mcool = None
+    if not opts.nosql:
+        mcool = get_zoomify(opts.workdir, mreads, reso, opts.filter,
+                            tmpdb=opts.tmpdb if 'tmpdb' in opts else None)
     hic_data = load_hic_data_from_bam(mreads, reso, ncpus=opts.cpus,
                                       region=region,
                                       biases=None if opts.all_bins else biases,
-                                      filter_exclude=opts.filter)
+                                      filter_exclude=opts.filter, mcool=mcool)
 
     # compartments
     cmp_result = {}
@@ -139,50 +145,84 @@ def run(opts):
         tad_dir = path.join(opts.workdir, '06_segmentation',
                              'tads_%s' % (nice(reso)))
         mkdir(tad_dir)
-        for crm in hic_data.chromosomes:
-            if opts.crms and not crm in opts.crms:
-                continue
-            print('  - %s' % crm)
-            matrix = hic_data.get_matrix(focus=crm)
-            beg, end = hic_data.section_pos[crm]
-            size = len(matrix)
-            if size < 10:
-                print("     Chromosome too short (%d bins), skipping..." % size)
-                continue
-            # transform bad column in chromosome referential
-            if hic_data.bads:
-                to_rm = tuple([1 if i in hic_data.bads else 0 for i in range(beg, end)])
-            else:
-                to_rm = None
-            # maximum size of a TAD
-            max_tad_size = (size - 1) if opts.max_tad_size is None else opts.max_tad_size
-            result = tadbit([matrix], remove=to_rm,
-                            n_cpus=opts.cpus, verbose=opts.verbose,
-                            max_tad_size=max_tad_size,
-                            no_heuristic=False)
-
-            # use normalization to compute height on TADs called
-            if opts.all_bins:
-                if opts.nosql:
-                    biases = load(open(biases, 'rb'))
+        pool = None
+        try:
+            if opts.topdom:
+                # TopDom works on the sparse matrix of each chromosome, all
+                # chromosomes are segmented in parallel
+                csr = hic_data.get_hic_data_as_csr()
+                pool = mu.Pool(opts.cpus)
+                jobs = {}
+                for crm in hic_data.chromosomes:
+                    if opts.crms and not crm in opts.crms:
+                        continue
+                    beg, end = hic_data.section_pos[crm]
+                    if end - beg < 10:
+                        continue
+                    jobs[crm] = pool.apply_async(
+                        tadbit, args=(csr[beg:end, beg:end],),
+                        kwds=dict(use_topdom=True, topdom_window=opts.topdom_window,
+                                  verbose=opts.verbose))
+                pool.close()
+                del csr
+            for crm in hic_data.chromosomes:
+                if opts.crms and not crm in opts.crms:
+                    continue
+                print('  - %s' % crm)
+                beg, end = hic_data.section_pos[crm]
+                size = end - beg
+                if size < 10:
+                    print("     Chromosome too short (%d bins), skipping..." % size)
+                    continue
+                # transform bad column in chromosome referential
+                if hic_data.bads:
+                    to_rm = tuple([1 if i in hic_data.bads else 0 for i in range(beg, end)])
+                else:
+                    to_rm = None
+                # maximum size of a TAD
+                max_tad_size = (size - 1) if opts.max_tad_size is None else opts.max_tad_size
+                if opts.topdom:
+                    result = jobs[crm].get()
+                    # only domains are TADs, gaps and boundaries between them
+                    # are not written
+                    result = dict(
+                        (key, [val for val, tag in zip(result[key], result['tag'])
+                               if tag == 'domain'])
+                        for key in ('start', 'end', 'score'))
                 else:
-                    biases = load(open(path.join(opts.workdir, biases), 'rb'))
-                hic_data.bads = biases['badcol']
-                hic_data.bias = biases['biases']
-            tads = load_tad_height(result, size, beg, end, hic_data)
-            table = ''
-            table += '%s\t%s\t%s\t%s\t%s\n' % ('#', 'start', 'end', 'score', 'density')
-            for tad in tads:
-                table += '%s\t%s\t%s\t%s%s\n' % (
-                    tad, int(tads[tad]['start'] + 1), int(tads[tad]['end'] + 1),
-                    abs(tads[tad]['score']), '\t%s' % (round(
-                        float(tads[tad]['height']), 3)))
-            out_tad = path.join(tad_dir, '%s_%s.tsv' % (crm, param_hash))
-            out = open(out_tad, 'w')
-            out.write(table)
-            out.close()
-            tad_result[crm] = {'path' : out_tad,
-                               'num': len(tads)}
+                    matrix = hic_data.get_matrix(focus=crm)
+                    result = tadbit([matrix], remove=to_rm,
+                                    n_cpus=opts.cpus, verbose=opts.verbose,
+                                    max_tad_size=max_tad_size,
+                                    no_heuristic=False)
+
+                # use normalization to compute height on TADs called
+                if opts.all_bins:
+                    if opts.nosql:
+                        biases = load(open(biases, 'rb'))
+                    else:
+                        biases = load(open(path.join(opts.workdir, biases), 'rb'))
+                    hic_data.bads = biases['badcol']
+                    hic_data.bias = biases['biases']
+                tads = load_tad_height(result, size, beg, end, hic_data)
+                table = ''
+                table += '%s\t%s\t%s\t%s\t%s\n' % ('#', 'start', 'end', 'score', 'density')
+                for tad in tads:
+                    table += '%s\t%s\t%s\t%s%s\n' % (
+                        tad, int(tads[tad]['start'] + 1), int(tads[tad]['end'] + 1),
+                        abs(tads[tad]['score']), '\t%s' % (round(
+                            float(tads[tad]['height']), 3)))
+                out_tad = path.join(tad_dir, '%s_%s.tsv' % (crm, param_hash))
+                out = open(out_tad, 'w')
+                out.write(table)
+                out.close()
+                tad_result[crm] = {'path' : out_tad,
+                                   'num': len(tads)}
+        finally:
+            # stop remaining workers, also if a chromosome failed
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
     finish_time = time.localtime()
 
@@ -548,6 +588,17 @@ def populate_args(parser):
                         help='''an integer defining the maximum size of TAD. Default
                         defines it as the number of rows/columns''')
 
+    tdopts.add_argument('--topdom', dest='topdom', action='store_true',
+                        default=False,
+                        help='''use TopDom instead of the TADbit
+                        break-point detection algorithm (chromosomes are
+                        segmented in parallel)''')
+
+    tdopts.add_argument('--topdom_window', dest='topdom_window', metavar="INT",
+                        action='store', default=5, type=int,
+                        help='''[%(default)s] window size (in bins) used by
+                        TopDom''')
+
     glopts.add_argument("-C", "--cpu", dest="cpus", type=int,
                         default=cpu_count(), help='''[%(default)s] Maximum number of CPU
                         cores  available in the execution host. If higher
@@ -65,16 +65,14 @@ from __future__ import print_function
 #     pass
 #===============================================================================
 
-from subprocess import Popen, PIPE
-from os import path
+import multiprocessing as mu
 
-from numpy import genfromtxt
-
-from pytadbit.utils.file_handling import which
+from scipy.interpolate import BSpline
+import numpy as np
 
 
 def oneD(tmp_dir='.', form='tot ~ s(map) + s(cg) + s(res)', p_fit=None,
-         seed=1, **kwargs):
+         seed=1, sections=None, ncpus=1, **kwargs):
     """
     Normalizes according to oneD normalization that takes into account the GC
     content, mappability and the number of restriction sites per bin.
@@ -83,9 +81,22 @@ def oneD(tmp_dir='.', form='tot ~ s(map) + s(cg) + s(res)', p_fit=None,
     OneD: increasing reproducibility of Hi-C Samples with abnormal karyotypes.
     bioRxiv. http://doi.org/10.1101/148254
 
-    :param form: string representing an R Formulae
+    As in the dryhic implementation, the total number of interactions per bin
+    is modeled with a negative binomial generalized additive model (log
+    link). Smooth terms are fitted as penalized cubic B-splines (P-splines)
+    by penalized iteratively reweighted least squares, the amount of
+    smoothing being chosen by generalized cross-validation.
+
+    :param '.' tmp_dir: not used, kept for backward compatibility
+    :param form: string representing an R Formulae, with smooth terms
+       (e.g. s(map)) and/or linear terms (e.g. map)
     :param None p_fit: proportion of data to be used in fitting (for very
        large datasets). Number between 0 and 1
+    :param 1 seed: seed for the random selection of the data used in fitting
+    :param None sections: list of (begin, end) bins of each chromosome, to
+       fit one model per chromosome (chromosomes with too few bins are fitted
+       together). By default a single model is fitted.
+    :param 1 ncpus: number of chromosomes to fit in parallel
     :param kwargs: dictionary with keys present in the formula and values being
        lists of equal length.
        for example:
@@ -96,41 +107,202 @@ def oneD(tmp_dir='.', form='tot ~ s(map) + s(cg) + s(res)', p_fit=None,
 
     :returns: list of biases to use to normalize the raw matrix of interactions
     """
+    response, terms = _parse_formula(form)
+    for name in [response] + [name for _, name in terms]:
+        if not name in kwargs:
+            raise Exception('ERROR: missing values for "%s" in oneD formula' % (
+                name))
+    data = dict((name, np.asarray(kwargs[name], dtype=float))
+                for name in [response] + [name for _, name in terms])
+    size = len(data[response])
+    if not sections:
+        sections = [(0, size)]
+
+    # chromosomes with not enough bins to fit their own model are grouped
+    valid = np.isfinite(data[response])
+    for _, name in terms:
+        valid &= np.isfinite(data[name])
+    min_bins = _ONED_MIN_BINS * (1 + sum(_ONED_KNOTS - 1 if smooth else 1
+                                         for smooth, _ in terms))
+    groups = []
+    small = []
+    for beg, end in sections:
+        if valid[beg:end].sum() >= min_bins:
+            groups.append(np.arange(beg, end))
+        else:
+            small.append(np.arange(beg, end))
+    if small:
+        groups.append(np.concatenate(small))
+
+    args = [(data[response][idx], [(smooth, data[name][idx])
+                                   for smooth, name in terms], p_fit, seed)
+            for idx in groups]
+    if ncpus > 1 and len(groups) > 1:
+        pool = mu.Pool(min(ncpus, len(groups)))
+        jobs = [pool.apply_async(_oned_fit, args=arg) for arg in args]
+        pool.close()
+        pool.join()
+        results = [job.get() for job in jobs]
+    else:
+        results = [_oned_fit(*arg) for arg in args]
 
-    script_path = which('normalize_oneD.R')
-    proc_par = ["Rscript", "--vanilla", script_path]
+    biases_oneD = np.empty(size)
+    biases_oneD.fill(np.nan)
+    for idx, fitted in zip(groups, results):
+        biases_oneD[idx] = fitted
+    return biases_oneD / np.nanmean(biases_oneD)
 
-    in_csv = path.join(tmp_dir, 'tot.csv')
-    proc_par.append(in_csv)
 
-    csvfile = open(in_csv, 'w')
-    headers = sorted(kwargs.keys())
-    csvfile.write(','.join(headers) + '\n')
-    csvfile.write('\n'.join(','.join(str(kwargs[k][i]) for k in headers)
-                            for i in range(len(kwargs['tot']))) + '\n')
-    csvfile.close()
+# number of B-splines per smooth term of the oneD model
+_ONED_KNOTS = 10
 
-    out_csv = path.join(tmp_dir, 'biases.csv')
-    proc_par.append(out_csv)
+# minimum number of bins per parameter to fit a oneD model on a chromosome
+_ONED_MIN_BINS = 10
 
-    proc_par.append('"%s"' % (form))
+# smoothing parameters tried in the fit of the oneD model
+_ONED_LAMBDAS = np.logspace(-4, 6, 21)
 
-    if p_fit:
-        proc_par.append(str(p_fit))
 
-    if seed > 1:
-        proc_par.append(str(seed))
-    elif seed < 1:
-        raise Exception(('ERROR: seed number (currently: %d) should be an '
-                         'interger greater than 1 (because of R)') % (seed))
+def _parse_formula(form):
+    """
+    Parse a formula like 'tot ~ s(map) + s(cg) + res'
+
+    :returns: the name of the response variable and a list of terms, as
+       tuples (True if smooth term, name of the variable)
+    """
+    try:
+        response, rhs = form.replace('"', '').split('~')
+    except ValueError:
+        raise Exception('ERROR: wrong oneD formula "%s"' % (form))
+    terms = []
+    for term in rhs.split('+'):
+        term = term.strip()
+        smooth = term.startswith('s(') and term.endswith(')')
+        terms.append((smooth, term[2:-1].strip() if smooth else term))
+    return response.strip(), terms
+
+
+def _bspline_basis(values, lower, upper, nknots=_ONED_KNOTS, degree=3):
+    """
+    Cubic B-spline basis with equally spaced knots between lower and upper
+    (values outside are clipped).
+    """
+    step = float(upper - lower) / (nknots - degree) or 1.
+    knots = lower + step * np.arange(-degree, nknots + 1)
+    values = np.clip(values, lower, upper)
+    return BSpline(knots, np.eye(nknots), degree)(values)
+
 
-    proc = Popen(proc_par, stderr=PIPE, universal_newlines=True)
-    err = proc.stderr.readlines()
-    print('\n'.join(err))
+def _oned_fit(counts, covariates, p_fit=None, seed=1, max_iter=100,
+              tolerance=1e-8):
+    """
+    Fits a negative binomial additive model of the counts and returns the
+    fitted mean of each bin (NaN when covariates are missing).
+
+    :param counts: array of counts per bin (NaN for bins to skip)
+    :param covariates: list of tuples (True if smooth term, array of values)
+    :param None p_fit: proportion of bins used in the fit
+    :param 1 seed: seed for the random selection of bins used in the fit
+    """
+    known = np.ones(len(counts), dtype=bool)
+    for _, values in covariates:
+        known &= np.isfinite(values)
+    result = np.empty(len(counts))
+    result.fill(np.nan)
+    train = np.flatnonzero(known & np.isfinite(counts))
+    if p_fit:
+        rand = np.random.RandomState(seed)
+        train = np.sort(rand.choice(train, max(1, int(round(len(train) * p_fit))),
+                                    replace=False))
+    if not len(train):
+        return result
+
+    # design matrix (centered, and without the last B-spline of each term, so
+    # that the intercept is identifiable) and penalty on the second order
+    # differences of the spline coefficients
+    bases = []
+    penalties = []
+    for smooth, values in covariates:
+        if smooth:
+            lower, upper = values[train].min(), values[train].max()
+            basis = _bspline_basis(values[known], lower, upper)[:, :-1]
+            diff = np.diff(np.eye(_ONED_KNOTS), n=2, axis=0)[:, :-1]
+            penalties.append(np.dot(diff.T, diff))
+        else:
+            basis = values[known][:, None]
+            penalties.append(np.zeros((1, 1)))
+        bases.append(basis)
+    design = np.hstack([np.ones((known.sum(), 1))] + bases)
+    train_rows = np.searchsorted(np.flatnonzero(known), train)
+    means = design[train_rows].mean(axis=0)
+    means[0] = 0
+    design -= means
+    penalty = np.zeros((design.shape[1], design.shape[1]))
+    pos = 1
+    for pen in penalties:
+        penalty[pos:pos + len(pen), pos:pos + len(pen)] = pen
+        pos += len(pen)
+
+    # penalized iteratively reweighted least squares
+    x = design[train_rows]
+    y = counts[train]
+    nobs = len(y)
+    fitted = y + 0.1
+    eta = np.log(fitted)
+    theta = np.inf
+    for _ in range(max_iter):
+        weights = fitted / (1 + fitted / theta)
+        z = eta + (y - fitted) / fitted
+        xw = x * np.sqrt(weights)[:, None]
+        zw = z * np.sqrt(weights)
+        xtwx = np.dot(xw.T, xw)
+        xtwz = np.dot(xw.T, zw)
+        # residual sum of squares of the unpenalized fit, the one of each
+        # penalized fit being this plus the distance between both fits
+        beta_ls = np.linalg.lstsq(xw, zw, rcond=None)[0]
+        rss_ls = np.sum((zw - np.dot(xw, beta_ls)) ** 2)
+        best = None
+        for lam in _ONED_LAMBDAS:
+            try:
+                inv = np.linalg.inv(xtwx + lam * penalty)
+            except np.linalg.LinAlgError:
+                continue
+            beta = np.dot(inv, xtwz)
+            edf = np.sum(inv * xtwx.T)
+            rss = rss_ls + np.dot(beta - beta_ls, np.dot(xtwx, beta - beta_ls))
+            gcv = nobs * rss / max(nobs - edf, 1) ** 2
+            if best is None or gcv < best[0]:
+                best = gcv, beta, edf
+        _, beta, edf = best
+        new_eta = np.clip(np.dot(x, beta), -700, 700)
+        change = np.max(np.abs(new_eta - eta))
+        eta = new_eta
+        fitted = np.exp(eta)
+        theta = _nb_theta(y, fitted, nobs - edf)
+        if change < tolerance:
+            break
+    result[known] = np.exp(np.clip(np.dot(design, beta), -700, 700))
+    return result
 
-    biases_oneD = genfromtxt(out_csv, delimiter=',', dtype=float)
 
-    return biases_oneD
+def _nb_theta(y, fitted, dof):
+    """
+    Dispersion parameter of the negative binomial distribution such that the
+    Pearson statistic equals the residual degrees of freedom (infinite, i.e.
+    Poisson, if there is no over-dispersion).
+    """
+    pearson = lambda theta: np.sum((y - fitted) ** 2 /
+                                   (fitted + fitted ** 2 / theta))
+    if pearson(np.inf) <= dof:
+        return np.inf
+    lower, upper = -8., 8.
+    for _ in range(50):
+        middle = (lower + upper) / 2
+        if pearson(10 ** middle) > dof:
+            upper = middle
+        else:
+            lower = middle
+    return 10 ** ((lower + upper) / 2)
 
 
 def _update_S(W):
@@ -231,7 +403,75 @@ def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
     return B
 
 
-def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwargs):
+def iterative_sparse(hic_data, bads=None, iterations=0, max_dev=0.00001,
+                     bias=None, verbose=False, **kwargs):
+    """
+    Implementation of iterative correction Imakaev 2012, using sparse
+    matrix-vector products instead of a copy of the matrix.
+
+    The matrix is never modified, instead, the sum of each row of the
+    corrected matrix is computed as (M . 1/B) / B, with B the current vector of
+    biases. Results are the same as the ones of :func:`iterative`.
+
+    :param hic_data: HiC_data object containing the interaction data
+    :param None bads: dictionary with column not to be considered
+    :param 0 iterations: number of iterations to do (99 if a fully smoothed
+       matrix with no visibility differences between columns is desired)
+    :param 0.00001 max_dev: maximum difference allowed between a row and the
+       mean value of all raws
+    :param None bias: dictionary of biases from a previous normalization, used
+       as starting point of the iterative process (warm start)
+    :returns: a vector of biases (length equal to the size of the matrix)
+    """
+    if verbose:
+        print('iterative correction (sparse)')
+    size = len(hic_data)
+    if not bads:
+        bads = {}
+    if verbose:
+        print("  - loading sparse matrix")
+    matrix = hic_data.get_hic_data_as_csr()
+    good = np.ones(size, dtype=bool)
+    good[[b for b in bads if 0 <= b < size]] = False
+    # remove bad columns and rows
+    matrix = matrix.multiply(good[:, None]).multiply(good[None, :]).tocsr()
+    matrix.eliminate_zeros()
+    # only rows with interactions are corrected
+    present = np.diff(matrix.indptr) > 0
+    npresent = int(present.sum())
+    if not npresent:
+        raise ZeroDivisionError('ERROR: normalization failed, all bad columns')
+    B = np.ones(size, dtype=np.float64)
+    if bias:
+        B = np.array([bias.get(i, 1.) for i in range(size)], dtype=np.float64)
+        B[~np.isfinite(B) | (B <= 0)] = 1.
+    B[~present] = 0.
+    if verbose:
+        print("  - computing biases")
+    inv = np.zeros(size, dtype=np.float64)
+    for it in range(iterations + 1):
+        nonzero = B != 0
+        inv[:] = 0.
+        inv[nonzero] = 1. / B[nonzero]
+        S = matrix.dot(inv) * inv
+        meanS = S[present].sum() / npresent
+        B *= S / meanS
+        if iterations == 0: # exit before, we do not need to check deviation
+            break
+        minS = S[present].min()
+        maxS = S[present].max()
+        dev = max(abs(minS / meanS - 1), abs(maxS / meanS - 1))
+        if verbose:
+            print('   %15.3f %15.3f %15.3f %4s %9.5f' % (minS, meanS, maxS, it, dev))
+        if dev < max_dev:
+            break
+    B *= meanS**.5
+    B[B == 0] = 1.
+    return dict((i, b) for i, b in enumerate(B.tolist()))
+
+
+def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False,
+             ncpus=1, **kwargs):
     """
     Computes the expected values by averaging observed interactions at a given
     distance in a given HiC matrix.
@@ -242,6 +482,7 @@ def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwa
        if not enough reads are observed at a given distance the observations
        of the distance+1 are summed. a signal to noise ratio of < 0.05
        corresponds to > 400 reads.
+    :param 1 ncpus: number of chromosomes to process in parallel
 
     :returns: a vector of biases (length equal to the size of the matrix)
     """
@@ -253,39 +494,93 @@ def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwa
             size = max(hic_data.chromosomes.values())
     except AttributeError:
         pass
+    if not bads:
+        bads = {}
 
-    if size > 1200:
-        import sys
-        sys.setrecursionlimit(size + 100)
-
+    # chromosome boundaries, sorted by position
+    if hic_data.section_pos:
+        segments = sorted(hic_data.section_pos.values())
+    else:
+        segments = [(0, size)]
+    starts = np.array([beg for beg, _ in segments], dtype=np.int64)
+
+    # upper triangle of the interactions, grouped by chromosome
+    rows, cols, values = hic_data._coo()
+    upper = rows <= cols
+    rows, cols, values = rows[upper], cols[upper], values[upper]
+    crms = np.searchsorted(starts, rows, side='right') - 1
+    ends = np.array([end for _, end in segments], dtype=np.int64)
+    intra = (crms >= 0) & (cols < ends[np.maximum(crms, 0)])
+    rows, cols, values, crms = rows[intra], cols[intra], values[intra], crms[intra]
+    order = np.argsort(crms, kind='stable')
+    rows, cols, values = rows[order], cols[order], values[order]
+    limits = np.searchsorted(crms[order], np.arange(len(segments) + 1))
+    bads = np.array(sorted(bads), dtype=np.int64)
+
+    args = [(rows[limits[c]:limits[c + 1]], cols[limits[c]:limits[c + 1]],
+             values[limits[c]:limits[c + 1]], beg, end,
+             bads[(bads >= beg) & (bads < end)])
+            for c, (beg, end) in enumerate(segments)]
+    if ncpus > 1 and len(segments) > 1:
+        pool = mu.Pool(min(ncpus, len(segments)))
+        jobs = [pool.apply_async(_diagonal_sums, args=arg) for arg in args]
+        pool.close()
+        pool.join()
+        results = [job.get() for job in jobs]
+    else:
+        results = [_diagonal_sums(*arg) for arg in args]
+
+    # sum over chromosomes (one extra diagonal as the merging can reach it)
+    sums = np.zeros(size + 1)
+    counts = np.zeros(size + 1, dtype=np.int64)
+    for diag_sums, diag_counts in results:
+        length = min(len(diag_sums), size + 1)
+        sums[:length] += diag_sums[:length]
+        counts[:length] += diag_counts[:length]
+
+    # merge consecutive diagonals until reaching the minimum number of reads
+    cum_sums = np.concatenate(([0.], np.cumsum(sums)))
+    cum_counts = np.concatenate(([0], np.cumsum(counts)))
     expc = {}
     dist = 0
     while dist < size:
-        diag = []
-        new_dist, val = _meandiag(hic_data, dist, diag, min_n, size, bads)
-        for dist in range(dist, new_dist + 1):
+        if not counts[dist]:
+            last, val = dist, 0.
+        else:
+            last = np.searchsorted(cum_sums, cum_sums[dist] + min_n,
+                                   side='right') - 1
+            # correct rounding errors of the addition above
+            while last > dist and cum_sums[last] - cum_sums[dist] > min_n:
+                last -= 1
+            while (last < size and
+                   not cum_sums[last + 1] - cum_sums[dist] > min_n):
+                last += 1
+            last = min(last, size)
+            val = (float(cum_sums[last + 1] - cum_sums[dist]) /
+                   (cum_counts[last + 1] - cum_counts[dist]))
+        for dist in range(dist, last + 2):
             expc[dist] = val
     return expc
 
 
-def _meandiag(hic_data, dist, diag, min_n, size, bads):
-    if hic_data.section_pos:
-        for crm in hic_data.section_pos:
-            for i in range(hic_data.section_pos[crm][0],
-                            hic_data.section_pos[crm][1] - dist):
-                if i in bads:
-                    continue
-                diag.append(hic_data[i, i + dist])
-    else:
-        for i in range(size - dist):
-            if i in bads:
-                continue
-            diag.append(hic_data[i, i + dist])
-    sum_diag = sum(diag)
-    if not diag:
-        return dist + 1, 0.
-    if sum_diag > min_n:
-        return dist + 1, float(sum_diag) / len(diag)
-    if dist >= size:
-        return dist + 1, float(sum_diag) / len(diag)
-    return _meandiag(hic_data, dist + 1, diag, min_n, size, bads)
+def _diagonal_sums(rows, cols, values, beg, end, bads):
+    """
+    Sum of the interactions, and number of cells, at each distance from the
+    diagonal inside a chromosome (rows in bads are skipped).
+
+    :param rows: row index of the interactions (upper triangle)
+    :param cols: column index of the interactions
+    :param values: interaction counts
+    :param beg: first bin of the chromosome
+    :param end: last bin of the chromosome (not included)
+    :param bads: bad columns inside the chromosome
+    """
+    length = end - beg
+    good = ~np.isin(rows, bads)
+    diag_sums = np.bincount(cols[good] - rows[good], weights=values[good],
+                            minlength=length)[:length]
+    # a row i is counted in diagonal d if i + d < end
+    diag_counts = length - np.arange(length, dtype=np.int64)
+    bad_limits = np.bincount(end - bads, minlength=length + 1)
+    diag_counts -= np.cumsum(bad_limits[::-1])[::-1][1:]
+    return diag_sums, diag_counts
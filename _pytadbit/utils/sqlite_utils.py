@@ -121,6 +121,29 @@ def add_path(cur, path, typ, jobid, workdir=None):
         pass
 
 
+def get_zoomify(workdir, inbam, resolution, filter_exclude, tmpdb=None):
+    """
+    Searches in the database a multi-resolution cooler generated by
+    "tadbit bin --zoomify" from a given BAM file, with the same filters and
+    containing the wanted resolution.
+
+    :returns: path to the cooler file, None if not found
+    """
+    from pytadbit.parsers.hic_bam_parser import find_zoomify
+    dbfile = tmpdb or join(workdir, 'trace.db')
+    if not exists(dbfile):
+        return None
+    con = lite.connect(dbfile)
+    with con:
+        cur = con.cursor()
+        try:
+            cur.execute("select distinct Path from PATHs where Type = 'HIC_MCOOL'")
+        except lite.OperationalError:
+            return None
+        mcools = [join(workdir, p) for p, in cur.fetchall()]
+    return find_zoomify(mcools, inbam, resolution, filter_exclude)
+
+
 def print_db(cur, name, no_print='', jobids=None, savedata=None, append=False,
              columns=None, tsv=False, **kwargs):
     """
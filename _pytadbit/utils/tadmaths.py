@@ -32,6 +32,39 @@ def right_double_mad(arr):
     return right_mad
 
 
+def library_complexity(total, unique):
+    """
+    Estimates the number of unique molecules in a library from the number of
+    sequenced pairs of reads and the number of distinct ones, solving the
+    Lander-Waterman equation (as in Picard EstimateLibraryComplexity):
+    unique / x = 1 - exp(-total / x)
+
+    :param total: number of pairs of reads
+    :param unique: number of distinct pairs of reads (duplicates removed)
+
+    :returns: estimated number of unique molecules (infinite if no duplicates
+       are found)
+    """
+    if unique >= total:
+        return float('inf')
+    if unique <= 0:
+        return 0.
+    func = lambda x: float(unique) / x - 1 + np.exp(-float(total) / x)
+    lower, upper = 1., 100.
+    while func(upper * unique) > 0:
+        upper *= 10
+    for _ in range(40):
+        ratio = (lower + upper) / 2
+        val = func(ratio * unique)
+        if val == 0:
+            break
+        if val > 0:
+            lower = ratio
+        else:
+            upper = ratio
+    return unique * (lower + upper) / 2
+
+
 def newton_raphson (guess, contour, sq_length, jmax=2000, xacc=1e-12):
     """
     Newton-Raphson method as defined in:
@@ -198,7 +198,7 @@ def main():
         keywords     = ["testing"],
         url          = 'https://github.com/3DGenomes/tadbit',
         download_url = 'https://github.com/3DGenomes/tadbit/tarball/master',
-        scripts      = ['scripts/tadbit', 'scripts/normalize_oneD.R'],
+        scripts      = ['scripts/tadbit'],
         data_files   = [(path.expanduser('~'),['extras/.bash_completion'])]+tf_models_files,
         cmdclass     = {'install': InstallCommand}
     )
@@ -9,28 +9,66 @@ import matplotlib
 from functools import reduce
 from collections import OrderedDict
 matplotlib.use('Agg')
+from matplotlib import pyplot as plt
 
 import unittest
 from pytadbit                             import Chromosome, load_chromosome
 from pytadbit                             import tadbit, batch_tadbit
+from pytadbit.tadbit                      import TopDom, _mannwhitneyu_less
+from pytadbit.tadbit                      import insulation_score, insulation_to_borders
+from pytadbit                             import HiC_data, SparseHiC_data
+from pytadbit                             import MmapHiC_data, load_mmap_hic_data
 from pytadbit.tad_clustering.tad_cmo      import optimal_cmo
 from pytadbit.modelling.structuralmodels        import load_structuralmodels
 from pytadbit.modelling.impmodel                import load_impmodel_from_cmm
 from pytadbit.eqv_rms_drms                import rmsdRMSD_wrapper
-from pytadbit.parsers.genome_parser       import parse_fasta
+from pytadbit.parsers.genome_parser       import parse_fasta, get_gc_content
+from pytadbit.parsers.genome_parser       import is_genome_cache, GENOME_MAGIC
+from pytadbit.parsers.bed_parser          import parse_mappability_bedGraph
+from pytadbit.parsers.bed_parser          import _bedgraph_bins
 from pytadbit.mapping.restriction_enzymes import map_re_sites, RESTRICTION_ENZYMES
+from pytadbit.mapping.restriction_enzymes import re_sites_index
 from pytadbit.parsers.hic_parser          import load_hic_data_from_reads, read_matrix
+from pytadbit.parsers.hic_parser          import load_hic_data_from_bam
+from pytadbit.parsers.hic_bam_parser      import bed2D_to_BAMhic, get_matrix
+from pytadbit.parsers.hic_bam_parser      import _balanced_chunks, _BAM_WORKER
+from pytadbit.parsers.hic_bam_parser      import BAMTileCache
+from pytadbit.tools                       import tadbit_normalize
+from pytadbit.tools                       import tadbit_filter
+from pytadbit.tools                       import tadbit_segment
+from pytadbit.utils.sqlite_utils          import add_path
+from pytadbit.parsers.hic_bam_parser      import zoomify
+from pysam                                import AlignmentFile
 from pytadbit.mapping.analyze             import hic_map, plot_distance_vs_interactions
 from pytadbit.mapping.analyze             import insert_sizes, plot_iterative_mapping
 from pytadbit.mapping.analyze             import correlate_matrices, eig_correlate_matrices
+from pytadbit.mapping                     import _sort_run, _iter_run, _merge_runs
 from pytadbit.mapping.filter              import filter_reads, apply_filter
+from pytadbit.mapping.filter              import _filter_duplicates_hashed, _dup_bucket
+from pytadbit.mapping.filter              import DUP_COLUMNS, DUP_DTYPE
+from pytadbit.utils.tadmaths              import library_complexity
+from pytadbit.parsers.pairs_parser        import read_pairs_index, PairsWriter
+from pytadbit.parsers.pairs_parser        import iter_pairs, iter_pairs_lines
+from pytadbit.utils.normalize_hic         import iterative, iterative_sparse, oneD
+from pytadbit.utils.normalize_hic         import expected
 
 from random                               import random, seed
+from multiprocessing                      import RawArray
+from numpy                                import frombuffer, int64, zeros, log
+from numpy                                import nan, isnan, mean
+from numpy.random                         import RandomState
+from scipy.sparse                         import csr_matrix
+from scipy.stats                          import mannwhitneyu
 from os                                   import system, path, chdir, environ
 from re                                   import finditer
 from warnings                             import warn, catch_warnings, simplefilter
 from distutils.spawn                      import find_executable
+from argparse                             import ArgumentParser
+from pickle                               import dump
+from glob                                 import glob
 
+import sqlite3 as lite
+import heapq
 import sys
 
 
@@ -93,6 +131,39 @@ class TestTadbit(unittest.TestCase):
         self.assertEqual(exp1['start'], breaks)
         self.assertEqual(exp1['score'], scores)
 
+        # Mann-Whitney U test against scipy, with NaNs and ties (normal
+        # approximation) and with small samples without ties (exact test)
+        rand = RandomState(3)
+        x = rand.rand(30, 12)
+        y = rand.randint(0, 5, (30, 20)).astype(float)
+        x[rand.rand(30, 12) < 0.3] = nan
+        y[rand.rand(30, 20) < 0.3] = nan
+        for xs, ys in ((x, y), (rand.rand(10, 5), rand.rand(10, 6) + 0.2)):
+            pvals = _mannwhitneyu_less(xs, ys)
+            for pval, xr, yr in zip(pvals, xs, ys):
+                self.assertAlmostEqual(pval, mannwhitneyu(
+                    xr[~isnan(xr)], yr[~isnan(yr)], alternative='less').pvalue)
+
+        # TopDom on a matrix with 4 known TADs
+        sizes = [20, 15, 25, 12]
+        size = sum(sizes)
+        tads = [t for t, s in enumerate(sizes) for _ in range(s)]
+        matrix = zeros((size, size))
+        for i in range(size):
+            for j in range(size):
+                matrix[i, j] = ((100. if tads[i] == tads[j] else 20.) /
+                                (1 + abs(i - j)) + rand.rand())
+        domains = TopDom(csr_matrix((matrix + matrix.T) / 2), 5)
+        self.assertEqual([(d['start'], d['end'], d['tag'])
+                          for _, d in sorted(domains.items())],
+                         [(0, 19, 'domain'), (20, 34, 'domain'),
+                          (35, 59, 'domain'), (60, 72, 'domain')])
+        # same TADs from tadbit, with inclusive ends as with the TADbit engine
+        result = tadbit(csr_matrix((matrix + matrix.T) / 2), use_topdom=True)
+        self.assertEqual(result['start'], [0, 20, 35, 60])
+        self.assertEqual(result['end'], [18, 33, 58, 71])
+        self.assertEqual(result['tag'], ['domain'] * 4)
+
         if CHKTIME:
             print('1', time() - t0)
 
@@ -330,6 +401,88 @@ class TestTadbit(unittest.TestCase):
         sumz = sum([exp._zscores[k1][k2] for k1 in list(exp._zscores.keys())
                     for k2 in exp._zscores[k1]])
         self.assertEqual(round(sumz, 4), round(4059.2877, 4))
+        # expected decay, compared to averaging the diagonals one by one
+        seed(3)
+        size = 100
+        hic = HiC_data([(i * size + j, int(random() * 30 / (1 + abs(i - j))))
+                        for i in range(size) for j in range(size)], size,
+                       chromosomes=OrderedDict([('c1', 60), ('c2', 40)]))
+        bads = {3: True, 10: True, 61: True}
+        min_n = 0.1 ** -2.
+        expc = {}
+        dist = 0
+        while dist < 60:
+            diag = []
+            last = dist
+            while True:
+                for beg, end in hic.section_pos.values():
+                    diag.extend(hic[i, i + last] for i in range(beg, end - last)
+                                if not i in bads)
+                if not diag:
+                    val = 0.
+                    break
+                if sum(diag) > min_n or last >= 60:
+                    val = float(sum(diag)) / len(diag)
+                    break
+                last += 1
+            for dist in range(dist, last + 2):
+                expc[dist] = val
+        for ncpus in (1, 2):
+            expc2 = expected(hic, bads=bads, signal_to_noise=0.1, ncpus=ncpus)
+            self.assertEqual(sorted(expc2), sorted(expc))
+            self.assertEqual([round(expc2[k], 8) for k in sorted(expc)],
+                             [round(expc[k], 8) for k in sorted(expc)])
+        # insulation score and its deltas, compared to summing each window
+        hic.filter_columns(silent=True)
+        hic.normalize_hic(silent=True)
+        hic.normalize_expected()
+        dists = [(1, 3), (2, 6)]
+        ins, deltas = insulation_score(hic, dists, delta=3, silent=True)
+        ins_arr, deltas_arr = insulation_score(hic, dists, delta=3,
+                                               silent=True, as_array=True)
+        for num, (dist, wend) in enumerate(dists):
+            ins2 = {}
+            deltas2 = {}
+            for beg, end in hic.section_pos.values():
+                crm_ins = {}
+                for pos in range(beg + wend, end - wend):
+                    crm_ins[pos] = sum(
+                        hic[i, j] / hic.bias[i] / hic.bias[j] / hic.expected[j - i]
+                        for i in range(pos - wend, pos - dist + 1)
+                        if not i in hic.bads
+                        for j in range(pos + dist, pos + wend + 1)
+                        if not j in hic.bads)
+                for pos in crm_ins:
+                    up_vals = [crm_ins[p] for p in range(pos - 3, pos)
+                               if p in crm_ins]
+                    dw_vals = [crm_ins[p] for p in range(pos + 1, pos + 4)
+                               if p in crm_ins]
+                    deltas2[pos] = mean(up_vals) - mean(dw_vals)
+                ins2.update(crm_ins)
+            for new, ref, arr in ((ins[dists[num]], ins2, ins_arr[num]),
+                                  (deltas[dists[num]], deltas2,
+                                   deltas_arr[num])):
+                self.assertEqual(sorted(new), sorted(ref))
+                self.assertEqual([k for k in range(size) if not isnan(arr[k])],
+                                 [k for k in sorted(ref) if not isnan(ref[k])])
+                for k in ref:
+                    if isnan(ref[k]):
+                        self.assertTrue(isnan(new[k]) and isnan(arr[k]))
+                        continue
+                    self.assertAlmostEqual(new[k], ref[k])
+                    self.assertEqual(arr[k], new[k])
+            # borders are local minima of the insulation score, with deltas
+            # going from positive to negative, from arrays or dictionaries
+            borders = insulation_to_borders(ins[dists[num]], deltas[dists[num]])
+            self.assertTrue(len(borders) > 0)
+            self.assertEqual(insulation_to_borders(ins_arr[num],
+                                                   deltas_arr[num]), borders)
+            for pos, strength in borders:
+                self.assertTrue(ins2[pos] < ins2.get(pos - 1, 100))
+                self.assertTrue(ins2[pos] < ins2.get(pos + 1, 100))
+                self.assertTrue(deltas2.get(pos - 1, 100) > 0 >
+                                deltas2.get(pos + 1, -100))
+                self.assertTrue(0.1 < strength <= 1)
         if CHKTIME:
             print("9", time() - t0)
 
@@ -708,6 +861,9 @@ class TestTadbit(unittest.TestCase):
         ref_genome = parse_fasta(PATH + "/ref_genome/chr2L_chr4_dm3.bz2",
                                  verbose=False)
         self.assertEqual(len(ref_genome["chr4"]), 1351857)
+        lengths = parse_fasta(PATH + "/ref_genome/chr2L_chr4_dm3.bz2",
+                              verbose=False, only_length=True)
+        self.assertEqual(lengths["chr4"], 1351857)
         frags = map_re_sites("dpnIi", ref_genome)
         self.assertEqual(len(frags["chr2L"]), 231)
         self.assertEqual(len(frags["chr2L"][230]), 16)
@@ -716,6 +872,10 @@ class TestTadbit(unittest.TestCase):
         self.assertEqual(len(frags["chr2L"]), 231)
         self.assertEqual(len(frags["chr2L"][230]), 3)
         self.assertEqual(frags["chr4"][10][5], 1017223)
+        sites = re_sites_index("hindiii", ref_genome)
+        self.assertEqual(sorted(set(sites["chr4"].tolist())),
+                         sorted(set(p for chunk in frags["chr4"].values()
+                                    for p in chunk)))
         if CHKTIME:
             self.assertEqual(True, True)
             print("17", time() - t0)
@@ -776,6 +936,235 @@ class TestTadbit(unittest.TestCase):
                                   if not l.startswith("#")]), 1000)
         d = plot_iterative_mapping("lala1-map~", "lala2-map~")
         self.assertEqual(d[0][1], 6000)
+        # same in binary pairs format
+        get_intersection("lala1-map~", "lala2-map~", "lala-map-pairs~",
+                         pairs=True)
+        # same intersection with small buffers (6 runs of 1000 pairs)
+        get_intersection("lala1-map~", "lala2-map~", "lala-map-small~",
+                         max_memory=0.01)
+        with open("lala-map~") as f_lala, open("lala-map-small~") as f_small:
+            self.assertEqual(f_lala.read(), f_small.read())
+        # runs merged by pairs, in several passes
+        with open("lala-map~") as f_lala:
+            crm_ids = dict((l.split()[2], i) for i, l in enumerate(
+                l for l in f_lala if l.startswith("# CRM ")))
+        with open("lala-map~") as f_lala:
+            lines = [tuple(l.split("\t")) for l in f_lala
+                     if not l.startswith("#")]
+        system("rm -rf lala-runs~; mkdir lala-runs~")
+        runs = [_sort_run(lines[i:i + 700], crm_ids,
+                          "lala-runs~/run_%05d.bin" % i, i)
+                for i in range(0, len(lines), 700)]
+        single = list(heapq.merge(*[_iter_run(f, n) for f, n in runs]))
+        merged, chunk_size = _merge_runs(runs, "lala-runs~", 0.01, max_runs=2)
+        self.assertEqual(list(merged), single)
+        self.assertEqual(chunk_size, 5)
+        self.assertEqual(len(single), 6000)
+        system("rm -rf lala-runs~ lala-map-small~")
+        masked = filter_reads("lala-map-pairs~", verbose=False)
+        self.assertEqual([masked[k]["reads"] for k in (1, 2, 3, 4, 9)],
+                         [1000, 1000, 1000, 1000, 1001])
+        self.assertEqual(apply_filter("lala-map-pairs~", "lala-map-filt-pairs~",
+                                      masked, filters=[1], reverse=True,
+                                      verbose=False), 1000)
+        self.assertEqual(read_pairs_index("lala-map-filt-pairs~")["count"], 1000)
+        # pairs of a region read from the blocks overlapping it only
+        chromosomes = OrderedDict()
+        lines = []
+        with open("lala-map~") as f_lala:
+            for line in f_lala:
+                if line.startswith("# CRM "):
+                    crm, clen = line[6:].split()
+                    chromosomes[crm] = int(clen)
+                elif not line.startswith("#"):
+                    lines.append(line)
+        with PairsWriter("lala-map-blocks~", chromosomes,
+                         block_size=300) as out:
+            out.write_lines([l.split("\t") for l in lines])
+        nblocks = len(read_pairs_index("lala-map-blocks~")["blocks"])
+        self.assertEqual(nblocks, 20)
+        for region, start, end in (("chr2", None, None),
+                                   ("chr2", 100000, 300000),
+                                   ("chr9", 0, 50000)):
+            self.assertEqual(
+                list(iter_pairs_lines("lala-map-blocks~", region=region,
+                                      start=start, end=end)),
+                [l for l in lines if l.split("\t")[1] == region and
+                 (start or 0) <= int(l.split("\t")[2]) <=
+                 (chromosomes[region] if end is None else end)])
+        self.assertTrue(len(list(iter_pairs(
+            "lala-map-blocks~", names=False, region="chr2", start=100000,
+            end=300000))) < nblocks)
+        system("rm -f lala-map-blocks~")
+        # filtered BAM written with pysam, sorted by runs of 500 contacts
+        bed2D_to_BAMhic("lala-map-pairs~", False, 2, "lala-map-pairs-bam~",
+                        "mid", masked=masked, max_reads=500)
+        bed2D_to_BAMhic("lala-map-pairs~", False, 2, "lala-map-pairs-bam1~",
+                        "mid", masked=masked)
+        reads = []
+        for fname in ("lala-map-pairs-bam~.bam", "lala-map-pairs-bam1~.bam"):
+            bam = AlignmentFile(fname)
+            self.assertEqual(bam.header["HD"]["SO"], "coordinate")
+            reads.append([(r.reference_id, r.reference_start, r.query_name,
+                           r.flag) for r in bam.fetch(until_eof=True)])
+            bam.close()
+        self.assertEqual(len(reads[0]), 2 * 6000)
+        self.assertEqual([r[:2] for r in reads[0]], sorted(r[:2] for r in reads[0]))
+        self.assertEqual(sorted(reads[0]), sorted(reads[1]))
+        for k in range(1, 11):
+            self.assertEqual(sum(1 for r in reads[0] if r[3] & 2**(k - 1)),
+                             2 * masked[k]["reads"])
+        system("rm -f lala-map-pairs-bam~.bam* lala-map-pairs-bam1~.bam*")
+        # tadbit filter resumed twice with other combinations of filters
+        system("rm -rf lala-filter~; mkdir lala-filter~")
+        system("cp lala-map~ lala-filter~/")
+        con = lite.connect("lala-filter~/trace.db")
+        with con:
+            cur = con.cursor()
+            cur.execute("""create table PATHs
+                           (Id integer primary key, JOBid int, Path text,
+                            Type text, unique (Path))""")
+            cur.execute("""create table JOBs
+                           (Id integer primary key, Parameters text,
+                            Launch_time text, Finish_time text, Type text,
+                            Parameters_md5 text, unique (Parameters_md5))""")
+            add_path(cur, "lala-filter~/lala-map~", "2D_BED", 0, "lala-filter~")
+        for args in (["--apply", "1", "2"],
+                     ["--apply", "1", "2", "3", "--resume", "--pairs"],
+                     ["--apply", "1", "--resume"]):
+            parser = ArgumentParser()
+            tadbit_filter.populate_args(parser)
+            tadbit_filter.run(parser.parse_args(
+                ["-w", "lala-filter~", "-C", "2", "--pathids", "1"] + args))
+        con = lite.connect("lala-filter~/trace.db")
+        with con:
+            cur = con.cursor()
+            cur.execute("""select PATHs.Path, Count from FILTER_OUTPUTs
+                           join PATHs on FILTER_OUTPUTs.PATHid = PATHs.Id
+                           where Name = 'valid-pairs'
+                           order by FILTER_OUTPUTs.JOBid""")
+            valid = cur.fetchall()
+        self.assertEqual([c for _, c in valid], [4000, 3000, 5000])
+        for fname, count in valid:
+            self.assertTrue(fname.endswith(".tsv"))
+            with open(path.join("lala-filter~", fname)) as f_valid:
+                self.assertEqual(sum(1 for l in f_valid
+                                     if not l.startswith("#")), count)
+        system("rm -rf lala-filter~")
+        # duplicates found through hashed buckets, every copy after the first
+        # one is a duplicate, whatever the bucket or range of the pairs
+        ids = {}
+        first = set()
+        dups = set()
+        with open("lala-map~") as f_lala:
+            for line in f_lala:
+                if line.startswith("#"):
+                    continue
+                read, cr1, ps1, sd1, _, _, _, cr2, ps2, sd2 = line.split("\t")[:10]
+                key = (cr1, ps1, sd1, cr2, ps2, sd2)
+                ids[read] = key
+                if key in first:
+                    dups.add(read)
+                first.add(key)
+        self.assertEqual(len(dups), 1001)
+        for max_memory, ncpus in ((1000, 1), (0.01, 1), (0.01, 2)):
+            dup_mask, total = _filter_duplicates_hashed(
+                "lala-map~", "lala-dups~", False, max_memory, ncpus)
+            self.assertEqual(total, 6000)
+            self.assertEqual(dup_mask[9]["reads"], 1001)
+            with open(dup_mask[9]["fnam"]) as f_dups:
+                self.assertEqual(set(l.strip() for l in f_dups), dups)
+        # distinct pairs of reads share buckets (FNV hash modulo 64)
+        crms = dict((c, i) for i, c in enumerate(OrderedDict.fromkeys(
+            k[0] for k in ids.values())))
+        keys = zeros(len(first), dtype=DUP_DTYPE)
+        for i, k in enumerate(DUP_COLUMNS[:6]):
+            keys[k] = [crms.get(v[i], -1) if k.startswith("chrom") else
+                       int(v[i]) for v in first]
+        buckets = _dup_bucket(keys, 64)
+        self.assertEqual(sorted(set(buckets.tolist())), list(range(64)))
+        # estimated library complexity saved with the statistics
+        masked = filter_reads("lala-map~", savedata="lala-stats~", verbose=False)
+        complexity = library_complexity(6000, 6000 - 1001)
+        self.assertAlmostEqual(log(1 - 4999. / complexity),
+                               -6000. / complexity, places=6)
+        self.assertAlmostEqual(masked[9]["complexity"], complexity)
+        with open("lala-stats~") as f_stats:
+            stats = dict(l.rstrip("\n").split("\t") for l in f_stats)
+        self.assertEqual(stats["Mapped both"], "6000")
+        self.assertEqual(stats["duplicated"], "1001")
+        self.assertEqual(stats["Library complexity"], "%.0f" % complexity)
+        system("rm -f lala-dups~* lala-stats~")
+        # binary genome cache, regenerated when written by another version
+        system("rm -f test.fa~_genome.TADbit")
+        genome = parse_fasta("test.fa~", verbose=False)
+        cached = parse_fasta("test.fa~", verbose=False)
+        self.assertTrue(is_genome_cache("test.fa~_genome.TADbit"))
+        self.assertEqual(list(cached), list(genome))
+        self.assertEqual([str(cached[c]) for c in cached],
+                         [genome[c] for c in genome])
+        with open("test.fa~_genome.TADbit", "rb") as f_cache:
+            content = f_cache.read()
+        with open("test.fa~_genome.TADbit", "wb") as f_cache:
+            f_cache.write(content.replace(GENOME_MAGIC,
+                                          GENOME_MAGIC[:-2] + b"\x01\n"))
+        self.assertFalse(is_genome_cache("test.fa~_genome.TADbit"))
+        cached = parse_fasta("test.fa~", verbose=False)
+        self.assertTrue(is_genome_cache("test.fa~_genome.TADbit"))
+        self.assertEqual([str(cached[c]) for c in cached],
+                         [genome[c] for c in genome])
+        # GC content per bin, from strings and from the memory mapped genome
+        genome["chrN"] = "ACGGN" * 7 + "N" * 25 + "GCGCATTTAA" * 3
+        for reso in (7, 10, 10000):
+            expected_gc = {}
+            for crm in genome:
+                expected_gc[crm] = []
+                for beg in range(0, len(genome[crm]), reso):
+                    seq = genome[crm][beg:beg + reso]
+                    nts = len(seq) - seq.count("N")
+                    expected_gc[crm].append(
+                        float(seq.count("G") + seq.count("C")) / nts if nts
+                        else float("nan"))
+            for gen in (genome, cached):
+                gc_content = get_gc_content(gen, reso, by_chrom=True)
+                self.assertEqual(list(gc_content), list(gen))
+                for crm in gc_content:
+                    self.assertEqual(len(gc_content[crm]), len(expected_gc[crm]))
+                    for b, exp_val in enumerate(expected_gc[crm]):
+                        if exp_val != exp_val:
+                            self.assertTrue(gc_content[crm][b] != gc_content[crm][b])
+                        else:
+                            self.assertAlmostEqual(gc_content[crm][b], exp_val)
+        system("rm -f test.fa~_genome.TADbit")
+        # mappability per bin, intervals spanning any number of bins
+        intervals = [("chr1", 0, 3, 1.), ("chr1", 3, 25, 0.5),
+                     ("chr1", 25, 26, 0.25), ("chr1", 30, 61, 0.75),
+                     ("chr2", 5, 9, 1.), ("chr2", 12, 47, 0.2),
+                     ("chr1", 61, 70, 1.)]
+        lines = ["track type=bedGraph\n"] + ["%s\t%d\t%d\t%s\n" % i
+                                            for i in intervals]
+        for reso in (1, 4, 10, 100):
+            expected_map = {}
+            for crm, beg, end, val in intervals:
+                sums = expected_map.setdefault(crm, {})
+                for pos in range(beg, end):
+                    sums[pos // reso] = sums.get(pos // reso, 0) + val
+            weights = OrderedDict()
+            # parsed in two chunks, chr1 extended by the second one
+            _bedgraph_bins(lines[:4], reso, weights)
+            _bedgraph_bins(lines[4:], reso, weights)
+            self.assertEqual(list(weights), ["chr1", "chr2"])
+            for crm in expected_map:
+                self.assertEqual(len(weights[crm]), max(expected_map[crm]) + 1)
+                for b, val in enumerate(weights[crm].tolist()):
+                    self.assertAlmostEqual(val, expected_map[crm].get(b, 0))
+        with open("lala-map.bedGraph~", "w") as f_map:
+            f_map.write("".join(lines))
+        mappability = parse_mappability_bedGraph("lala-map.bedGraph~", 10,
+                                                 save_cache=False)
+        self.assertEqual([round(v, 6) for v in mappability["chr2"]],
+                         [0.4, 0.16, 0.2, 0.2, 0.14])
+        system("rm -f lala-map.bedGraph~")
 
         if CHKTIME:
             self.assertEqual(True, True)
@@ -793,6 +1182,226 @@ class TestTadbit(unittest.TestCase):
         # slowest part of the all test:
         hic_data2 = read_matrix("lala-map.tsv~", resolution=10000)
         self.assertEqual(hic_data1, hic_data2)
+        # same matrix from a BAM file (read by chunks saved as binary arrays)
+        bed2D_to_BAMhic("lala-map~", True, 2, "lala-map-bam~", "mid")
+        hic_data3 = load_hic_data_from_bam("lala-map-bam~.bam", 10000,
+                                           filter_exclude=0, ncpus=2,
+                                           verbose=False)
+        self.assertEqual(hic_data3, hic_data1)
+        (beg1, end1), (beg2, end2) = [hic_data1.section_pos[c]
+                                      for c in ("chr2", "chr3")]
+        self.assertEqual(get_matrix("lala-map-bam~.bam", 10000, filter_exclude=0,
+                                    region1="chr2", region2="chr3", ncpus=1,
+                                    clean=True),
+                         dict(((i - beg1, j - beg2), hic_data1[i, j])
+                              for i in range(beg1, end1)
+                              for j in range(beg2, end2) if hic_data1[i, j]))
+        # chunks of one chromosome parsed in this process, BAM opened once
+        hic_data3 = load_hic_data_from_bam("lala-map-bam~.bam", 10000,
+                                           filter_exclude=0, ncpus=1,
+                                           region="chr2", nchunks=7,
+                                           verbose=False)
+        self.assertEqual(hic_data3.get_matrix(),
+                         hic_data1.get_matrix(focus="chr2"))
+        self.assertFalse("bamfile" in _BAM_WORKER)
+        # multi-resolution cooler, read back only for the wanted regions
+        try:
+            from pytadbit.parsers.cooler_parser import parse_pixels
+        except ImportError:
+            print("ERROR: h5py not found, skipping cooler test\n")
+        else:
+            zoomify("lala-map-bam~.bam", [10000, 20000], "lala-map-bam~.mcool",
+                    filter_exclude=0, ncpus=2, verbose=False)
+            self.assertEqual(load_hic_data_from_bam(
+                "lala-map-bam~.bam", 10000, filter_exclude=0, ncpus=2,
+                verbose=False, mcool="lala-map-bam~.mcool"), hic_data1)
+            for reso in (10000, 20000):
+                for regions in (dict(region1="chr2", region2="chr3"),
+                                dict(region1="chr1", start1=100000,
+                                     end1=500000, region2="chr1",
+                                     start2=300000, end2=800000)):
+                    self.assertEqual(
+                        get_matrix("lala-map-bam~.bam", reso, filter_exclude=0,
+                                   ncpus=1, clean=True,
+                                   mcool="lala-map-bam~.mcool", **regions),
+                        get_matrix("lala-map-bam~.bam", reso, filter_exclude=0,
+                                   ncpus=1, clean=True, **regions))
+            names, offsets, bin1, bin2, _ = parse_pixels(
+                "lala-map-bam~.mcool", 10000, {"chr2": [(10, 40)]})
+            beg = offsets[names.index("chr2")]
+            self.assertTrue(len(bin1) > 0)
+            self.assertTrue(((bin1 >= beg + 10) & (bin1 < beg + 40) &
+                             (bin2 >= beg + 10) & (bin2 < beg + 40)).all())
+        # regions assembled from the tiles kept in a cache
+        cache = BAMTileCache(tile_bins=7, cache_dir="lala-tiles~")
+        for regions in (dict(region1="chr1", start1=100000, end1=500000,
+                             region2="chr1", start2=300000, end2=800000),
+                        dict(region1="chr1", start1=200000, end1=600000,
+                             region2="chr2"),
+                        dict(region1="chr2", region2="chr3")):
+            self.assertEqual(
+                get_matrix("lala-map-bam~.bam", 10000, filter_exclude=0,
+                           ncpus=1, clean=True, cache=cache, **regions),
+                get_matrix("lala-map-bam~.bam", 10000, filter_exclude=0,
+                           ncpus=1, clean=True, **regions))
+        self.assertTrue(cache.hits > 0)
+        self.assertTrue(len(cache) > 0)
+        ntiles = len(cache)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.nbytes, 0)
+        misses = cache.misses
+        # tiles read back from disk after clearing the memory
+        get_matrix("lala-map-bam~.bam", 10000, filter_exclude=0, ncpus=1,
+                   region1="chr2", region2="chr3", cache=cache)
+        self.assertEqual(cache.misses, misses)
+        # least recently used tiles dropped when memory is exceeded
+        small = BAMTileCache(max_memory=0, tile_bins=7)
+        get_matrix("lala-map-bam~.bam", 10000, filter_exclude=0, ncpus=1,
+                   region1="chr1", cache=small)
+        self.assertEqual(len(small), 1)
+        self.assertTrue(ntiles > 1)
+        system("rm -rf lala-tiles~")
+        # cis, total, and close interactions per bin summed in shared memory
+        size = len(hic_data1)
+        shared = RawArray("q", size * 4)
+        tadbit_normalize._init_bam_worker(
+            "lala-map-bam~.bam", 0, hic_data1.section_pos, 10000, ".", "lala~",
+            shared, 1, 5)
+        for crm, (beg, end) in hic_data1.section_pos.items():
+            tadbit_normalize.read_bam_frag(crm, 0, (end - beg) * 10000)
+            system("rm -f " + tadbit_normalize._matrix_frag_path(
+                ".", crm, 0, (end - beg) * 10000, "lala~"))
+        tadbit_normalize._close_bam_worker()
+        counts = [[0] * 4 for _ in range(size)]
+        for crm, (beg, end) in hic_data1.section_pos.items():
+            for i in range(beg, end):
+                for j in range(size):
+                    counts[i][1] += hic_data1[i, j]
+                    if beg <= j < end:
+                        counts[i][0] += hic_data1[i, j]
+                        if abs(i - j) <= 1:
+                            counts[i][2] += hic_data1[i, j]
+                        elif abs(i - j) <= 5:
+                            counts[i][3] += hic_data1[i, j]
+        self.assertEqual(frombuffer(shared, dtype=int64).reshape(-1, 4).tolist(),
+                         counts)
+        # same sums from several processes, Vanilla biases follow them
+        biases, _, badcol, _, _ = tadbit_normalize.read_bam(
+            "lala-map-bam~.bam", 0, 10000, min_count=1, ncpus=2, outdir=".",
+            extra_out="lala~", normalization="Vanilla")
+        self.assertEqual(sorted(badcol),
+                         [i for i in range(size) if not counts[i][1]])
+        ratios = [biases[i] / counts[i][1] for i in range(size)
+                  if not i in badcol]
+        self.assertAlmostEqual(min(ratios), max(ratios))
+        plt.close("all")
+        system("rm -f filtering_summary_plot_10kb_lala~.png")
+        # chunks weighted by reads, also for chromosomes without index stats
+        bam = AlignmentFile("lala-map-bam~.bam")
+        sections = OrderedDict((c, l // 10000 + 1)
+                               for c, l in zip(bam.references, bam.lengths))
+        per_bin = float(bam.mapped) / sum(sections.values())
+        sections["chrZ"] = 30
+        section_pos = {}
+        total = 0
+        for crm in sections:
+            section_pos[crm] = (total, total + sections[crm])
+            total += sections[crm]
+        regs, begs, ends, weights = _balanced_chunks(
+            bam, sections, section_pos, 0, total, 10000, 20)
+        bam.close()
+        self.assertAlmostEqual(sum(weights), 2 * 6000 + 30 * per_bin)
+        self.assertAlmostEqual(sum(w for c, w in zip(regs, weights)
+                                   if c == "chrZ"), 30 * per_bin)
+        for crm in sections:
+            limits = [(b, e) for c, b, e in zip(regs, begs, ends) if c == crm]
+            self.assertEqual([b for b, _ in limits],
+                             [0] + [e + 1 for _, e in limits[:-1]])
+            self.assertEqual(limits[-1][1], sections[crm] * 10000 - 1)
+        # TopDom segmentation from the command line, only domains are written
+        # with inclusive ends (1-based)
+        system("mkdir -p lala-segment~")
+        with open("lala-biases~", "wb") as out:
+            dump({"biases": dict((i, 1.) for i in range(len(hic_data1))),
+                  "badcol": {}, "decay": {}, "resolution": 10000}, out)
+        parser = ArgumentParser()
+        tadbit_segment.populate_args(parser)
+        tadbit_segment.run(parser.parse_args([
+            "-w", "lala-segment~", "--nosql", "--mreads", "lala-map-bam~.bam",
+            "--biases", "lala-biases~", "-r", "10000", "--only_tads",
+            "--topdom", "-C", "2"]))
+        csr = hic_data1.get_hic_data_as_csr()
+        for crm, (beg, end) in hic_data1.section_pos.items():
+            result = tadbit(csr[beg:end, beg:end], use_topdom=True)
+            domains = [[start + 1, final + 1] for start, final, tag in
+                       zip(result["start"], result["end"], result["tag"])
+                       if tag == "domain"]
+            fnam = glob("lala-segment~/06_segmentation/tads_10kb/%s_*.tsv" % crm)
+            tads = [[int(v) for v in line.split()[1:3]] for line in open(fnam[0])
+                    if not line.startswith("#")]
+            self.assertEqual(tads, domains)
+            self.assertTrue(all(start <= final for start, final in tads))
+            self.assertTrue(all(tads[i][1] < tads[i + 1][0]
+                                for i in range(len(tads) - 1)))
+            self.assertEqual(max(final for _, final in tads), end - beg)
+        sparse = SparseHiC_data(hic_data1, len(hic_data1))
+        self.assertEqual(sparse, hic_data1)
+        self.assertEqual(sparse.sum(), hic_data1.sum())
+        MmapHiC_data("lala-mmap~", hic_data1, len(hic_data1))
+        self.assertEqual(load_mmap_hic_data("lala-mmap~"), hic_data1)
+        b1 = iterative(hic_data1, iterations=10, max_dev=0.00001)
+        b2 = iterative_sparse(hic_data1, iterations=10, max_dev=0.00001)
+        self.assertEqual([round(b1[i], 6) for i in b1],
+                         [round(b2[i], 6) for i in b1])
+        # numpy arrays of a region, same as cell by cell
+        size = len(hic_data1)
+        for hic in (hic_data1, sparse):
+            hic.bias = b1
+            hic.bads = {1: True}
+            arr = hic.get_array(focus=(2, size - 1), normalized=True,
+                                diagonal=False, masked=True)
+            self.assertEqual(arr.data.tolist(),
+                             [[0. if i == j else hic[j, i] / b1[j] / b1[i]
+                               for j in range(1, size - 1)]
+                              for i in range(1, size - 1)])
+            self.assertTrue(arr.mask[0].all() and arr.mask[:, 0].all())
+            self.assertFalse(arr.mask[1:, 1:].any())
+            self.assertEqual(hic.get_array(focus=(2, 5), dtype='float32').dtype,
+                             'float32')
+            self.assertEqual(list(hic.yield_matrix(normalized=True)),
+                             [[0.0] * size if i == 1 else
+                              [hic[i, j] / b1[i] / b1[j] for j in range(size)]
+                              for i in range(size)])
+            hic.bias = None
+            hic.bads = {}
+        # oneD on simulated biases (second chromosome with twice the copies)
+        seed(2)
+        mapp = [0.5 + random() / 2 for _ in range(2000)]
+        gc = [0.3 + random() / 5 for _ in range(2000)]
+        expc = [100 * m**2 * (1 + (g - 0.4)**2 * 10) * (2 if i >= 1200 else 1)
+                for i, (m, g) in enumerate(zip(mapp, gc))]
+        tot = [e * (0.9 + random() / 5) for e in expc]
+        b3 = oneD(form="tot ~ s(map) + s(cg)", tot=tot, map=mapp, cg=gc,
+                  sections=[(0, 1200), (1200, 2000)], ncpus=2)
+        ratios = [b / e for b, e in zip(b3, expc)]
+        self.assertTrue(max(ratios) / min(ratios) < 1.1)
+        # oneD fit with smooth and linear terms, and a missing covariate
+        seed(5)
+        mapp = [0.5 + random() / 2 for _ in range(120)]
+        gc = [0.3 + random() / 5 for _ in range(120)]
+        res = [int(random() * 10) for _ in range(120)]
+        tot = [int(50 * m * (1 + (g - 0.4)**2 * 10) * (1 + r / 10.) *
+                   (0.8 + random() * 0.4)) for m, g, r in zip(mapp, gc, res)]
+        mapp[7] = float("nan")
+        b3 = oneD(form="tot ~ s(map) + s(cg) + res", tot=tot, map=mapp, cg=gc,
+                  res=res)
+        self.assertTrue(b3[7] != b3[7])
+        self.assertEqual([round(b, 4) for b in b3[:7]] +
+                         [round(b, 4) for b in b3[8:12]],
+                         [1.4123, 1.5336, 1.245, 1.0925, 1.4755, 0.9355, 0.5522,
+                          1.3321, 0.8417, 1.3029, 0.891])
+        self.assertAlmostEqual(sum(b for b in b3 if b == b), 119.)
         # vals = plot_distance_vs_interactions(hic_data1)
 
         # self.assertEqual([round(i, 2) if str(i)!="nan" else 0.0 for i in